@@ -0,0 +1,263 @@
+# end-to-end benchmarks for the ETL hot paths
+#
+# usage (from the project root):
+#   python -m benchmarks.run_benchmarks                              # default scales, saves a baseline
+#   python -m benchmarks.run_benchmarks --scales 10000 100000 1000000
+#   python -m benchmarks.run_benchmarks --compare benchmarks/baselines/OLD.json benchmarks/baselines/NEW.json
+
+# imports
+import argparse
+import contextlib
+import io
+import json
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# make the project importable when run as a script
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from benchmarks import synthetic
+from benchmarks.server import serve_directory
+
+# defaults
+DEFAULT_SCALES = [10_000, 100_000, 1_000_000]
+DEFAULT_MAX_DISK_FILES = 100_000
+DEFAULT_MAX_ARCHIVE_MEMBERS = 10_000
+BASELINE_DIR = PROJECT_ROOT / "benchmarks" / "baselines"
+DECODE_TIME = {"cn": "night"}
+DECODE_VIS = {"cn": "clear"}
+
+# *******************************
+# Timing helpers
+# *******************************
+
+# stage progress prints would drown the report, so fixtures, setups and timed calls run quietly
+def quiet():
+    return contextlib.redirect_stdout(io.StringIO())
+
+# time a function, returning the median/min over repeats (setup runs before every repeat, untimed)
+def time_it(func, repeats=3, setup=None):
+    times = []
+    for _ in range(repeats):
+        with quiet():
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+    return {"median_s": round(statistics.median(times), 6), "min_s": round(min(times), 6), "repeats": repeats}
+
+# current commit (or "unknown" outside a git checkout)
+def git_commit():
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=PROJECT_ROOT,
+                                capture_output=True, text=True, check=True)
+        return result.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+# *******************************
+# Benchmarks
+# *******************************
+
+# stages that only need a manifest in memory
+def bench_in_memory(scale, repeats, results):
+
+    from src.ingestion import archive, sample
+
+    name = "rcnj_cn_s"
+    shape = synthetic.shape_for_members(scale)
+    paths = synthetic.member_paths(name, **shape)
+    listing = synthetic.slt_listing(f"{name}.7z", paths)
+
+    results["index_archive.parse"][scale] = time_it(lambda: archive.parse_listing(listing, "simple"), repeats)
+    results["index_archive.parse_verbose"][scale] = time_it(lambda: archive.parse_listing(listing, "verbose"), repeats)
+    results["filter_manifest"][scale] = time_it(lambda: sample.filter_manifest(paths, stride=5), repeats)
+    results["build_sample_plan"][scale] = time_it(
+        lambda: sample.build_sample_plan({f"{name}.7z": paths}, STRIDE=5, MAX_IMGS=2000, SEED=42), repeats)
+
+# labelling and splitting over files on disk
+def bench_on_disk(scale, repeats, results, work_dir):
+
+    from src.ingestion import label, split
+
+    # images only, one archive
+    name = "rcnj_cn_s"
+    shape = synthetic.shape_for_members(scale, modalities=("camera",), extras=())
+    sampled_dir = work_dir / f"sampled_{scale}"
+    ready_dir = work_dir / f"ready_{scale}"
+    with quiet():
+        synthetic.write_tree(sampled_dir, name, **shape)
+
+    def build():
+        return label.build_labels_df(sampled_dir, DECODE_TIME, DECODE_VIS, ".7z", ".png")
+
+    results["build_labels_df"][scale] = time_it(build, repeats)
+
+    # exploration index: a few images per agent
+    from src.ingestion import index
+    results["build_index"][scale] = time_it(lambda: index.build_index(sampled_dir / name, limit=8), repeats)
+
+    labels_path = work_dir / f"labels_{scale}.csv"
+    with quiet():
+        build().to_csv(labels_path, index=False)
+
+    results["split_labels"][scale] = time_it(lambda: split.split_labels(labels_path, seed=42), repeats)
+
+    with quiet():
+        splits = split.split_labels(labels_path, seed=42)
+    results["build_splits"][scale] = time_it(
+        lambda: split.build_splits(splits, sampled_dir, ready_dir, overwrite=True),
+        repeats,
+        setup=lambda: shutil.rmtree(ready_dir, ignore_errors=True)
+    )
+
+    shutil.rmtree(ready_dir, ignore_errors=True)
+    shutil.rmtree(sampled_dir, ignore_errors=True)
+
+# download (local HTTP), index and selective extraction of a real synthetic archive
+def bench_archive(scale, repeats, results, work_dir):
+
+    from src.ingestion import archive, download, extract, sample
+
+    with quiet():
+        archive_path = synthetic.make_synthetic_archive(work_dir / f"gen_{scale}", **synthetic.shape_for_members(scale))
+    raw_dir = work_dir / f"raw_{scale}"
+    sampled_dir = work_dir / f"extracted_{scale}"
+
+    with serve_directory(archive_path.parent) as base_url:
+        results["download_files"][scale] = time_it(
+            lambda: download.download_files(base_url, raw_dir, [archive_path.name], timeout=60, max_size_GB=10),
+            repeats,
+            setup=lambda: shutil.rmtree(raw_dir, ignore_errors=True)
+        )
+
+    results["index_archive"][scale] = time_it(lambda: archive.index_archive(archive_path), repeats)
+
+    with quiet():
+        manifest = archive.index_archive(archive_path)
+        file_list = sample.sample_manifest(sample.filter_manifest(manifest, stride=5), 2000, seed=42)
+    results["extract_selected"][scale] = time_it(
+        lambda: extract.extract_selected(archive_path, file_list, sampled_dir, overwrite=True),
+        repeats,
+        setup=lambda: shutil.rmtree(sampled_dir, ignore_errors=True)
+    )
+
+    shutil.rmtree(work_dir / f"gen_{scale}", ignore_errors=True)
+    shutil.rmtree(raw_dir, ignore_errors=True)
+    shutil.rmtree(sampled_dir, ignore_errors=True)
+
+# run every benchmark at every scale
+def run(scales, repeats=3, max_disk_files=DEFAULT_MAX_DISK_FILES, max_archive_members=DEFAULT_MAX_ARCHIVE_MEMBERS):
+
+    from collections import defaultdict
+    results = defaultdict(dict)
+    has_7z = shutil.which("7z") is not None
+
+    with tempfile.TemporaryDirectory(prefix="advercity_bench_") as tmp:
+        work_dir = Path(tmp)
+
+        for scale in scales:
+            print(f"[BENCH] scale={scale}")
+
+            bench_in_memory(scale, repeats, results)
+
+            if scale <= max_disk_files:
+                bench_on_disk(scale, repeats, results, work_dir)
+            else:
+                print(f"  [SKIP] on-disk stages above --max-disk-files={max_disk_files}")
+
+            if not has_7z:
+                print("  [SKIP] archive stages (7z not found)")
+            elif scale <= max_archive_members:
+                bench_archive(scale, repeats, results, work_dir)
+            else:
+                print(f"  [SKIP] archive stages above --max-archive-members={max_archive_members}")
+
+    # JSON keys must be strings
+    return {stage: {str(scale): r for scale, r in by_scale.items()} for stage, by_scale in results.items()}
+
+# *******************************
+# Baselines
+# *******************************
+
+# save results as a baseline for this commit
+def save_baseline(results, output_path=None):
+
+    commit = git_commit()
+    if output_path is None:
+        output_path = BASELINE_DIR / f"{commit}.json"
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+
+    baseline = {
+        "commit": commit,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    output_path.write_text(json.dumps(baseline, indent=2))
+    print(f"[SAVE] Baseline saved to {output_path}")
+    return output_path
+
+# compare two baselines, returning the (stage, scale) pairs that got slower than threshold
+def compare(old_path, new_path, threshold=1.2):
+
+    old = json.loads(Path(old_path).read_text())
+    new = json.loads(Path(new_path).read_text())
+
+    print(f"{'stage':<28} {'scale':>9} {old['commit']:>12} {new['commit']:>12} {'ratio':>7}")
+    regressions = []
+    for stage, by_scale in sorted(new["results"].items()):
+        for scale, r in sorted(by_scale.items(), key=lambda kv: int(kv[0])):
+            before = old["results"].get(stage, {}).get(scale)
+            if before is None:
+                continue
+            ratio = r["median_s"] / before["median_s"] if before["median_s"] > 0 else float("inf")
+            flag = "  <-- slower" if ratio > threshold else ""
+            print(f"{stage:<28} {scale:>9} {before['median_s']:>11.4f}s {r['median_s']:>11.4f}s {ratio:>7.2f}{flag}")
+            if ratio > threshold:
+                regressions.append((stage, scale, ratio))
+
+    return regressions
+
+# print results as a table
+def print_results(results):
+    for stage, by_scale in sorted(results.items()):
+        for scale, r in sorted(by_scale.items(), key=lambda kv: int(kv[0])):
+            print(f"  {stage:<28} {scale:>9}  median {r['median_s']:.4f}s  min {r['min_s']:.4f}s")
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Benchmark the Adver-City ETL stages on synthetic archives.")
+    parser.add_argument("--scales", type=int, nargs="+", default=DEFAULT_SCALES, help="archive sizes (members)")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--max-disk-files", type=int, default=DEFAULT_MAX_DISK_FILES,
+                        help="largest scale for stages that need files on disk")
+    parser.add_argument("--max-archive-members", type=int, default=DEFAULT_MAX_ARCHIVE_MEMBERS,
+                        help="largest scale for stages that need a real .7z archive")
+    parser.add_argument("--output", type=Path, default=None, help="baseline path (default: baselines/<commit>.json)")
+    parser.add_argument("--compare", type=Path, nargs=2, metavar=("OLD", "NEW"),
+                        help="compare two baselines instead of running")
+    parser.add_argument("--threshold", type=float, default=1.2, help="slowdown ratio reported as a regression")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        regressions = compare(*args.compare, threshold=args.threshold)
+        return 1 if regressions else 0
+
+    results = run(args.scales, args.repeats, args.max_disk_files, args.max_archive_members)
+    print_results(results)
+    save_baseline(results, args.output)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
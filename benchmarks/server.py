@@ -0,0 +1,27 @@
+# local HTTP stand-in for the FRDR server (GET and HEAD with content-length)
+
+# imports
+import functools
+import threading
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+# quiet request handler rooted at a directory
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+# serve a directory on localhost for the duration of a with-block, yielding the base URL
+@contextmanager
+def serve_directory(directory, port=0):
+
+    handler = functools.partial(QuietHandler, directory=str(directory))
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,121 @@
+# startup-time benchmark: how long the pipeline modules take to import (python -X importtime)
+#
+# usage (from the project root):
+#   python -m benchmarks.startup                     # exits non-zero if a target is over budget
+#   python -m benchmarks.startup --budget-ms 80 --repeats 10
+#
+# Each target is imported in a fresh interpreter. Its import time is the sum of the cumulative
+# times of the top-level imports it triggers (interpreter startup itself is not counted), and the
+# best of --repeats runs is compared with the budget. A target also fails if it pulls in one of
+# HEAVY_MODULES, which should only be imported by the functions that need them.
+
+# imports
+import argparse
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+
+# what a run imports before doing any work
+TARGETS = {
+    "ETL_pipeline imports": "from src.ingestion import download, archive, sample, extract, validate, label, dedup, split; "
+                            "from src.utils import instrument, profiling",
+    "src.cli": "import src.cli",
+    "src.pipeline.stages": "import src.pipeline.stages",
+    "src.ingestion": "import src.ingestion",
+    "src.utils": "import src.utils",
+    "exploration.utils": "import exploration.utils",
+}
+
+# third-party modules that must not be imported at startup
+HEAVY_MODULES = ["pandas", "numpy", "requests", "tqdm", "PIL", "matplotlib", "directory_tree"]
+
+DEFAULT_BUDGET_MS = 50
+
+# run python -X importtime and parse its report into [(module, cumulative us, depth)]
+def import_times(code):
+
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=PROJECT_ROOT,
+        capture_output=True,
+        text=True,
+        check=True
+    )
+
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|", 2)
+        if not cumulative.strip().isdigit():
+            continue    # the header line
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        rows.append((name.strip(), int(cumulative), depth))
+
+    return rows
+
+# time one target: (milliseconds, heavy modules it imported)
+def measure(code, baseline):
+
+    rows = import_times(code)
+    total_us = sum(cumulative for name, cumulative, depth in rows if depth == 0 and name not in baseline)
+    imported = {name.split(".")[0] for name, _, _ in rows}
+    heavy = sorted(m for m in HEAVY_MODULES if m in imported and m not in baseline)
+
+    return total_us / 1000, heavy
+
+# time every target (best of repeats)
+def run(targets, repeats=5):
+
+    # modules the bare interpreter imports anyway
+    baseline = {name for name, _, _ in import_times("pass")}
+
+    results = {}
+    for label, code in targets.items():
+        times = []
+        heavy = []
+        for _ in range(repeats):
+            ms, heavy = measure(code, baseline)
+            times.append(ms)
+        results[label] = {"ms": min(times), "heavy": heavy}
+
+    return results
+
+# print the results, returns True if every target is within budget
+def report(results, budget_ms):
+
+    ok = True
+    width = max(len(label) for label in results)
+    for label, r in results.items():
+        problems = []
+        if r["ms"] > budget_ms:
+            problems.append(f"over {budget_ms} ms budget")
+        if r["heavy"]:
+            problems.append("imports " + ", ".join(r["heavy"]))
+        ok = ok and not problems
+        status = "FAIL " + "; ".join(problems) if problems else "ok"
+        print(f"  {label:<{width}}  {r['ms']:8.1f} ms  {status}")
+
+    return ok
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Check the import time of the pipeline modules.")
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS, help="per-target import budget")
+    parser.add_argument("--repeats", type=int, default=5, help="runs per target (the best is kept)")
+    parser.add_argument("--json", type=Path, default=None, help="also save the results as JSON")
+    args = parser.parse_args(argv)
+
+    results = run(TARGETS, repeats=args.repeats)
+    ok = report(results, args.budget_ms)
+
+    if args.json is not None:
+        args.json.write_text(json.dumps({"budget_ms": args.budget_ms, "results": results}, indent=2))
+
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
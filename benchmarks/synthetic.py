@@ -0,0 +1,140 @@
+# synthetic Adver-City archives for benchmarking
+#
+# Layout mirrors the real archives:
+#   {prefix}_{weather}_{density}/{agent_id}/{frame_id:06d}_camera{N}.png
+#   {prefix}_{weather}_{density}/{agent_id}/{frame_id:06d}_semantic{N}.png
+#   {prefix}_{weather}_{density}/{agent_id}/{frame_id:06d}_lidar.ply
+#   {prefix}_{weather}_{density}/{agent_id}/{frame_id:06d}.yaml
+# with negative agent ids for static infrastructure cameras.
+
+# imports
+import math
+import struct
+import subprocess
+import zlib
+from pathlib import Path
+
+# first frame id used by the real archives
+FIRST_FRAME = 60
+
+# build a valid PNG in memory (RGB, 8-bit), with pixels derived from seed so files differ
+def tiny_png(width=8, height=8, seed=0):
+
+    def chunk(chunk_type, data):
+        return (struct.pack(">I", len(data)) + chunk_type + data
+                + struct.pack(">I", zlib.crc32(chunk_type + data) & 0xFFFFFFFF))
+
+    # one filter byte (0) per scanline, then RGB pixels
+    raw = b"".join(
+        b"\x00" + bytes(((seed + x * 7 + y * 13 + c * 31) % 256) for x in range(width) for c in range(3))
+        for y in range(height)
+    )
+
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw))
+            + chunk(b"IEND", b""))
+
+# agent ids: -1, -2, ... for infrastructure, then positive vehicle ids
+def agent_ids(agents, infrastructure=2):
+    infrastructure = min(infrastructure, agents)
+    return ([str(-(i + 1)) for i in range(infrastructure)]
+            + [str(161 + 14 * i) for i in range(agents - infrastructure)])
+
+# member paths of one synthetic archive, in the order 7z lists them (directories first)
+def member_paths(name, agents=5, frames=100, cameras=4, modalities=("camera", "semantic"),
+                 extras=("yaml", "lidar")):
+
+    ids = agent_ids(agents)
+    paths = [name] + [f"{name}/{agent}" for agent in ids]
+
+    for agent in ids:
+        for frame in range(FIRST_FRAME, FIRST_FRAME + frames):
+            if "yaml" in extras:
+                paths.append(f"{name}/{agent}/{frame:06d}.yaml")
+            for modality in modalities:
+                for c in range(cameras):
+                    paths.append(f"{name}/{agent}/{frame:06d}_{modality}{c}.png")
+            if "lidar" in extras:
+                paths.append(f"{name}/{agent}/{frame:06d}_lidar.ply")
+
+    return paths
+
+# pick agents/frames so an archive has roughly `members` entries
+def shape_for_members(members, agents=5, cameras=4, modalities=("camera", "semantic"), extras=("yaml", "lidar")):
+    per_frame = cameras * len(modalities) + len(extras)
+    frames = max(1, math.ceil(members / (agents * per_frame)))
+    return {"agents": agents, "frames": frames, "cameras": cameras, "modalities": modalities, "extras": extras}
+
+# the text `7z l -slt` would print for these members (lets parsing be benchmarked without 7z)
+def slt_listing(archive_path, paths, size=512):
+
+    lines = ["", f"Path = {archive_path}", "Type = 7z", "", "----------"]
+    for path in paths:
+        is_dir = "." not in Path(path).name
+        lines += [
+            f"Path = {path}",
+            f"Size = {0 if is_dir else size}",
+            f"Packed Size = {0 if is_dir else size // 2}",
+            "Modified = 2024-01-01 00:00:00",
+            f"Attributes = {'D' if is_dir else 'A'}",
+            f"CRC = {'' if is_dir else format(zlib.crc32(path.encode()), '08X')}",
+            "Encrypted = -",
+            "Method = LZMA2:24",
+            "Block = 0",
+            "",
+        ]
+    return "\n".join(lines)
+
+# write the member files of one synthetic archive under root
+def write_tree(root, name, **shape):
+
+    root = Path(root)
+    png_cache = {}
+    written = 0
+
+    for i, path in enumerate(member_paths(name, **shape)):
+        target = root / path
+        if "." not in target.name:
+            target.mkdir(parents=True, exist_ok=True)
+            continue
+        if target.suffix == ".png":
+            # a handful of distinct images is enough, and keeps generation fast
+            seed = i % 251
+            if seed not in png_cache:
+                png_cache[seed] = tiny_png(seed=seed)
+            target.write_bytes(png_cache[seed])
+        elif target.suffix == ".yaml":
+            target.write_text(f"frame: {target.stem}\nagent: {target.parent.name}\n")
+        else:
+            target.write_bytes(b"ply\nformat binary_little_endian 1.0\nend_header\n")
+        written += 1
+
+    return root / name
+
+# pack a tree into {name}.7z with the 7z command line tool
+def make_archive(tree_dir, archive_path):
+
+    tree_dir = Path(tree_dir)
+    archive_path = Path(archive_path)
+    archive_path.parent.mkdir(parents=True, exist_ok=True)
+
+    if archive_path.exists():
+        archive_path.unlink()
+
+    # store only (-mx0), so benchmarks measure our code rather than LZMA
+    subprocess.run(
+        ["7z", "a", "-mx0", str(archive_path.resolve()), tree_dir.name],
+        cwd=tree_dir.parent,
+        capture_output=True,
+        check=True
+    )
+    return archive_path
+
+# generate a full synthetic archive: {prefix}_{weather}_{density}.7z
+def make_synthetic_archive(work_dir, prefix="rcnj", weather="cn", density="s", **shape):
+
+    work_dir = Path(work_dir)
+    name = f"{prefix}_{weather}_{density}"
+    tree = write_tree(work_dir / "trees", name, **shape)
+    return make_archive(tree, work_dir / "archives" / f"{name}.7z")
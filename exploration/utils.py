@@ -1,64 +1,162 @@
 # designed specifically for dataset exploration and analysis
 # includes all files (images, metadata, YAML configs, etc.)
+#
+# A full extraction is only treated as done once every member of the archive (per its manifest)
+# is on disk; a completed archive is recorded in a ledger in output_dir, so later runs skip it
+# without checking every member again. An interrupted extraction resumes with the missing
+# members only. Several archives can be extracted at once, under a core budget.
 
+# imports (tempfile, the thread pool and src modules are imported where they are used, to keep imports light)
+import os
+import json
 import subprocess
 from pathlib import Path
 
+# ledger of completed full extractions, kept in output_dir
+LEDGER_FILENAME = "full_extract_ledger.json"
+
+# the members of an archive: its saved verbose manifest in index_dir if there is one, else a fresh
+# listing (member sizes are needed to spot files cut off by a crash, simple manifests have none)
+def archive_members(source_path, index_dir=None):
+
+    from src.ingestion import archive
+
+    records = None
+    if index_dir is not None:
+        manifest_path = Path(index_dir) / f"{source_path.stem}_manifest.json"
+        if manifest_path.exists():
+            records = json.loads(manifest_path.read_text())
+            if not any(isinstance(r, dict) for r in records):
+                records = None
+    if records is None:
+        records = archive.index_archive(source_path, mode="verbose")
+
+    # simple manifests hold paths only; 7z lists the archive itself first
+    records = [r if isinstance(r, dict) else {"Path": r} for r in records]
+    return [r for r in records if Path(r["Path"]).name != source_path.name and "Type" not in r]
+
+# members that are not (fully) on disk: missing, or a different size than listed (e.g. cut off by a crash)
+def missing_members(records, output_dir):
+
+    missing = []
+    for r in records:
+        path = output_dir / r["Path"]
+        if not path.exists():
+            missing.append(r["Path"])
+        elif r.get("Folder") != "+" and r.get("Size") and path.is_file() and path.stat().st_size != int(r["Size"]):
+            missing.append(r["Path"])
+
+    return missing
+
+# size and mtime of an archive, so a replaced archive is not taken as extracted
+def _archive_fingerprint(source_path):
+    stat = source_path.stat()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def extract_archive_full(source_path, output_dir, data_format="7z", index_dir=None, threads=None, verify=False):
+
+    '''
+    index_dir: where {name}_manifest.json may be (otherwise the archive is listed)
+    threads:   7z threads for this archive (-mmt), default: all cores
+    verify:    check the members on disk even if the ledger says the archive is done
+    '''
+
+    from src.utils.file_operations import load_json_cache, update_json_cache
 
-def extract_archive_full(source_path, output_dir, data_format="7z"):
-    
     # ensure Path types
     if not isinstance(source_path, Path):
         source_path = Path(source_path)
     if not isinstance(output_dir, Path):
         output_dir = Path(output_dir)
-    
+
     # check if source file exists
     if not source_path.exists():
         raise FileNotFoundError(f"File not found: {source_path}")
-    
+
+    if data_format != "7z":
+        raise ValueError(f"Unsupported archive format: {data_format}")
+
     # create output directory if needed
     output_dir.mkdir(parents=True, exist_ok=True)
-    
+
     # determine extracted directory name
     expected_dir = output_dir / source_path.stem
-    
-    # skip if already extracted
-    if expected_dir.exists():
+    ledger_path = output_dir / LEDGER_FILENAME
+    fingerprint = _archive_fingerprint(source_path)
+
+    # skip if this archive was completely extracted before
+    entry = load_json_cache(ledger_path).get(source_path.name)
+    if not verify and expected_dir.exists() and entry is not None and entry["archive"] == fingerprint:
         print(f"[SKIP] Already extracted:\n  {expected_dir}")
         return expected_dir
-    
-    # extract using 7z (full extraction)
-    print(f"[EXTRACT] Extracting full archive:\n  from: {source_path}\n  to: {output_dir}")
-    
-    if data_format == "7z":
-        subprocess.run(
-            ["7z", "x", str(source_path), f"-o{output_dir}", "-y"],
-            check=True
-        )
-    else:
-        raise ValueError(f"Unsupported archive format: {data_format}")
-    
+
+    # otherwise compare what is on disk with the manifest
+    records = archive_members(source_path, index_dir)
+    missing = missing_members(records, output_dir)
+
+    if missing:
+
+        mmt = f"-mmt{threads}" if threads else "-mmt"
+
+        # nothing there yet: one plain full extraction
+        if len(missing) == len(records):
+            print(f"[EXTRACT] Extracting full archive:\n  from: {source_path}\n  to: {output_dir}")
+            subprocess.run(["7z", "x", str(source_path), f"-o{output_dir}", "-y", mmt], check=True)
+
+        # resume: only the missing members (listed in a file, there can be many)
+        else:
+            import tempfile
+            print(f"[RESUME] Extracting {len(missing)} of {len(records)} members:\n  from: {source_path}\n  to: {output_dir}")
+            with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as f:
+                f.write("\n".join(missing))
+                list_path = f.name
+            try:
+                subprocess.run(["7z", "x", str(source_path), f"-o{output_dir}", "-aoa", mmt, "-scsUTF-8", f"-i@{list_path}"],
+                               check=True)
+            finally:
+                os.unlink(list_path)
+
+        # the extraction must now be complete
+        missing = missing_members(records, output_dir)
+        if missing:
+            raise RuntimeError(f"{source_path.name}: {len(missing)} members still missing after extraction, e.g. {missing[0]}")
+
+    update_json_cache({source_path.name: {"archive": fingerprint, "members": len(records)}}, ledger_path, indent=2)
+
     return expected_dir
 
 
-def extract_archives_full(source_dir, filenames, output_dir, data_format="7z"):
-    
+def extract_archives_full(source_dir, filenames, output_dir, data_format="7z", index_dir=None, cores=None,
+                          threads_per_archive=2, verify=False):
+
+    '''
+    Archives are extracted concurrently: cores // threads_per_archive at a time, each with
+    threads_per_archive 7z threads (cores defaults to all of them).
+    '''
+
+    from concurrent.futures import ThreadPoolExecutor
+
     # ensure Path types
     if not isinstance(source_dir, Path):
         source_dir = Path(source_dir)
     if not isinstance(output_dir, Path):
         output_dir = Path(output_dir)
-    
-    extracted_dirs = []
-    
-    for filename in filenames:
-        source_path = source_dir / filename
-        extracted_dir = extract_archive_full(
-            source_path=source_path,
+
+    cores = cores or os.cpu_count() or 1
+    threads = max(1, min(threads_per_archive, cores))
+    workers = max(1, cores // threads)
+
+    def extract_one(filename):
+        return extract_archive_full(
+            source_path=source_dir / filename,
             output_dir=output_dir,
-            data_format=data_format
+            data_format=data_format,
+            index_dir=index_dir,
+            threads=threads,
+            verify=verify
         )
-        extracted_dirs.append(extracted_dir)
-    
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        extracted_dirs = list(pool.map(extract_one, filenames))
+
     return extracted_dirs
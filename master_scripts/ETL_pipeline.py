@@ -1,4 +1,5 @@
 # standard imports
+import argparse
 import json
 import sys
 import os
@@ -20,7 +21,9 @@ print(f"Current working directory: {Path.cwd()}")
 sys.path.insert(0, str(Path.cwd()))
 
 # custom imports
-from src.ingestion import download, archive, sample, extract, label, split
+from src.ingestion import download, archive, sample, extract, validate, label, dedup, split
+from src.utils import instrument, profiling, disk_budget
+from src.cli import load_config
 
 # check if I can skip download and sampling
 def check_skip(INDEX_DIR, PLAN_FILENAME, SAMPLED_DIR, IMG_EXT):
@@ -54,17 +57,17 @@ def check_skip(INDEX_DIR, PLAN_FILENAME, SAMPLED_DIR, IMG_EXT):
 
 
 # main ETL pipeline
-def main():
+def main(profile_stage=None, profile_mode=None, config_path=None, overrides=None):
 
     # *******************************
     # Load configuration parameters
     # *******************************
 
     PROJECT_ROOT = Path.cwd()
-    CONFIG_PATH = PROJECT_ROOT / "config" / "config.json"
+    CONFIG_PATH = Path(config_path) if config_path else PROJECT_ROOT / "config" / "config.json"
     
-    with open(CONFIG_PATH, "r") as f:
-        cfg = json.load(f)
+    # load config (with any --set overrides)
+    cfg = load_config(CONFIG_PATH, overrides)
     
     # Project Descriptions
     PROJECT_NAME = cfg["project"]["name"]
@@ -80,6 +83,15 @@ def main():
     # Make the directories
     for p in [RAW_DIR, INDEX_DIR, SAMPLED_DIR, READY_DIR]:
         p.mkdir(parents=True, exist_ok=True)
+
+    # Per-stage metrics (only wraps the stage functions if enabled in the config)
+    instrument.setup(cfg, INDEX_DIR)
+
+    # Remote sizes and validators are cached between runs
+    download.setup_metadata_cache(cfg, INDEX_DIR)
+
+    # Profile one stage (from --profile, or profiling.stage in the config)
+    profiling.setup_from_config(cfg, INDEX_DIR, stage=profile_stage, mode=profile_mode)
     
     # Archive info
     BASE_URL = cfg["ingestion"]["url"]                        # remote location of data archive
@@ -90,6 +102,11 @@ def main():
     MAX_GB = float(cfg["ingestion"]["max_size_GB"])           # maximum file size
     MAX_IMGS = int(cfg["ingestion"]["images_per_archive"])    # maximum number of images to pull
     STRIDE = int(cfg["ingestion"]["frame_stride"])            # gaps between frames when sampling
+    SAMPLE_MODE = cfg["ingestion"].get("sample_mode", "images")   # images, groups (whole synchronized frames) or clips
+    CLIP_LEN = int(cfg["ingestion"].get("clip_length", 8))            # frames per clip (clips mode)
+    CLIP_OVERLAP = int(cfg["ingestion"].get("clip_overlap", 0))       # frames shared by consecutive clips
+    MAX_CLIPS = cfg["ingestion"].get("max_clips_per_archive", None)   # default: as many as MAX_IMGS allows
+    MAX_CLIPS = int(MAX_CLIPS) if MAX_CLIPS is not None else max(1, MAX_IMGS // CLIP_LEN)
     SEED = int(cfg["reproducibility"]["seed"])
     random.seed(SEED)
     CLEANUP_RAW = cfg["sampling"].get("cleanup_raw_after_extract", False)
@@ -97,13 +114,30 @@ def main():
     # Sampling plan config
     PLAN_FILENAME = cfg["sampling"]["plan_filename"]          # filename for sample plan
     PLAN_OVERWRITE = cfg["sampling"]["overwrite"]             # whether to overwrite existing plan
+    PRUNE_REMOVED = cfg["sampling"].get("prune_removed", True)    # delete sampled files a changed plan dropped
     LABELS_FILENAME = cfg["sampling"]["labels_filename"]      # filename for labels CSV
+    CLIPS_FILENAME = cfg["sampling"].get("clips_filename", "clips.csv")   # filename for the clip table
     
     # Image info
     CAMERA = cfg["ingestion"].get("camera", None)             # safer
     #IMG_TYPE = cfg["ingestion"]["image_type"]                 # rgb
     IMG_EXT = cfg["ingestion"]["image_extension"]             # file extension of images
+    MODALITIES = cfg["ingestion"].get("modalities", None)     # e.g. ["camera", "semantic"]: aligned members per sample
+    MODALITY_PATTERNS = cfg["ingestion"].get("modality_patterns", None)   # member names of the other sensors
     
+    # Image info (header scanning)
+    images_cfg = cfg.get("images", {})
+    SCAN_HEADERS = images_cfg.get("scan_headers", False)              # add width/height/etc. to labels
+    HEADER_CACHE = INDEX_DIR / images_cfg.get("header_cache_filename", "image_headers.json")
+    WORKERS = int(images_cfg.get("workers", 8))                       # parallel workers for image passes
+    VALIDATE = images_cfg.get("validate", False)                      # check extracted images before labelling
+    VALIDATE_MODE = images_cfg.get("validate_mode", "crc")            # crc (chunk/archive CRCs) or decode (full PIL decode)
+    VALIDATION_PATH = INDEX_DIR / images_cfg.get("validation_filename", "image_validation.json")
+    DEDUP = images_cfg.get("dedup", False)                            # hash images and keep duplicates in one split
+    DEDUP_PERCEPTUAL = images_cfg.get("dedup_perceptual", False)      # also group near-identical frames
+    DEDUP_LINK = images_cfg.get("dedup_link_copies", False)           # store exact duplicates once (hard links)
+    HASH_CACHE = INDEX_DIR / images_cfg.get("hash_cache_filename", "image_hashes.json")
+
     # Labelling info
     labels_cfg = cfg["labels"]
     
@@ -128,6 +162,18 @@ def main():
     DECODE_TIME = labels_cfg["weather_decode_time"]           # maps files to day/night
     DECODE_VIS = labels_cfg["weather_decode_visibility"]      # maps files to visibility conditions
     
+    # Extraction ledger (what was extracted from each archive)
+    LEDGER_PATH = INDEX_DIR / cfg.get("pipeline", {}).get("ledger_filename", "extract_ledger.json")
+
+    # Catalog (SQLite copy of the manifests, plan, ledger and labels) and the query that narrows the plan
+    catalog_cfg = cfg.get("catalog", {})
+    CATALOG = catalog_cfg.get("enabled", False)
+    CATALOG_PATH = INDEX_DIR / catalog_cfg.get("filename", "catalog.sqlite")
+    QUERY = catalog_cfg.get("query") or {}          # e.g. {"time": "night", "visibility": "fog", "camera": [0, 1, 2]}
+
+    # Disk budget over raw, sampled and ready (None if not configured)
+    BUDGET = disk_budget.make_budget(cfg, PROJECT_ROOT, LEDGER_PATH, INDEX_DIR / PLAN_FILENAME)
+
     # Check if we can skip download and sampling
     CHECK_SKIP_OPTION = cfg["ingestion"].get("check_skip_option", False) 
 
@@ -141,6 +187,14 @@ def main():
     print(f"Project: {PROJECT_NAME}\n")
     print(f"Description: {PROJECT_DESC}\n")
 
+    # Stage graph mode: each stage re-runs only if its inputs, config or outputs changed
+    PIPELINE_MODE = cfg.get("pipeline", {}).get("mode", "linear")
+
+    if PIPELINE_MODE == "dag":
+        from src.pipeline import stages
+        stages.run_pipeline(cfg, PROJECT_ROOT)
+        return
+
     # *******************************
     # 1. Download from remote server
     # *******************************
@@ -153,7 +207,7 @@ def main():
     if not skip:
 
         print(separator)
-        print("[1/7]: Downloading data from remote server... \n")
+        print("[1/8]: Downloading data from remote server... \n")
 
         filenames = download.build_filenames(
             CHOOSE_PREFIX, CHOOSE_WEATHER, CHOOSE_DENSITY,
@@ -161,15 +215,23 @@ def main():
             ARCHIVE_EXT
         )
 
+        # the archive-level part of the query (e.g. time, visibility) is answered before downloading
+        if QUERY:
+            from src.ingestion import catalog
+            if catalog.archive_query(QUERY):
+                filenames = catalog.filter_archives(CATALOG_PATH, filenames, QUERY, DECODE_TIME, DECODE_VIS, ARCHIVE_EXT)
+
         print(' Built the following filenames: \n', filenames)
 
-        download_raw = download.download_files(
+        download_raw = download.download_with_config(
+            cfg["ingestion"],
             base_url=BASE_URL,
             destinations_dir=RAW_DIR,
             filenames=filenames,
             timeout=60,
             max_size_GB=MAX_GB,
-            overwrite=PLAN_OVERWRITE
+            overwrite=PLAN_OVERWRITE,
+            budget=BUDGET
         )
         print(' Downloaded ', len(download_raw), 'files.')
         for file in download_raw:
@@ -180,17 +242,32 @@ def main():
         # *******************************
 
         print(separator)
-        print("[2/7]: Developing manifest... \n")
+        print("[2/8]: Developing manifest... \n")
 
         archives = sorted(RAW_DIR.glob(f"*{ARCHIVE_EXT}"))
         print(f"    Found {len(archives)} downloaded archives\n")
         
         manifests = {}
+        frame_groups = {}
         for archive_file in archives:
             manifest = archive.build_manifest(archive_file, INDEX_DIR, mode=MANIFEST_MODE)
             manifests[archive_file.name] = manifest
             print(f"  {archive_file.name}: {len(manifest)} lines")
 
+            # narrow the candidates to the members that match the query (filtered by the catalog)
+            if QUERY:
+                manifests[archive_file.name] = catalog.query_manifest(
+                    CATALOG_PATH, archive_file.name, INDEX_DIR / f"{archive_file.stem}_manifest.json", QUERY,
+                    DECODE_TIME, DECODE_VIS, ARCHIVE_EXT)
+                print(f"  {archive_file.name}: {len(manifests[archive_file.name])} members match the query")
+
+            # index the synchronized frames, to sample them whole (from the candidates, with a query)
+            if SAMPLE_MODE == "groups" and QUERY:
+                frame_groups[archive_file.name] = sample.build_frame_groups(manifests[archive_file.name], img_ext=IMG_EXT)
+            elif SAMPLE_MODE == "groups":
+                frame_groups[archive_file.name] = sample.load_frame_groups(
+                    INDEX_DIR / f"{archive_file.stem}_manifest.json", img_ext=IMG_EXT, manifest=manifest)
+
         print(f"\n Total manifests: {len(manifests)}")
 
         # *******************************
@@ -198,31 +275,56 @@ def main():
         # *******************************
 
         print(separator)
-        print("[3/7]: Building sampling plan... \n")
-
-        sampling_plan = sample.build_sample_plan(
-            manifests,
-            CAMERA=CAMERA,
-            IMG_EXT=IMG_EXT,
-            STRIDE=STRIDE,
-            MAX_IMGS=MAX_IMGS,
-            SEED=SEED
-        )
+        print("[3/8]: Building sampling plan... \n")
+
+        if SAMPLE_MODE == "clips":
+            sampling_plan, archive_clips = sample.build_clip_plan(
+                manifests,
+                CAMERA=CAMERA,
+                IMG_EXT=IMG_EXT,
+                STRIDE=STRIDE,
+                CLIP_LEN=CLIP_LEN,
+                CLIP_OVERLAP=CLIP_OVERLAP,
+                MAX_CLIPS=MAX_CLIPS,
+                SEED=SEED,
+                MODALITIES=MODALITIES,
+                MODALITY_PATTERNS=MODALITY_PATTERNS
+            )
+            sample.save_clip_table(archive_clips, INDEX_DIR / CLIPS_FILENAME)
+        else:
+            sampling_plan = sample.build_sample_plan(
+                manifests,
+                CAMERA=CAMERA,
+                IMG_EXT=IMG_EXT,
+                STRIDE=STRIDE,
+                MAX_IMGS=MAX_IMGS,
+                SEED=SEED,
+                MODE=SAMPLE_MODE,
+                GROUPS=frame_groups,
+                MODALITIES=MODALITIES,
+                MODALITY_PATTERNS=MODALITY_PATTERNS
+            )
 
         print(f"\n Total images to extract: {sum(len(v) for v in sampling_plan.values())}")
         
+        previous_plan = sample.load_sample_plan(INDEX_DIR / PLAN_FILENAME)
+
         sample.save_sample_plan(
             sampling_plan,
             INDEX_DIR / PLAN_FILENAME,
             overwrite=PLAN_OVERWRITE
         )
 
+        # extraction below only fetches what the plan added; drop what it removed
+        if PRUNE_REMOVED:
+            sample.prune_removed(sample.plan_diff(previous_plan, sampling_plan), SAMPLED_DIR)
+
         # *******************************
         # 4. Extract based on sampling plan
         # *******************************
 
         print(separator)
-        print("[4/7]: Extracting based on sampling plan... \n")
+        print("[4/8]: Extracting based on sampling plan... \n")
 
         sample_plan_file = INDEX_DIR / PLAN_FILENAME
         
@@ -231,53 +333,111 @@ def main():
             raw_dir=RAW_DIR,
             sampled_dir=SAMPLED_DIR,
             overwrite=PLAN_OVERWRITE,
-            cleanup_raw=CLEANUP_RAW
+            cleanup_raw=CLEANUP_RAW,
+            ledger_path=LEDGER_PATH,
+            budget=BUDGET
         )
         
         print(f"\n Extraction complete. Location:")
         print(f"  {SAMPLED_DIR.name}/")
     
     else:
-        print(" [SKIP] Skipping step #1/7: Download data from remote server\n")
-        print(" [SKIP] Skipping step #2/7: Develop manifest\n")
-        print(" [SKIP] Skipping step #3/7: Build sampling plan\n")
-        print(" [SKIP] Skipping step #4: Extract based on sampling plan\n")
+        print(" [SKIP] Skipping step #1/8: Download data from remote server\n")
+        print(" [SKIP] Skipping step #2/8: Develop manifest\n")
+        print(" [SKIP] Skipping step #3/8: Build sampling plan\n")
+        print(" [SKIP] Skipping step #4/8: Extract based on sampling plan\n")
 
     # *******************************
-    # 5. Labelling and Metadata
+    # 5. Validate extracted images
+    # *******************************
+
+    invalid = None
+
+    if VALIDATE:
+
+        print(separator)
+        print("[5/8]: Validating extracted images... \n")
+
+        invalid = validate.validate_sample_plan(
+            sample_plan_file=INDEX_DIR / PLAN_FILENAME,
+            sampled_dir=SAMPLED_DIR,
+            index_dir=INDEX_DIR,
+            mode=VALIDATE_MODE,
+            workers=WORKERS,
+            validation_path=VALIDATION_PATH
+        )
+
+    else:
+        print(" [SKIP] Skipping step #5/8: Validate extracted images\n")
+
+    # *******************************
+    # 6. Labelling and Metadata
     # *******************************
 
     print(separator)
-    print("[5/7]: Labelling and Metadata... \n")
+    print("[6/8]: Labelling and Metadata... \n")
 
     labels_data = label.build_labels_df(
         sampled_dir=SAMPLED_DIR,
         decode_time=DECODE_TIME,
         decode_vis=DECODE_VIS,
         archive_ext=ARCHIVE_EXT,
-        img_ext=IMG_EXT
+        img_ext=IMG_EXT,
+        invalid=invalid,
+        modalities=MODALITIES,
+        modality_patterns=MODALITY_PATTERNS
     )
     
     print(f"\nLabeled {len(labels_data)} images")
+
+    if SCAN_HEADERS:
+        labels_data = label.add_image_headers(
+            df=labels_data,
+            sampled_dir=SAMPLED_DIR,
+            workers=WORKERS,
+            cache_path=HEADER_CACHE
+        )
     
+    if DEDUP:
+        labels_data = dedup.dedup_labels(
+            df=labels_data,
+            sampled_dir=SAMPLED_DIR,
+            perceptual=DEDUP_PERCEPTUAL,
+            workers=WORKERS,
+            cache_path=HASH_CACHE,
+            link_copies=DEDUP_LINK
+        )
+
     _ = label.save_labels(
         df=labels_data,
         output_path=INDEX_DIR / LABELS_FILENAME,
     )
 
+    # bring the catalog up to date with this run's manifests, plan, ledger and labels
+    if CATALOG:
+        from src.ingestion import catalog
+        catalog.sync_catalog(
+            CATALOG_PATH,
+            download.build_filenames(CHOOSE_PREFIX, CHOOSE_WEATHER, CHOOSE_DENSITY,
+                                     VALID_PREFIX, VALID_WEATHER, VALID_DENSITY, ARCHIVE_EXT),
+            INDEX_DIR, INDEX_DIR / PLAN_FILENAME, LEDGER_PATH, INDEX_DIR / LABELS_FILENAME,
+            DECODE_TIME, DECODE_VIS, ARCHIVE_EXT
+        )
+
     # *******************************
-    # 6. Generate Train/Val/Test sets
+    # 7. Generate Train/Val/Test sets
     # *******************************
 
     print(separator)
-    print("[6/7]: Generating Train/Val/Test sets... \n")
+    print("[7/8]: Generating Train/Val/Test sets... \n")
 
     splits = split.split_labels(
         labels_path=INDEX_DIR / LABELS_FILENAME,
         train_ratio=SPLITS_TRAIN,
         val_ratio=SPLITS_VAL,
         test_ratio=SPLITS_TEST,
-        seed=SEED
+        seed=SEED,
+        group_col=split.group_column(DEDUP, SAMPLE_MODE)
     )
     
     print(f"Train: {len(splits['train'])} images")
@@ -292,11 +452,11 @@ def main():
     )
 
     # *******************************
-    # 7. Finish
+    # 8. Finish
     # *******************************
 
     print(separator)
-    print("[7/7]: Finished... \n")
+    print("[8/8]: Finished... \n")
 
     print(f" Dataset ready for next steps at: ")
     print(f"  Train: {(READY_DIR / 'train')}/")
@@ -304,4 +464,20 @@ def main():
     print(f"  Test: {(READY_DIR / 'test')}/")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+
+    parser = argparse.ArgumentParser(description="Run the Adver-City ETL pipeline.")
+    parser.add_argument("--config", default=None, help="config file (default: config/config.json)")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="override a config value, e.g. --set ingestion.images_per_archive=500 (repeatable)")
+    parser.add_argument("--profile", metavar="STAGE", default=None,
+                        help="profile one stage, e.g. extract, label, extract:rcnj_cn_s or extract.extract_selected")
+    parser.add_argument("--profile-mode", choices=["cprofile", "sampling"], default=None,
+                        help="cProfile stats (.prof) or sampled collapsed stacks for flamegraphs (.collapsed)")
+    args = parser.parse_args()
+
+    try:
+        main(profile_stage=args.profile, profile_mode=args.profile_mode,
+             config_path=args.config, overrides=args.set)
+    finally:
+        # write the run report and metrics (no-op if instrumentation is off)
+        instrument.finish()
\ No newline at end of file
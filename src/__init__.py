@@ -5,3 +5,16 @@ Created on Fri Dec 23 10:02:18 2022
 
 @author: tjards
 """
+
+# submodules are imported on first access (PEP 562), so importing the package stays cheap
+import importlib
+
+_SUBMODULES = ["cli", "ingestion", "pipeline", "utils"]
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module(f"{__name__}.{name}")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def __dir__():
+    return sorted(list(globals()) + _SUBMODULES)
@@ -0,0 +1,352 @@
+# command line entry point for the ETL pipeline:
+#   adver-etl {download,manifest,plan,extract,validate,label,split,all} [--set key=value ...] [--dry-run]
+#
+# Each subcommand runs the stages of that kind in the stage graph, plus anything upstream of them
+# that is out of date. Only the standard library is imported at the top, so --help and --dry-run
+# start without loading pandas.
+
+# imports
+import sys
+import json
+import shutil
+import argparse
+from pathlib import Path
+
+STAGE_KINDS = ["download", "manifest", "plan", "extract", "validate", "label", "thumbnails", "catalog", "merge", "split"]
+
+# *******************************
+# Configuration
+# *******************************
+
+# walk up from start until we find a directory holding config/config.json
+def find_project_root(start=None):
+
+    start = Path.cwd() if start is None else Path(start)
+    for directory in [start] + list(start.parents):
+        if (directory / "config" / "config.json").exists():
+            return directory
+
+    raise FileNotFoundError(f"No config/config.json found in {start} or its parents (use --root or --config)")
+
+# parse an override value as JSON (numbers, true/false, null, lists), otherwise keep it as a string
+def parse_value(text):
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return text
+
+# apply "section.key=value" overrides to the config (in place)
+def apply_overrides(cfg, overrides):
+
+    for override in overrides or []:
+
+        if "=" not in override:
+            raise ValueError(f"Override '{override}' is not of the form key=value")
+
+        dotted_key, text = override.split("=", 1)
+        keys = dotted_key.strip().split(".")
+
+        # walk down to the parent section, creating sections as needed
+        section = cfg
+        for key in keys[:-1]:
+            if not isinstance(section.setdefault(key, {}), dict):
+                raise ValueError(f"Override '{dotted_key}': '{key}' is not a section")
+            section = section[key]
+
+        section[keys[-1]] = parse_value(text)
+        print(f"[SET] {dotted_key} = {section[keys[-1]]!r}")
+
+    return cfg
+
+# load the config and apply any overrides
+def load_config(config_path, overrides=None):
+
+    # enforce Path type
+    if not isinstance(config_path, Path):
+        config_path = Path(config_path)
+
+    with open(config_path, "r") as f:
+        cfg = json.load(f)
+
+    return apply_overrides(cfg, overrides)
+
+# *******************************
+# Dry run
+# *******************************
+
+# human readable byte count
+def format_bytes(n):
+    if n is None:
+        return "?"
+    for unit in ["B", "KB", "MB", "GB", "TB"]:
+        if abs(n) < 1024 or unit == "TB":
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+
+# estimate the work one archive needs: bytes to download and decompress, files to write
+def estimate_archive(s, filename, kind="all", timeout=30):
+
+    from src.ingestion import download, sample
+    from src.pipeline.stages import plan_candidates
+
+    stem = Path(filename).stem
+    raw_path = s["raw_dir"] / filename
+    manifest_path = s["index_dir"] / f"{stem}_manifest.json"
+    notes = []
+
+    # the plan this archive would get (the manifest is needed for that, narrowed by the catalog query if any)
+    manifest = json.loads(manifest_path.read_text()) if manifest_path.exists() else None
+    if manifest is not None:
+        candidates = plan_candidates(s, filename, manifest_path)
+        file_list, _ = sample.sample_archive(candidates, camera=s["camera"], img_ext=s["img_ext"], stride=s["stride"],
+                                             max_imgs=s["max_imgs"], seed=s["seed"], mode=s["sample_mode"],
+                                             clip_len=s["clip_len"], clip_overlap=s["clip_overlap"], max_clips=s["max_clips"],
+                                             modalities=s["modalities"], modality_patterns=s["modality_patterns"])
+        if s["overwrite"]:
+            missing = list(file_list)
+        else:
+            missing = [f for f in file_list if not (s["sampled_dir"] / f).exists()]
+    else:
+        file_list = None
+        missing = None
+        notes.append("no manifest yet, files capped at images_per_archive")
+
+    # archive size: on disk, or from the server
+    if raw_path.exists():
+        size = raw_path.stat().st_size
+    else:
+        try:
+            size = download.content_length(f"{s['base_url']}/{filename}", timeout)
+        except Exception as e:
+            size = None
+            notes.append(f"HEAD failed: {e}")
+
+    # the download stage would skip it
+    if size is not None and size > s["max_gb"] * 1024 ** 3:
+        return {"archive": filename, "download": 0, "archive_size": size, "decompress": 0,
+                "files": 0, "notes": [f"skipped, over max_size_GB ({s['max_gb']})"]}
+
+    # the raw archive is only fetched if asked for, or if we need to index it or extract from it
+    extracting = kind not in ("download", "manifest", "plan")
+    needs_raw = not raw_path.exists() and (kind == "download" or manifest is None or (extracting and bool(missing)))
+    download_bytes = size if needs_raw else 0
+
+    # bytes to decompress: exact with a verbose manifest, otherwise the archive's share
+    if missing is None:
+        files = s["max_imgs"]
+        decompress = None
+    else:
+        files = len(missing)
+        member_sizes = {f["Path"]: int(f.get("Size") or 0) for f in manifest if isinstance(f, dict)}
+        if not missing:
+            decompress = 0
+        elif member_sizes:
+            decompress = sum(member_sizes.get(f, 0) for f in missing)
+        elif size is not None and manifest:
+            decompress = int(size * len(missing) / len(manifest))
+            notes.append("decompressed size estimated from the archive size (simple manifest)")
+        else:
+            decompress = None
+
+    # images already on disk (copied again when the splits are built)
+    on_disk = 0
+    if file_list is not None:
+        missing_set = set(missing)
+        for f in file_list:
+            path = s["sampled_dir"] / f
+            if f not in missing_set and path.exists():
+                on_disk += path.stat().st_size
+
+    return {"archive": filename, "download": download_bytes, "archive_size": size, "decompress": decompress,
+            "files": files, "on_disk": on_disk, "notes": notes}
+
+# estimate the work for a stage (and everything upstream of it) without running anything
+def estimate(cfg, project_root, kind="all"):
+
+    from src.pipeline.stages import load_settings, archive_filenames
+
+    s = load_settings(cfg, project_root)
+    workers = int(cfg.get("pipeline", {}).get("workers", 4))
+
+    # only this node's archives, when sharded
+    filenames = archive_filenames(s)
+    rows = [estimate_archive(s, filename, kind) for filename in filenames]
+
+    # stages before extraction write no images
+    extracting = kind not in ("download", "manifest", "plan")
+    splitting = kind in ("split", "all") and not (s["shards"] > 1 and s["shard"] is not None)
+    if not extracting:
+        for row in rows:
+            row["decompress"] = 0
+            row["files"] = 0
+
+    def total(key):
+        values = [row.get(key) for row in rows]
+        return None if any(v is None for v in values) else sum(values)
+
+    download_total = total("download")
+    decompress_total = total("decompress")
+    split_total = None
+    if splitting and decompress_total is not None:
+        split_total = decompress_total + sum(row.get("on_disk", 0) for row in rows)
+
+    # disk peak: raw archives held while extracting (only `workers` at once if they are cleaned up),
+    # plus the extracted images, plus the split copies
+    raw_peak = None
+    raw_after = None
+    downloads = [row["download"] for row in rows]
+    if None not in downloads:
+        if s["cleanup_raw"] and extracting:
+            raw_peak = sum(sorted(downloads, reverse=True)[:workers])
+            raw_after = 0
+        else:
+            raw_peak = raw_after = sum(downloads)
+
+    peak = None
+    if raw_peak is not None and decompress_total is not None:
+        peak = raw_peak + decompress_total
+        if split_total is not None:
+            peak = max(peak, raw_after + decompress_total + split_total)
+
+    return {
+        "kind": kind,
+        "archives": rows,
+        "download": download_total,
+        "decompress": decompress_total,
+        "files": total("files"),
+        "split_copies": split_total,
+        "disk_peak": peak,
+        "disk_free": shutil.disk_usage(project_root).free,
+    }
+
+# print a dry run estimate
+def print_estimate(est):
+
+    print(f"\n[DRY RUN] {est['kind']}: {len(est['archives'])} archives\n")
+    width = max([len(row["archive"]) for row in est["archives"]] + [7])
+    print(f"  {'archive':<{width}}  {'download':>10}  {'decompress':>10}  {'files':>7}")
+    for row in est["archives"]:
+        print(f"  {row['archive']:<{width}}  {format_bytes(row['download']):>10}  "
+              f"{format_bytes(row['decompress']):>10}  {row['files']:>7}"
+              + (f"  ({'; '.join(row['notes'])})" if row["notes"] else ""))
+
+    print()
+    print(f"  bytes to download:   {format_bytes(est['download'])}")
+    print(f"  bytes to decompress: {format_bytes(est['decompress'])}")
+    print(f"  files to write:      {est['files']}")
+    if est["split_copies"] is not None:
+        print(f"  split copies:        {format_bytes(est['split_copies'])}")
+    print(f"  disk peak (extra):   {format_bytes(est['disk_peak'])} of {format_bytes(est['disk_free'])} free")
+
+    if est["disk_peak"] is not None and est["disk_peak"] > est["disk_free"]:
+        print("[WARN] the estimated disk peak is more than the free space")
+
+# *******************************
+# Entry point
+# *******************************
+
+def build_parser():
+
+    # options shared by every subcommand
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--root", default=None,
+                        help="project root (default: the nearest directory with config/config.json)")
+    common.add_argument("--config", default=None,
+                        help="config file (default: ROOT/config/config.json)")
+    common.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="override a config value, e.g. --set ingestion.images_per_archive=500 (repeatable)")
+    common.add_argument("--dry-run", action="store_true",
+                        help="estimate bytes to download/decompress, files to write and the disk peak, then stop")
+    common.add_argument("--shard", metavar="K/N", default=None,
+                        help="run as node K (0-based) of N: only this shard's archives, up to its labels")
+    common.add_argument("--local-shards", type=int, metavar="N", default=None,
+                        help="run N local node processes (one per shard), then merge and split")
+    common.add_argument("--offline", action="store_true",
+                        help="use the cached remote metadata (sizes, ETags) without asking the server")
+    common.add_argument("--queue-workers", type=int, metavar="N", default=None,
+                        help="run the archives through the job queue on N local worker processes")
+    common.add_argument("--profile", metavar="STAGE", default=None,
+                        help="profile one stage, e.g. extract, extract:rcnj_cn_s or extract.extract_selected")
+    common.add_argument("--profile-mode", choices=["cprofile", "sampling"], default=None,
+                        help="cProfile stats (.prof) or sampled collapsed stacks for flamegraphs (.collapsed)")
+
+    parser = argparse.ArgumentParser(prog="adver-etl", description="Run the Adver-City ETL pipeline.")
+    subparsers = parser.add_subparsers(dest="stage", metavar="STAGE", required=True)
+    for kind in STAGE_KINDS:
+        subparsers.add_parser(kind, parents=[common], help=f"run the {kind} stages (and anything upstream that is out of date)")
+    subparsers.add_parser("all", parents=[common], help="run the whole pipeline")
+
+    return parser
+
+def main(argv=None):
+
+    args = build_parser().parse_args(argv)
+
+    # locate the project and load the config
+    project_root = Path(args.root).resolve() if args.root else find_project_root()
+    config_path = Path(args.config).resolve() if args.config else project_root / "config" / "config.json"
+    cfg = load_config(config_path, args.set)
+
+    # run as one node of a sharded run
+    if args.shard is not None:
+        from src.pipeline.shards import parse_shard
+        shard, shards = parse_shard(args.shard)
+        cfg.setdefault("sharding", {}).update({"shard": shard, "shards": shards})
+        print(f"[SHARD] node {shard} of {shards}")
+
+    # remote sizes and validators are cached between runs
+    if args.offline:
+        cfg["ingestion"]["offline"] = True
+    from src.ingestion import download
+    download.setup_metadata_cache(cfg, project_root / cfg["data_paths"]["index"])
+
+    # archives through the job queue
+    if args.queue_workers is not None:
+        cfg.setdefault("pipeline", {}).update({"executor": "queue", "queue_workers": args.queue_workers})
+
+    if args.dry_run:
+        print_estimate(estimate(cfg, project_root, args.stage))
+        return 0
+
+    # make the directories
+    index_dir = project_root / cfg["data_paths"]["index"]
+    for key in ["raw", "index", "sampled", "ready"]:
+        (project_root / cfg["data_paths"][key]).mkdir(parents=True, exist_ok=True)
+
+    from src.utils import instrument, profiling
+    from src.pipeline import stages
+
+    # local processes stand in for the nodes, then this process coordinates
+    if args.local_shards is not None:
+        from src.pipeline import shards
+        cfg.setdefault("sharding", {}).update({"shard": None, "shards": args.local_shards})
+        node_kind = "all" if args.stage in ("all", "merge", "split") else args.stage
+
+        # the nodes get the same run options as this process
+        flags = ["--offline"] if args.offline else []
+        if args.queue_workers is not None:
+            flags += ["--queue-workers", str(args.queue_workers)]
+        if args.profile is not None:
+            flags += ["--profile", args.profile]
+        if args.profile_mode is not None:
+            flags += ["--profile-mode", args.profile_mode]
+
+        codes = shards.run_local_nodes(node_kind, args.local_shards, project_root,
+                                       stages.load_settings(cfg, project_root)["shards_dir"],
+                                       config_path=config_path, overrides=args.set, flags=flags)
+        if any(codes.values()) or node_kind != "all":
+            return 1 if any(codes.values()) else 0
+
+    instrument.setup(cfg, index_dir)
+    profiling.setup_from_config(cfg, index_dir, stage=args.profile, mode=args.profile_mode)
+
+    try:
+        status = stages.run_pipeline(cfg, project_root, kind=None if args.stage == "all" else args.stage)
+    finally:
+        instrument.finish()
+
+    # non-zero exit if anything failed or was blocked
+    return 0 if all(result in ("done", "skipped", "deferred", "empty") for result in status.values()) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -17,6 +17,11 @@ def index_archive(archive_path, mode="simple"):
         check=True
     )
 
+    return parse_listing(result.stdout, mode)
+
+# parse the output of `7z l -slt` into a manifest
+def parse_listing(listing, mode="simple"):
+
     # initialize manifest list
     files = []
 
@@ -24,7 +29,7 @@ def index_archive(archive_path, mode="simple"):
     current = {}
 
     # parse the records
-    for line in result.stdout.splitlines():
+    for line in listing.splitlines():
         
         # clean line
         line = line.strip()
@@ -97,3 +102,27 @@ def build_manifest(archive_path, index_dir, mode="simple"):
     print(f"[SAVE] Manifest saved:\n  {manifest_path.name}")
 
     return files
+
+# pull per-member CRCs from a manifest (only verbose manifests carry them)
+def member_crcs(manifest):
+
+    crcs = {}
+    for record in manifest:
+        # simple manifests are just path strings
+        if isinstance(record, dict) and record.get("CRC"):
+            crcs[record["Path"]] = record["CRC"]
+
+    return crcs
+
+# load the per-member CRCs for an archive from its saved manifest (if any)
+def load_member_crcs(archive_name, index_dir):
+
+    # ensure Path types
+    if not isinstance(index_dir, Path):
+        index_dir = Path(index_dir)
+
+    manifest_path = index_dir / f"{Path(archive_name).stem}_manifest.json"
+    if not manifest_path.exists():
+        return {}
+
+    return member_crcs(json.loads(manifest_path.read_text()))
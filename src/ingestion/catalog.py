@@ -0,0 +1,394 @@
+# a local catalog of the archives, their members, the sampling plan, the extraction ledger and the labels
+#
+# The JSON and CSV files stay the source of truth; the catalog is a SQLite copy of them, indexed on
+# (archive, agent_id, frame_id, camera) and on (visibility, time), that is brought up to date when a
+# file changed (sources holds the fingerprint each file was loaded at). Selections are written as a
+# declarative query, e.g.
+#     {"time": "night", "visibility": ["fog"], "camera": {">=": 0, "<=": 2}, "agent_id": {">=": 0}}
+# (a value means ==, a list means IN, a dict holds operators), which is compiled to a WHERE clause so
+# the filtering runs in SQLite rather than in Python.
+
+# imports (pandas is imported inside the functions that use it, to keep startup fast)
+import os
+import json
+import sqlite3
+from pathlib import Path
+from src.utils.file_operations import file_fingerprint
+from src.ingestion.index import parse_image_name
+from src.ingestion.label import extract_archive_labels
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS archives (
+    name       TEXT PRIMARY KEY,   -- archive stem, e.g. rcnj_cn_s
+    filename   TEXT NOT NULL,
+    prefix     TEXT,
+    weather    TEXT,
+    density    TEXT,
+    time       TEXT,
+    visibility TEXT
+);
+CREATE INDEX IF NOT EXISTS archives_conditions ON archives (visibility, time);
+
+CREATE TABLE IF NOT EXISTS members (
+    archive  TEXT NOT NULL,
+    position INTEGER NOT NULL,     -- order in the manifest, so selections keep it
+    path     TEXT NOT NULL,
+    agent_id INTEGER,
+    frame_id INTEGER,
+    camera   INTEGER,              -- sensor number (camera0, semantic0 -> 0)
+    modality TEXT,
+    size     INTEGER,              -- verbose manifests only
+    PRIMARY KEY (archive, position)
+) WITHOUT ROWID;
+-- covering indexes: selections by agent or by frame range are answered from the index alone
+CREATE INDEX IF NOT EXISTS members_key ON members (archive, agent_id, frame_id, camera, modality, position, path);
+CREATE INDEX IF NOT EXISTS members_frames ON members (archive, frame_id, camera, agent_id, modality, position, path);
+
+CREATE TABLE IF NOT EXISTS plan (
+    archive TEXT NOT NULL,
+    path    TEXT NOT NULL,
+    PRIMARY KEY (archive, path)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS extracted (
+    archive      TEXT PRIMARY KEY,
+    files        INTEGER,
+    plan_hash    TEXT,
+    extracted_at TEXT
+);
+
+CREATE TABLE IF NOT EXISTS sources (
+    path        TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL
+);
+"""
+
+# query keys and the columns they filter on
+ARCHIVE_COLUMNS = {key: f"a.{key}" for key in ["prefix", "weather", "density", "time", "visibility"]}
+ARCHIVE_COLUMNS["archive"] = "a.name"
+MEMBER_COLUMNS = dict(ARCHIVE_COLUMNS, **{key: f"m.{key}" for key in ["agent_id", "frame_id", "camera", "modality"]})
+LABEL_COLUMNS = {key: f"l.{key}" for key in ["archive", "prefix", "weather", "density", "time", "visibility",
+                                             "agent_id", "frame_id", "camera"]}
+
+OPERATORS = {"==": "=", "!=": "!=", "<": "<", "<=": "<=", ">": ">", ">=": ">="}
+
+# *******************************
+# Connection
+# *******************************
+
+# open the catalog (one connection per thread or process)
+def connect(db_path):
+    db_path = Path(db_path)
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+# the fingerprint of every file loaded into the catalog (the stage fingerprint of the catalog stage)
+def source_fingerprints(db_path):
+    if not Path(db_path).exists():
+        return None
+    conn = connect(db_path)
+    sources = dict(conn.execute("SELECT path, fingerprint FROM sources").fetchall())
+    conn.close()
+    return sources
+
+# the file's fingerprint if it changed since it was loaded (None if it did not, or does not exist)
+def _changed(conn, path):
+    if not Path(path).exists():
+        return None
+    fingerprint = json.dumps(file_fingerprint(path))
+    row = conn.execute("SELECT fingerprint FROM sources WHERE path = ?", (str(path),)).fetchone()
+    return None if row is not None and row[0] == fingerprint else fingerprint
+
+# refresh the statistics the query planner uses to pick an index (sampled, so it stays cheap)
+def _analyze(conn):
+    conn.execute("PRAGMA analysis_limit = 1000")
+    conn.execute("ANALYZE")
+
+# replace a table's rows from a file, and remember the file's fingerprint, in one transaction
+def _replace(conn, path, fingerprint, statements):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for sql, params in statements:
+            if isinstance(params, list):
+                conn.executemany(sql, params)
+            else:
+                conn.execute(sql, params)
+        conn.execute("INSERT OR REPLACE INTO sources (path, fingerprint) VALUES (?, ?)", (str(path), fingerprint))
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+# *******************************
+# Loading
+# *******************************
+
+# "camera0" -> 0
+def camera_number(camera_id):
+    digits = "".join(c for c in str(camera_id or "") if c.isdigit())
+    return int(digits) if digits else None
+
+# record the archives with their decoded conditions (time, visibility)
+def register_archives(conn, filenames, decode_time, decode_vis, archive_ext):
+
+    rows = []
+    for filename in filenames:
+        details = extract_archive_labels(filename, decode_time, decode_vis, archive_ext)
+        if details is None:
+            continue
+        rows.append((Path(filename).stem, filename, details["prefix"], details["weather"], details["density"],
+                     details["time"], details["visibility"]))
+
+    conn.executemany("INSERT OR REPLACE INTO archives VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+# catalog rows for the members of one manifest (simple or verbose; directories are left out)
+def manifest_rows(manifest, archive_name):
+
+    for position, entry in enumerate(manifest):
+
+        if isinstance(entry, dict):
+            if entry.get("Folder") == "+" or "Type" in entry:
+                continue
+            member, size = entry["Path"], int(entry["Size"]) if entry.get("Size") else None
+        else:
+            member, size = entry, None
+
+        # expecting {archive}/{agent_id}/.../{frame_id}_{sensor}.{ext}
+        parts = member.replace("\\", "/").split("/")
+        stem, ext = os.path.splitext(parts[-1])
+        if not ext:
+            continue
+        agent_id = int(parts[1]) if len(parts) > 2 and parts[1].lstrip("-").isdigit() else None
+        frame_id, camera_id, modality = parse_image_name(stem)
+
+        yield (archive_name, position, member, agent_id, frame_id, camera_number(camera_id), modality, size)
+
+# load an archive's manifest (if it changed since it was loaded)
+def sync_manifest(conn, manifest_path, filename):
+
+    fingerprint = _changed(conn, manifest_path)
+    if fingerprint is None:
+        return False
+
+    name = Path(filename).stem
+    rows = list(manifest_rows(json.loads(Path(manifest_path).read_text()), name))
+    _replace(conn, manifest_path, fingerprint, [
+        ("DELETE FROM members WHERE archive = ?", (name,)),
+        ("INSERT INTO members VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows),
+    ])
+    return True
+
+# load the sampling plan ({archive filename: [paths]})
+def sync_plan(conn, plan_file):
+
+    fingerprint = _changed(conn, plan_file)
+    if fingerprint is None:
+        return False
+
+    plan = json.loads(Path(plan_file).read_text())
+    rows = [(Path(filename).stem, path) for filename, paths in plan.items() for path in paths]
+    _replace(conn, plan_file, fingerprint, [
+        ("DELETE FROM plan", ()),
+        ("INSERT OR IGNORE INTO plan VALUES (?, ?)", rows),
+    ])
+    return True
+
+# load the extraction ledger
+def sync_ledger(conn, ledger_path):
+
+    fingerprint = _changed(conn, ledger_path)
+    if fingerprint is None:
+        return False
+
+    ledger = json.loads(Path(ledger_path).read_text())
+    rows = [(Path(filename).stem, entry.get("files"), entry.get("plan_hash"), entry.get("extracted_at"))
+            for filename, entry in ledger.items()]
+    _replace(conn, ledger_path, fingerprint, [
+        ("DELETE FROM extracted", ()),
+        ("INSERT INTO extracted VALUES (?, ?, ?, ?)", rows),
+    ])
+    return True
+
+# load the labels (every column of the labels CSV, plus archive and the camera number)
+def sync_labels(conn, labels_file):
+
+    import pandas as pd
+
+    fingerprint = _changed(conn, labels_file)
+    if fingerprint is None:
+        return False
+
+    df = pd.read_csv(labels_file)
+    if not df.empty:
+        df["archive"] = df["archive_name"]
+        df["camera"] = df["camera_id"].map(camera_number)
+
+    # the table is dropped, rebuilt, indexed and its fingerprint recorded in one transaction, so a reader
+    # sees either the old labels or the new ones (pandas' to_sql would commit on its own, so it is not used)
+    statements = [("DROP TABLE IF EXISTS labels", ())]
+    if len(df.columns):
+        rows = df.astype(object).where(df.notna(), None).values.tolist()
+        statements += [
+            (pd.io.sql.get_schema(df, "labels"), ()),
+            (f"INSERT INTO labels VALUES ({', '.join('?' * len(df.columns))})", rows),
+        ]
+    if not df.empty:
+        statements += [
+            ("CREATE INDEX labels_key ON labels (archive, agent_id, frame_id, camera)", ()),
+            ("CREATE INDEX labels_conditions ON labels (visibility, time)", ()),
+        ]
+    _replace(conn, labels_file, fingerprint, statements)
+    return True
+
+# bring the whole catalog up to date with the files on disk
+def sync_catalog(db_path, filenames, index_dir, plan_file, ledger_path, labels_file, decode_time, decode_vis,
+                 archive_ext):
+
+    '''
+    filenames are the archives of the run; their manifests ({stem}_manifest.json in
+    index_dir) are loaded if they exist. Only files that changed since the last sync
+    are read. Returns the names of the files that were (re)loaded.
+    '''
+
+    conn = connect(db_path)
+    register_archives(conn, filenames, decode_time, decode_vis, archive_ext)
+
+    loaded = []
+    for filename in filenames:
+        manifest_path = Path(index_dir) / f"{Path(filename).stem}_manifest.json"
+        if sync_manifest(conn, manifest_path, filename):
+            loaded.append(manifest_path.name)
+    for path, sync in [(plan_file, sync_plan), (ledger_path, sync_ledger), (labels_file, sync_labels)]:
+        if sync(conn, path):
+            loaded.append(Path(path).name)
+
+    if loaded:
+        _analyze(conn)
+    conn.close()
+
+    print(f"[CATALOG] loaded {len(loaded)} changed files into {Path(db_path).name}" + (f": {', '.join(loaded)}" if loaded else ""))
+    return loaded
+
+# *******************************
+# Queries
+# *******************************
+
+# a query value as stored in the catalog ("camera1" -> 1)
+def _query_value(key, value):
+    if key == "camera" and isinstance(value, str):
+        return camera_number(value)
+    return value
+
+# compile a query into a WHERE clause over the given columns: (sql, params)
+def compile_query(query, columns):
+
+    clauses = []
+    params = []
+
+    for key, condition in (query or {}).items():
+
+        if key not in columns:
+            raise ValueError(f"Unknown query key: {key} (expected one of {', '.join(sorted(columns))})")
+        column = columns[key]
+
+        # a value means ==, a list means IN
+        if not isinstance(condition, dict):
+            condition = {"in": condition} if isinstance(condition, list) else {"==": condition}
+
+        for op, value in condition.items():
+            if op == "in":
+                values = [_query_value(key, v) for v in value]
+                clauses.append(f"{column} IN ({', '.join('?' * len(values))})")
+                params.extend(values)
+            elif op in OPERATORS:
+                clauses.append(f"{column} {OPERATORS[op]} ?")
+                params.append(_query_value(key, value))
+            else:
+                raise ValueError(f"Unknown operator in query for {key}: {op} (expected in, {', '.join(OPERATORS)})")
+
+    return " AND ".join(clauses) or "1", params
+
+# only the archive-level part of a query (what can be answered before anything is downloaded)
+def archive_query(query):
+    return {key: value for key, value in (query or {}).items() if key in ARCHIVE_COLUMNS}
+
+# the archives (of filenames) whose conditions match the query, in the order given
+def filter_archives(db_path, filenames, query, decode_time, decode_vis, archive_ext):
+
+    where, params = compile_query(archive_query(query), ARCHIVE_COLUMNS)
+
+    conn = connect(db_path)
+    register_archives(conn, filenames, decode_time, decode_vis, archive_ext)
+    matching = {row[0] for row in conn.execute(f"SELECT a.filename FROM archives a WHERE {where}", params)}
+    conn.close()
+
+    return [f for f in filenames if f in matching]
+
+# the members that match the query (of one archive, if given), in manifest order
+def select_members(db_path, query, archive=None):
+
+    where, params = compile_query(query, MEMBER_COLUMNS)
+    if archive is not None:
+        where += " AND m.archive = ?"
+        params.append(Path(archive).stem)
+
+    conn = connect(db_path)
+    rows = conn.execute(
+        f"""SELECT m.path FROM members m JOIN archives a ON a.name = m.archive
+            WHERE {where} ORDER BY m.archive, m.position""",
+        params
+    ).fetchall()
+    conn.close()
+
+    return [row[0] for row in rows]
+
+# the planned members that match the query: {archive filename: [paths]} (only extracted archives, if asked)
+def select_plan(db_path, query, extracted=False):
+
+    where, params = compile_query(query, MEMBER_COLUMNS)
+    join = "JOIN extracted e ON e.archive = p.archive" if extracted else ""
+
+    conn = connect(db_path)
+    rows = conn.execute(
+        f"""SELECT a.filename, m.path FROM plan p {join}
+            JOIN members m ON m.archive = p.archive AND m.path = p.path
+            JOIN archives a ON a.name = m.archive
+            WHERE {where} ORDER BY m.archive, m.position""",
+        params
+    ).fetchall()
+    conn.close()
+
+    plan = {}
+    for filename, path in rows:
+        plan.setdefault(filename, []).append(path)
+    return plan
+
+# the label rows that match the query, as a DataFrame
+def select_labels(db_path, query):
+
+    import pandas as pd
+
+    where, params = compile_query(query, LABEL_COLUMNS)
+
+    conn = connect(db_path)
+    try:
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'labels'").fetchone() is None:
+            return pd.DataFrame()
+        return pd.read_sql_query(f"SELECT * FROM labels l WHERE {where}", conn, params=params)
+    finally:
+        conn.close()
+
+# the candidates of one archive for its sampling plan: its manifest, narrowed to the members that match the query
+def query_manifest(db_path, filename, manifest_path, query, decode_time, decode_vis, archive_ext):
+
+    conn = connect(db_path)
+    register_archives(conn, [filename], decode_time, decode_vis, archive_ext)
+    if sync_manifest(conn, manifest_path, filename):
+        _analyze(conn)
+    conn.close()
+
+    return select_members(db_path, query, archive=filename)
@@ -0,0 +1,171 @@
+# imports
+import os
+import hashlib
+from pathlib import Path
+from src.utils.file_operations import file_fingerprint, load_json_cache, update_json_cache
+from src.utils import profiling
+
+# exact content hash of a file
+def content_hash(path, chunk_size=1024 * 1024):
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+# perceptual (difference) hash: near-identical frames map to the same value
+def perceptual_hash(path, hash_size=8):
+
+    '''
+    dHash: shrink to (hash_size + 1) x hash_size greyscale and record,
+    for each pixel, whether it is brighter than its right-hand neighbour.
+    '''
+
+    # import here so exact-only runs do not need PIL in the workers
+    from PIL import Image
+
+    with Image.open(path) as img:
+        small = img.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR)
+        pixels = list(small.getdata())
+
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+
+    return f"{bits:0{hash_size * hash_size // 4}x}"
+
+# hash one image (runs in a worker process)
+def _hash_one(args):
+    path, perceptual = args
+    try:
+        exact = content_hash(path)
+        phash = perceptual_hash(path) if perceptual else None
+        return exact, phash, None
+    except Exception as e:
+        return None, None, str(e)
+
+# hash many images in parallel, reusing cached hashes for unchanged files
+def hash_images(sampled_dir, rel_paths, perceptual=False, workers=4, cache_path=None):
+
+    # enforce Path type
+    if not isinstance(sampled_dir, Path):
+        sampled_dir = Path(sampled_dir)
+
+    # load previous results
+    cache = load_json_cache(cache_path)
+
+    # decide which files need hashing
+    hashes = {}
+    to_hash = []
+    fingerprints = {}
+    for rel_path in rel_paths:
+        rel_path = str(rel_path)
+        full_path = sampled_dir / rel_path
+        if not full_path.exists():
+            continue
+
+        fingerprint = file_fingerprint(full_path)
+        entry = cache.get(rel_path)
+        if (entry is not None
+                and entry["fingerprint"] == fingerprint
+                and (not perceptual or entry.get("phash") is not None)):
+            hashes[rel_path] = (entry["content_hash"], entry.get("phash"))
+            continue
+
+        fingerprints[rel_path] = fingerprint
+        to_hash.append(rel_path)
+
+    print(f"[HASH] {len(to_hash)} to hash, {len(hashes)} cached")
+
+    # hash the rest in parallel
+    updates = {}
+    if to_hash:
+        jobs = [(str(sampled_dir / rel_path), perceptual) for rel_path in to_hash]
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers, **profiling.pool_kwargs()) as pool:
+            for rel_path, (exact, phash, error) in zip(to_hash, pool.map(_hash_one, jobs, chunksize=64)):
+                if error is not None:
+                    print(f"[ERROR] could not hash {rel_path}: {error}")
+                    continue
+                hashes[rel_path] = (exact, phash)
+                updates[rel_path] = {"fingerprint": fingerprints[rel_path], "content_hash": exact, "phash": phash}
+
+        # persist for next time
+        if cache_path is not None:
+            update_json_cache(updates, cache_path)
+
+    return hashes
+
+# add dedup columns to the labels, and optionally store only one copy of each exact duplicate
+def dedup_labels(df, sampled_dir, perceptual=False, workers=4, cache_path=None, link_copies=False):
+
+    '''
+    Adds columns:
+        content_hash   : exact hash of the file contents
+        phash          : perceptual hash (only if perceptual=True)
+        canonical_path : the copy of this content that is kept (first image_path in sort order)
+        is_duplicate   : True if this row is not the canonical copy
+        dup_group      : rows sharing a value must land in the same split
+                         (phash if perceptual, otherwise content_hash)
+    If link_copies=True, non-canonical exact duplicates in sampled_dir are replaced by
+    hard links to canonical_path, so the bytes are stored once but every row stays valid.
+    '''
+
+    # enforce Path type
+    if not isinstance(sampled_dir, Path):
+        sampled_dir = Path(sampled_dir)
+
+    # nothing to do
+    if df.empty:
+        return df
+
+    # hash everything (cached per file fingerprint)
+    hashes = hash_images(sampled_dir, df["image_path"], perceptual=perceptual, workers=workers, cache_path=cache_path)
+
+    df["content_hash"] = [hashes.get(p, (None, None))[0] for p in df["image_path"]]
+    if perceptual:
+        df["phash"] = [hashes.get(p, (None, None))[1] for p in df["image_path"]]
+
+    # canonical copy = first path (sorted) with the same content
+    canonical = {}
+    for rel_path, exact in sorted(zip(df["image_path"], df["content_hash"])):
+        if exact is not None and exact not in canonical:
+            canonical[exact] = rel_path
+
+    df["canonical_path"] = [
+        canonical.get(exact, rel_path) for rel_path, exact in zip(df["image_path"], df["content_hash"])
+    ]
+    df["is_duplicate"] = df["canonical_path"] != df["image_path"]
+
+    # grouping key for splitting (unhashed rows fall back to their own path)
+    group_source = df["phash"] if perceptual else df["content_hash"]
+    df["dup_group"] = group_source.fillna(df["image_path"])
+
+    n_dups = int(df["is_duplicate"].sum())
+    n_groups = df["dup_group"].nunique()
+    print(f"[DEDUP] {n_dups} exact duplicates, {n_groups} groups for {len(df)} images")
+
+    # keep only the canonical copy on disk (duplicates become hard links to it)
+    if link_copies:
+        linked = 0
+        for rel_path, canonical_path in df.loc[df["is_duplicate"], ["image_path", "canonical_path"]].itertuples(index=False):
+            dup_path = sampled_dir / rel_path
+            src_path = sampled_dir / canonical_path
+            if not dup_path.exists() or not src_path.exists() or dup_path.samefile(src_path):
+                continue
+            # link next to the duplicate, then swap it in (never leaves a missing file)
+            temp = dup_path.with_suffix(dup_path.suffix + ".link")
+            try:
+                if temp.exists():
+                    temp.unlink()
+                os.link(src_path, temp)
+                os.replace(temp, dup_path)
+                linked += 1
+            except OSError as e:
+                print(f"[ERROR] could not link {rel_path}: {e}")
+        print(f"[CLEANUP] Replaced {linked} duplicate copies with links in {sampled_dir.name}")
+
+    return df
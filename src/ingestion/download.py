@@ -1,7 +1,9 @@
-# imports
-import requests
-from tqdm import tqdm
+# imports (requests, httpx, tqdm and asyncio are imported inside the functions that use them, to keep startup fast)
+import time
+import threading
 from pathlib import Path
+from src.utils import disk_budget
+from src.utils.file_operations import load_json_cache, update_json_cache
 
 # ensures choices are passed as lists
 def as_list(x):
@@ -45,6 +47,127 @@ def build_filenames(CHOOSE_PREFIX, CHOOSE_WEATHER, CHOOSE_DENSITY,
     
     return filenames               
 
+# *******************************
+# Remote metadata cache
+# *******************************
+
+# size and validators of remote archives, kept between runs (set up with setup_metadata_cache)
+_metadata_cache = {"path": None, "ttl_s": 86400, "offline": False}
+
+# use a persistent metadata cache (ingestion.http_cache_filename in index_dir, ingestion.http_cache_ttl_s)
+def setup_metadata_cache(cfg, index_dir):
+
+    ingestion_cfg = cfg.get("ingestion", {})
+    filename = ingestion_cfg.get("http_cache_filename", "remote_metadata.json")
+
+    _metadata_cache["path"] = None if filename is None else Path(index_dir) / filename
+    _metadata_cache["ttl_s"] = float(ingestion_cfg.get("http_cache_ttl_s", 86400))
+    _metadata_cache["offline"] = bool(ingestion_cfg.get("offline", False))
+
+    return _metadata_cache["path"]
+
+# the cached entry for a url (None if there is none)
+def cached_metadata(url):
+    return load_json_cache(_metadata_cache["path"]).get(url)
+
+# a cached entry that can be used without asking the server (fresh, or offline)
+def _fresh_metadata(url):
+    entry = cached_metadata(url)
+    if entry is None:
+        return None
+    if _metadata_cache["offline"] or time.time() - entry["fetched_at"] < _metadata_cache["ttl_s"]:
+        return entry
+    return None
+
+# headers that let the server answer 304 if the archive has not changed
+def _conditional_headers(entry):
+    headers = {}
+    if entry is not None and entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry is not None and entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+# turn a HEAD response into a cache entry (and save it), None if the server had nothing
+def _store_metadata(url, status_code, headers, entry):
+
+    # unchanged: keep what we know, it is fresh again
+    if status_code == 304 and entry is not None:
+        entry = dict(entry, fetched_at=time.time())
+    elif 200 <= status_code < 300:
+        size = headers.get("content-length")
+        entry = dict(
+            entry or {},
+            size=None if size is None else int(size),
+            etag=headers.get("etag"),
+            last_modified=headers.get("last-modified"),
+            fetched_at=time.time(),
+        )
+    else:
+        return None
+
+    if _metadata_cache["path"] is not None:
+        update_json_cache({url: entry}, _metadata_cache["path"], indent=2)
+    return entry
+
+# size, ETag and Last-Modified of a remote file (from the cache when fresh, else revalidated with HEAD)
+def remote_metadata(url, timeout):
+
+    entry = _fresh_metadata(url)
+    if entry is not None:
+        return entry
+
+    # offline: what the cache does not know stays unknown
+    if _metadata_cache["offline"]:
+        return None
+
+    # stale or unknown: ask the server, conditionally if we have validators
+    import requests
+
+    entry = cached_metadata(url)
+    r = requests.head(url, timeout = timeout, allow_redirects=True, headers=_conditional_headers(entry))
+    return _store_metadata(url, r.status_code, r.headers, entry)
+
+# note what we downloaded, so an unchanged remote copy is not fetched again
+def record_download(url, destination):
+
+    if _metadata_cache["path"] is None:
+        return
+
+    entry = cached_metadata(url) or {}
+    stat = Path(destination).stat()
+    entry["local"] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+                      "etag": entry.get("etag"), "last_modified": entry.get("last_modified")}
+    entry.setdefault("size", stat.st_size)
+    entry.setdefault("fetched_at", time.time())
+    update_json_cache({url: entry}, _metadata_cache["path"], indent=2)
+
+# what we recorded about a local copy, if the file on disk is still the one we downloaded (else None)
+def _local_copy(url, destination):
+
+    entry = cached_metadata(url)
+    if entry is None or "local" not in entry or not Path(destination).exists():
+        return None
+
+    stat = Path(destination).stat()
+    local = entry["local"]
+    if [stat.st_size, stat.st_mtime_ns] != [local["size"], local["mtime_ns"]]:
+        return None
+    return local
+
+# does the remote metadata describe the same file as the local copy?
+def _same_as_local(local, remote):
+    if remote is None or remote.get("size") != local["size"]:
+        return False
+    if local.get("etag") or remote.get("etag"):
+        return remote.get("etag") == local.get("etag")
+    return bool(local.get("last_modified")) and remote.get("last_modified") == local.get("last_modified")
+
+# is the local copy still the same as the remote one? (False if we cannot tell)
+def unchanged_since_download(url, destination, timeout):
+    local = _local_copy(url, destination)
+    return local is not None and _same_as_local(local, remote_metadata(url, timeout))
+
 # check the content length of a file
 '''
 recall HTTP lingo:
@@ -57,24 +180,19 @@ recall HTTP lingo:
 '''
 def content_length(url, timeout):
 
-    # request the header
-    r = requests.head(url, timeout = timeout, allow_redirects=True)
-    if not (200 <= r.status_code < 300):
+    # request the header (or use the cached answer)
+    metadata = remote_metadata(url, timeout)
+    if metadata is None:
         return None
     
-    # get the content length
-    content_length = r.headers.get("content-length")
-    
-    # return
-    if content_length is None:
-        return None
-    else:
-        return int(content_length)
-    
-
+    # return the content length
+    return metadata.get("size")
 
 # download a file
 def download_file(url, destination, filename, timeout):
+
+    import requests
+    from tqdm import tqdm
     
     # note: I shouldn't pass in both the destination and the filename (redundant), fix later
     
@@ -104,6 +222,7 @@ def download_file(url, destination, filename, timeout):
                     bar.update(len(chunk))
 
     temp.rename(destination)
+    record_download(url, destination)
 
     return destination 
 
@@ -113,7 +232,8 @@ def download_files(base_url,
                    filenames, 
                    timeout = 60, 
                    max_size_GB = 5, 
-                   overwrite = False):
+                   overwrite = False,
+                   budget = None):
 
     # ensure destinations_dir is a Path object
     if not isinstance(destinations_dir, Path):
@@ -140,19 +260,34 @@ def download_files(base_url,
             # try next in list
             continue
 
+        # overwriting: only if the remote copy changed since we downloaded it
+        if overwrite and destination.exists():
+            if unchanged_since_download(url, destination, timeout):
+                print(f"[SKIP] {filename} unchanged on the server.")
+                downloaded.append(destination)
+                continue
+            destination.unlink()
+
         # avoid files that are too big
-        if max_size_B is not None:
+        size = None
+        if max_size_B is not None or budget is not None:
             # get size
             size = content_length(url, timeout)
             # if no return
             if size is None:
                 size = 0 # this would be suspicious, but keep going
             # if it's too big
-            if size > max_size_B:
+            if max_size_B is not None and size > max_size_B:
                 # try next in the list
                 print(f"[SKIP] {filename} would exceed {max_size_GB} GB.")
                 continue 
 
+        # wait for room under the disk budget, if there is one
+        if budget is not None:
+            if not disk_budget.admit(budget, f"download:{filename}", size, archive_name=filename):
+                print(f"[SKIP] {filename} does not fit in the disk budget.")
+                continue
+            
         # if you made it this far, try download
         try:
             downloaded_file = download_file(url, destination, filename, timeout)
@@ -160,14 +295,347 @@ def download_files(base_url,
             print(f"[DOWNLOAD] {filename} successful.")
         except Exception as e:
             print(f"[ERROR] {filename}: {e}")
+        finally:
+            disk_budget.release(budget, f"download:{filename}")
 
     return downloaded
-            
-             
 
+# *******************************
+# Async download engine
+# *******************************
+
+# global bandwidth limit, shared by every download in this process (threads and event loops)
+_bandwidth = {"lock": threading.Lock(), "next": 0.0}
+
+# reserve a slot for nbytes under the bandwidth limit, returns how long to wait for it
+def bandwidth_delay(nbytes, bandwidth_MBps):
+
+    if not bandwidth_MBps:
+        return 0.0
+
+    now = time.monotonic()
+    with _bandwidth["lock"]:
+        start = max(now, _bandwidth["next"])
+        _bandwidth["next"] = start + nbytes / (bandwidth_MBps * 1024 ** 2)
+
+    return start - now
+
+# remote_metadata for the event loop: the cache file (and its lock) is used off the loop, HEAD goes through the client
+async def _probe(client, url):
+
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    entry = await loop.run_in_executor(None, _fresh_metadata, url)
+    if entry is not None:
+        return entry
+
+    # offline: what the cache does not know stays unknown
+    if _metadata_cache["offline"]:
+        return None
+
+    entry = await loop.run_in_executor(None, cached_metadata, url)
+    r = await client.head(url, headers=_conditional_headers(entry))
+    return await loop.run_in_executor(None, _store_metadata, url, r.status_code, r.headers, entry)
+
+# stream one file to disk: chunks are written by the writer thread, at most `slots` chunks are in memory
+async def _fetch(client, url, destination, writer, slots, bandwidth_MBps, bar):
+
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    temp = destination.with_suffix(destination.suffix + ".part")
+    if temp.exists():
+        temp.unlink()
+
+    pending = []
+    async with client.stream("GET", url) as r:
+        r.raise_for_status()
+        f = await loop.run_in_executor(writer, open, temp, "wb")
+        try:
+            async for chunk in r.aiter_bytes(chunk_size=1024 * 1024):
+
+                # backpressure: wait for the writer to free a buffer slot
+                await slots.acquire()
+                write = loop.run_in_executor(writer, f.write, chunk)
+                write.add_done_callback(lambda _: slots.release())
+                pending.append(write)
+                bar.update(len(chunk))
+
+                delay = bandwidth_delay(len(chunk), bandwidth_MBps)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+        finally:
+            # the writer runs the jobs in order, so the file is complete once the last write is
+            await asyncio.gather(*pending, return_exceptions=True)
+            await loop.run_in_executor(writer, f.close)
+
+    # surface any write error
+    for write in pending:
+        write.result()
+
+    temp.rename(destination)
+    await loop.run_in_executor(None, record_download, url, destination)
+    return destination
+
+# what the downloads of one run share: one client, one writer thread, one buffer, one concurrency limit,
+# and the size probes (started up front, so they run concurrently)
+async def _open_session(base_url, destinations_dir, timeout, max_size_B, max_size_GB, overwrite, concurrency,
+                        buffer_MB, bandwidth_MBps, budget):
+
+    import asyncio
+    import httpx
+    from tqdm import tqdm
+    from concurrent.futures import ThreadPoolExecutor
+
+    limits = httpx.Limits(max_connections=concurrency)
+    return {
+        "base_url": base_url,
+        "destinations_dir": destinations_dir,
+        "timeout": timeout,
+        "max_size_B": max_size_B,
+        "max_size_GB": max_size_GB,
+        "overwrite": overwrite,
+        "bandwidth_MBps": bandwidth_MBps,
+        "budget": budget,
+        "client": httpx.AsyncClient(timeout=timeout, follow_redirects=True, limits=limits),
+        # one writer thread, so the event loop never blocks on disk
+        "writer": ThreadPoolExecutor(max_workers=1, thread_name_prefix="download-writer"),
+        "slots": asyncio.Semaphore(max(1, int(buffer_MB))),
+        "running": asyncio.Semaphore(concurrency),
+        "probes": {},
+        "bar": tqdm(total=0, unit="B", unit_scale=True, desc="download"),
+    }
+
+async def _close_session(session):
+    await session["client"].aclose()
+    session["writer"].shutdown(wait=True)
+    session["bar"].close()
+
+# the metadata probe of a file (started once per session, runs on the session's loop)
+def _start_probe(session, filename):
+
+    import asyncio
+
+    if filename not in session["probes"]:
+        url = f"{session['base_url']}/{filename}"
+        session["probes"][filename] = asyncio.ensure_future(_probe(session["client"], url))
+    return session["probes"][filename]
+
+# download one file within a session: the destination, or None if it was skipped
+async def _session_download(session, filename):
+
+    import asyncio
+
+    url = f"{session['base_url']}/{filename}"
+    destination = session["destinations_dir"] / filename
+
+    # avoid overwrite, if desired and if it exists
+    if not session["overwrite"] and destination.exists():
+        print(f"[SKIP] {filename} already present in {session['destinations_dir'].name}.")
+        return destination
+
+    # the remote size and validators (no answer is suspicious, but keep going)
+    try:
+        metadata = await _start_probe(session, filename)
+    except Exception:
+        metadata = None
+    size = None if metadata is None else metadata.get("size")
+
+    # overwriting: only if the remote copy changed since we downloaded it
+    if session["overwrite"] and destination.exists():
+        loop = asyncio.get_running_loop()
+        local = await loop.run_in_executor(None, _local_copy, url, destination)
+        if local is not None and _same_as_local(local, metadata):
+            print(f"[SKIP] {filename} unchanged on the server.")
+            return destination
+        destination.unlink()
+
+    # avoid files that are too big
+    if session["max_size_B"] is not None and (size or 0) > session["max_size_B"]:
+        print(f"[SKIP] {filename} would exceed {session['max_size_GB']} GB.")
+        return None
+
+    bar = session["bar"]
+    bar.total += size or 0
+    bar.refresh()
+
+    async with session["running"]:
+
+        # a file that appeared meanwhile counts as downloaded
+        if destination.exists():
+            return destination
+
+        # wait for room under the disk budget (admission blocks, so it runs off the loop)
+        budget = session["budget"]
+        key = f"download:{filename}"
+        loop = asyncio.get_running_loop()
+        if budget is not None and not await loop.run_in_executor(None, disk_budget.admit, budget, key, size, filename):
+            print(f"[SKIP] {filename} does not fit in the disk budget.")
+            return None
+        try:
+            result = await _fetch(session["client"], url, destination, session["writer"], session["slots"],
+                                  session["bandwidth_MBps"], bar)
+        finally:
+            await loop.run_in_executor(None, disk_budget.release, budget, key)
+
+    print(f"[DOWNLOAD] {filename} successful.")
+    return result
+
+# probe every file at once, then download the ones within budget (concurrency files at a time)
+async def _download_all(base_url, destinations_dir, filenames, timeout, max_size_B, max_size_GB,
+                        overwrite, concurrency, buffer_MB, bandwidth_MBps, budget):
+
+    import asyncio
+
+    session = await _open_session(base_url, destinations_dir, timeout, max_size_B, max_size_GB, overwrite,
+                                  concurrency, buffer_MB, bandwidth_MBps, budget)
+    try:
+        # size probes for every file that is not on disk, up front
+        for filename in filenames:
+            if not (destinations_dir / filename).exists():
+                _start_probe(session, filename)
+        results = await asyncio.gather(*(_session_download(session, f) for f in filenames), return_exceptions=True)
+    finally:
+        await _close_session(session)
+
+    downloaded = []
+    for filename, result in zip(filenames, results):
+        if isinstance(result, Exception):
+            print(f"[ERROR] {filename}: {result}")
+        elif result is not None:
+            downloaded.append(result)
+
+    return downloaded
+
+# download multiple files with asyncio (same dir, same GB budget [per file] and skips as download_files)
+def download_files_async(base_url,
+                         destinations_dir,
+                         filenames,
+                         timeout = 60,
+                         max_size_GB = 5,
+                         overwrite = False,
+                         concurrency = 4,
+                         buffer_MB = 64,
+                         bandwidth_MBps = None,
+                         budget = None):
+
+    '''
+    Needs httpx. buffer_MB bounds the downloaded chunks (1 MB each) waiting to be written,
+    bandwidth_MBps (None = no limit) is shared by every download in the process.
+    With a disk budget (src.utils.disk_budget), each file waits for room before it starts.
+    '''
+
+    import asyncio
+
+    # ensure destinations_dir is a Path object
+    if not isinstance(destinations_dir, Path):
+        destinations_dir = Path(destinations_dir)
+    destinations_dir.mkdir(parents = True, exist_ok = True)
+
+    # convert GB to B
+    max_size_B = int(max_size_GB * 1024 ** 3) if max_size_GB is not None else None
+
+    return asyncio.run(_download_all(base_url, destinations_dir, filenames, timeout, max_size_B, max_size_GB,
+                                     overwrite, int(concurrency), buffer_MB, bandwidth_MBps, budget))
+
+# *******************************
+# Shared download engine
+# *******************************
+
+# the async engine of a pipeline run (None when there is none), see start_engine
+_engine = {"loop": None, "thread": None, "session": None}
+
+# start one async engine for the whole run: an event loop on a background thread, with one session
+# (client, writer, buffer, concurrency), that every download_with_config call of the run feeds
+def start_engine(ingestion_cfg, base_url, destinations_dir, filenames, timeout=60, max_size_GB=5, overwrite=False,
+                 budget=None):
+
+    '''
+    The stage graph downloads one archive per stage; with the engine running, those
+    downloads share the concurrency limit, the write buffer and the bandwidth limit,
+    and the sizes of `filenames` (those not on disk yet) are probed at once, up front.
+    Only used with ingestion.download_engine "async". Stop it with stop_engine().
+    '''
+
+    import asyncio
+
+    if ingestion_cfg.get("download_engine", "sync") != "async" or _engine["loop"] is not None:
+        return None
+
+    if not isinstance(destinations_dir, Path):
+        destinations_dir = Path(destinations_dir)
+    destinations_dir.mkdir(parents = True, exist_ok = True)
+    max_size_B = int(max_size_GB * 1024 ** 3) if max_size_GB is not None else None
+
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, name="download-engine", daemon=True)
+    thread.start()
+
+    session = asyncio.run_coroutine_threadsafe(_open_session(
+        base_url, destinations_dir, timeout, max_size_B, max_size_GB, overwrite,
+        int(ingestion_cfg.get("download_concurrency", 4)),
+        ingestion_cfg.get("download_buffer_MB", 64),
+        ingestion_cfg.get("bandwidth_limit_MBps", None),
+        budget
+    ), loop).result()
+
+    # size probes for every archive that is not on disk yet, concurrently
+    for filename in filenames:
+        if not (destinations_dir / filename).exists():
+            loop.call_soon_threadsafe(_start_probe, session, filename)
+
+    _engine.update(loop=loop, thread=thread, session=session)
+    return _engine
+
+# download through the running engine (from any thread; blocks until the files are done)
+def engine_download(filenames):
+
+    import asyncio
+
+    downloaded = []
+    for filename, future in [(f, asyncio.run_coroutine_threadsafe(_session_download(_engine["session"], f), _engine["loop"]))
+                             for f in filenames]:
+        try:
+            result = future.result()
+        except Exception as e:
+            print(f"[ERROR] {filename}: {e}")
+            continue
+        if result is not None:
+            downloaded.append(result)
+
+    return downloaded
+
+# stop the engine of the run (if there is one)
+def stop_engine():
+
+    import asyncio
 
+    loop = _engine["loop"]
+    if loop is None:
+        return
 
+    asyncio.run_coroutine_threadsafe(_close_session(_engine["session"]), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    _engine["thread"].join()
+    loop.close()
+    _engine.update(loop=None, thread=None, session=None)
 
+# the download function the config asks for (ingestion.download_engine: "sync" or "async")
+def download_with_config(ingestion_cfg, base_url, destinations_dir, filenames, timeout=60, max_size_GB=5, overwrite=False,
+                         budget=None):
 
+    # a pipeline run with a running engine: the files join its downloads
+    if _engine["loop"] is not None:
+        return engine_download(filenames)
 
+    if ingestion_cfg.get("download_engine", "sync") != "async":
+        return download_files(base_url, destinations_dir, filenames, timeout=timeout,
+                              max_size_GB=max_size_GB, overwrite=overwrite, budget=budget)
 
+    return download_files_async(base_url, destinations_dir, filenames, timeout=timeout,
+                                max_size_GB=max_size_GB, overwrite=overwrite,
+                                concurrency=ingestion_cfg.get("download_concurrency", 4),
+                                buffer_MB=ingestion_cfg.get("download_buffer_MB", 64),
+                                bandwidth_MBps=ingestion_cfg.get("bandwidth_limit_MBps", None),
+                                budget=budget)
@@ -1,7 +1,12 @@
 # imports
 import subprocess
 import json
+import time
+import hashlib
+import threading
 from pathlib import Path
+from src.utils.file_operations import file_lock, write_atomic
+from src.utils import disk_budget
 
 # extract a single archive file
 def extract_file(source_path, output_dir, data_format="7z"):
@@ -133,8 +138,45 @@ def all_files_exist_for_archive(file_list, sampled_dir):
     print(f"all files exist in {sampled_dir.name}")
     return True
 
+# the planned files that are not extracted yet (the delta a changed plan needs)
+def missing_files(file_list, sampled_dir):
+    return [f for f in file_list if not (Path(sampled_dir) / f).exists()]
+
+# archives may be extracted concurrently, so serialise ledger updates
+_ledger_lock = threading.Lock()
+
+# load the extraction ledger (archive name -> what was extracted, and when)
+def load_ledger(ledger_path):
+    ledger_path = Path(ledger_path)
+    if not ledger_path.exists():
+        return {}
+    return json.loads(ledger_path.read_text())
+
+# hash of a file list (the ledger records it, so a changed plan shows up)
+def plan_hash(file_list):
+    return hashlib.sha256(json.dumps(sorted(file_list)).encode()).hexdigest()
+
+# record a completed extraction in the ledger
+def record_extraction(ledger_path, archive_name, file_list):
+
+    ledger_path = Path(ledger_path)
+
+    with _ledger_lock, file_lock(ledger_path):
+        ledger = load_ledger(ledger_path)
+
+        ledger[archive_name] = {
+            "files": len(file_list),
+            "plan_hash": plan_hash(file_list),
+            "extracted_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+
+        write_atomic(ledger_path, json.dumps(ledger, indent=2))
+
+    return ledger[archive_name]
+
 # extract all files specified in sampling plan
-def extract_from_sample_plan(sample_plan_file, raw_dir, sampled_dir, overwrite=False, cleanup_raw = False):
+def extract_from_sample_plan(sample_plan_file, raw_dir, sampled_dir, overwrite=False, cleanup_raw = False, ledger_path=None,
+                             budget=None):
     
     # ensure Path types
     if not isinstance(sample_plan_file, Path):
@@ -162,7 +204,7 @@ def extract_from_sample_plan(sample_plan_file, raw_dir, sampled_dir, overwrite=F
         archive_path = raw_dir / archive_name
         
         print(f"\n{archive_name}:")
-        print(f"  Files to extract: {len(file_list)}")
+        print(f"  Files in plan: {len(file_list)}")
 
         # check if all files already exist in the archive
         if not overwrite and all_files_exist_for_archive(file_list=file_list, sampled_dir=sampled_dir):
@@ -174,9 +216,25 @@ def extract_from_sample_plan(sample_plan_file, raw_dir, sampled_dir, overwrite=F
                 "errors": 0
             })
             total_skipped += len(file_list)
+            if ledger_path is not None:
+                record_extraction(ledger_path, archive_name, file_list)
             continue        
+        # wait for room under the disk budget, if there is one
+        if budget is not None:
+            need = disk_budget.extraction_bytes(budget, archive_path, file_list, sampled_dir)
+            if not disk_budget.admit(budget, f"extract:{archive_name}", need, archive_name=archive_name):
+                print(f"  [SKIP] {archive_name} does not fit in the disk budget")
+                results.append({"archive": archive_name, "extracted": 0, "skipped": 0, "errors": 1,
+                                "error_msg": "over the disk budget"})
+                total_errors += 1
+                continue
+
+        # only the files that are not there yet (e.g. those a bigger budget added)
+        to_extract = file_list if overwrite else missing_files(file_list, sampled_dir)
+        print(f"  Files to extract: {len(to_extract)}")
+
         try:
-            result = extract_selected(archive_path, file_list, sampled_dir, overwrite=overwrite)
+            result = extract_selected(archive_path, to_extract, sampled_dir, overwrite=overwrite)
             results.append(result)
             total_extracted += result["extracted"]
             total_skipped += result.get("skipped", 0)
@@ -187,6 +245,9 @@ def extract_from_sample_plan(sample_plan_file, raw_dir, sampled_dir, overwrite=F
                 if result.get("skipped", 0) > 0:
                     msg += f", skipped {result['skipped']} (already exist)"
                 print(f"  {msg}")
+
+                if ledger_path is not None:
+                    record_extraction(ledger_path, archive_name, file_list)
             
                 if cleanup_raw:            
                     try:
@@ -208,6 +269,8 @@ def extract_from_sample_plan(sample_plan_file, raw_dir, sampled_dir, overwrite=F
                 "error_msg": str(e)
             })
             total_errors += 1
+        finally:
+            disk_budget.release(budget, f"extract:{archive_name}")
     
     # summary
     print(f"\n{'='*50}")
@@ -1,104 +1,264 @@
-# imports
-import pandas as pd
+# imports (pandas is imported inside the functions that use it, to keep startup fast)
+import os
+import heapq
+import itertools
 from pathlib import Path
-from src.utils.file_operations import get_agent_ids, find_imgs
+from concurrent.futures import ThreadPoolExecutor
+from src.utils.file_operations import get_agent_ids, find_imgs, load_json_cache, update_json_cache
 
 # configs
 sort_order = ["data_name", "agent_id", "frame_id", "camera", "image_path"]
+columns = ["data_name", "prefix", "weather", "density", "agent_id", "frame_id", "camera", "image_path"]
+
+# rows are tuples in `columns` order; this sorts them like sort_values(sort_order) (missing values last)
+_sort_positions = [columns.index(c) for c in sort_order]
+
+def _row_key(row):
+    return tuple((row[i] is None, row[i] if row[i] is not None else 0) for i in _sort_positions)
+
+# expecting PREFIX_WEATHER_DENSITY
+def parse_data_name(data_name):
 
-# build an index from one source
-def build_index(data_dir, camera=None, ext='.png', limit=8):
-    
-    # turn dir into a proper path
-    data_path = Path(data_dir)
-    
-    # pull folder name
-    data_name = data_path.name
-    
-    # expecting PREFIX_WEATHER_DENSITY
     data_name_parts = data_name.split("_")
 
     try:
-        prefix, weather, density = data_name_parts[0], data_name_parts[1], data_name_parts[2]
+        return data_name_parts[0], data_name_parts[1], data_name_parts[2]
     except Exception as e:
         print(f"Failed to parse directory name: {data_name}\n{e}\nExpecting format PREFIX_WEATHER_DENSITY")
-        return
-    
-    # get the agent ids
-    agent_ids = get_agent_ids(data_dir, include_negative=True)
+        return None
+
+# index the images of one agent, as sorted rows
+def index_agent(data_path, agent_id, camera=None, ext='.png', limit=8, use_cache=False):
+
+    data_name = data_path.name
+    prefix, weather, density = parse_data_name(data_name)
+
+    # find the images for that agent id
+    imgs = find_imgs(data_path / agent_id, camera=camera, ext=ext, limit=limit, use_cache=use_cache, as_paths=False)
 
-    # initialize rows
+    # parse image metadata (assuming format FRAMEID_CAMERAID.png)
     rows = []
+    for img in imgs:
 
-    # iterate through the agent ids 
-    for agent_id in agent_ids:
+        # pull filename sans extension
+        img_name_parts = os.path.splitext(os.path.basename(img))[0].split("_")
 
-        # find the images for that agent id
-        agent_dir = data_path / agent_id
-        imgs = find_imgs(agent_dir, camera=camera, ext=ext, limit=limit)
+        # pull frame id
+        frame_id = int(img_name_parts[0]) if img_name_parts and img_name_parts[0].isdigit() else None
 
-        # parse image metadata (assuming format FRAMEID_CAMERAID.png)
-        for img in imgs:
+        # pull camera id (guard against unexpected names like "camera_01")
+        camera_parts = [p for p in img_name_parts[1:] if p.lower().startswith("camera")]
+        camera_id = "_".join(camera_parts) if camera_parts else None
 
-            # pull filename sans extension
-            img_name_parts = img.stem.split("_")
+        rows.append((data_name, prefix, weather, density, int(agent_id), frame_id, camera_id, img))
 
-            # pull frame id                           
-            frame_id = int(img_name_parts[0]) if img_name_parts and img_name_parts[0].isdigit() else None
+    rows.sort(key=_row_key)
+    return rows
 
-            # pull camera id (guard against unexpected names like "camera_01")
-            camera_parts = [p for p in img_name_parts[1:] if p.lower().startswith("camera")]
-            camera_id = "_".join(camera_parts) if camera_parts else None
+# index one agent, or reuse its snapshot if the agent directory has not changed since
+def _index_agent_cached(data_path, agent_id, camera, ext, limit, use_cache, snapshot):
 
-            rows.append({
-                "data_name": data_name,
-                "prefix": prefix,
-                "weather": weather,
-                "density": density,
-                "agent_id": int(agent_id),
-                "frame_id": frame_id,
-                "camera": camera_id,
-                "image_path": str(img),
-            })
+    agent_dir = data_path / agent_id
+    params = [camera, ext, limit]
+    mtime_ns = os.stat(agent_dir).st_mtime_ns
 
-    df = pd.DataFrame(rows)
+    entry = snapshot.get(str(agent_dir))
+    if entry is not None and entry["mtime_ns"] == mtime_ns and entry["params"] == params:
+        return [tuple(row) for row in entry["rows"]], None
 
-    # sort the rows (if they are not empty)
-    if not df.empty:
-        df = df.sort_values(sort_order).reset_index(drop=True)
+    rows = index_agent(data_path, agent_id, camera=camera, ext=ext, limit=limit, use_cache=use_cache)
+    return rows, {"mtime_ns": mtime_ns, "params": params, "rows": rows}
 
-    return df
+# index every agent of every directory in parallel: one sorted partition per agent
+def index_partitions(data_dirs, camera=None, ext='.png', limit=8, use_cache=False, workers=8, snapshot_path=None):
+
+    # the agents to index (directories that do not parse are skipped)
+    jobs = []
+    for data_dir in data_dirs:
+        data_path = Path(data_dir)
+        if parse_data_name(data_path.name) is None:
+            continue
+        for agent_id in get_agent_ids(data_path, include_negative=True):
+            jobs.append((data_path, agent_id))
+
+    snapshot = load_json_cache(snapshot_path)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(lambda job: _index_agent_cached(*job, camera, ext, limit, use_cache, snapshot), jobs))
+
+    # remember the agents that were (re)indexed
+    updates = {str(data_path / agent_id): entry for (data_path, agent_id), (_, entry) in zip(jobs, results) if entry is not None}
+    if snapshot_path is not None and updates:
+        update_json_cache(updates, snapshot_path)
+        print(f"[INDEX] re-indexed {len(updates)} of {len(jobs)} agent directories")
+
+    return [rows for rows, _ in results]
+
+# k-way merge of sorted partitions (no global re-sort); partitions that do not overlap,
+# e.g. one per agent, only need to be put in order
+def merge_partitions(partitions):
+
+    partitions = sorted((rows for rows in partitions if rows), key=lambda rows: _row_key(rows[0]))
+    bounds = [(_row_key(rows[0]), _row_key(rows[-1])) for rows in partitions]
+    if all(bounds[i][1] <= bounds[i + 1][0] for i in range(len(bounds) - 1)):
+        return itertools.chain.from_iterable(partitions)
+    return heapq.merge(*partitions, key=_row_key)
+
+# rows as columnar batches ({column: [values]}, at most batch_size rows each)
+def _to_batches(rows, names, batch_size):
+
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield dict(zip(names, map(list, zip(*batch))))
+            batch = []
+    if batch:
+        yield dict(zip(names, map(list, zip(*batch))))
+
+# the sorted index as columnar batches
+def iter_index_batches(data_dirs, camera=None, ext='.png', limit=8, use_cache=False, workers=8,
+                       snapshot_path=None, batch_size=65536):
+
+    partitions = index_partitions(data_dirs, camera=camera, ext=ext, limit=limit, use_cache=use_cache,
+                                  workers=workers, snapshot_path=snapshot_path)
+
+    yield from _to_batches(merge_partitions(partitions), columns, batch_size)
+
+# one DataFrame from columnar batches
+def _batches_to_df(batches, names=columns):
+
+    import pandas as pd
+
+    data = {c: [] for c in names}
+    for batch in batches:
+        for c in names:
+            data[c].extend(batch[c])
+
+    if not data["image_path"]:
+        return pd.DataFrame()
+    return pd.DataFrame(data)
+
+# build an index from one source
+def build_index(data_dir, camera=None, ext='.png', limit=8, use_cache=False, workers=8, snapshot_path=None):
+
+    # expecting PREFIX_WEATHER_DENSITY
+    if parse_data_name(Path(data_dir).name) is None:
+        return
+
+    return _batches_to_df(iter_index_batches([data_dir], camera=camera, ext=ext, limit=limit, use_cache=use_cache,
+                                             workers=workers, snapshot_path=snapshot_path))
 
 # build an index from multiple sources
-def build_index_multi(data_dirs, camera=None, ext='.png', limit=8):
-    
-    # initialize index dataframe(s)
-    index = []
+def build_index_multi(data_dirs, camera=None, ext='.png', limit=8, use_cache=False, workers=8, snapshot_path=None):
 
-    # iterate through directories 
-    for data_dir in data_dirs:
-        
-        # build a dataframe (subindex)
-        subindex = build_index(data_dir, camera=camera, ext=ext, limit=limit)
-
-        # append (if there is something to append)
-        if subindex is not None and not subindex.empty:
-            index.append(subindex)
-
-    # if everything is empty 
-    if not index:
-        # return an empty dataframe
-        return pd.DataFrame() 
-    
-    else:
-        # combine the indices into one big dataframe
-        index_concat = pd.concat(index, ignore_index=True)
+    '''
+    Agents are indexed in parallel (workers threads) and their sorted rows are merged, so the
+    result is already in sort_order. With snapshot_path, agents whose directory mtime is unchanged
+    since the last run are taken from the snapshot instead of being listed again.
+    '''
+
+    return _batches_to_df(iter_index_batches(data_dirs, camera=camera, ext=ext, limit=limit, use_cache=use_cache,
+                                             workers=workers, snapshot_path=snapshot_path))
+
+# *******************************
+# Index from manifests
+# *******************************
+
+# the same columns, plus the modality of each image (camera, semantic, ...)
+manifest_columns = columns + ["modality"]
+
+# split "000060_semantic0" into (frame id, camera, modality): the sensor number is kept as cameraN,
+# so the modalities of one camera line up
+def parse_image_name(stem):
+
+    img_name_parts = stem.split("_")
+
+    # pull frame id
+    frame_id = int(img_name_parts[0]) if img_name_parts and img_name_parts[0].isdigit() else None
+
+    # pull camera id (guard against unexpected names like "camera_01")
+    camera_parts = [p for p in img_name_parts[1:] if p.lower().startswith("camera")]
+    if camera_parts:
+        return frame_id, "_".join(camera_parts), "camera"
+
+    # other modalities: semantic0 -> camera0, semantic
+    sensor = img_name_parts[1] if len(img_name_parts) > 1 else ""
+    modality = sensor.rstrip("0123456789")
+    number = sensor[len(modality):]
+    return frame_id, (f"camera{number}" if number else None), (modality or None)
+
+# index the images listed in one manifest, one sorted partition per agent
+def index_manifest(manifest, data_name, camera=None, ext='.png', limit=8, modalities=None, image_root=None):
+
+    '''
+    manifest is what archive.build_manifest saved (simple or verbose). camera filters on the
+    image name like find_imgs, modalities (e.g. ["camera", "semantic"]) keeps only those
+    (None = every modality), and limit applies per agent, in path order. image_path is the
+    member path, under image_root if given (e.g. where the archive would be extracted).
+    '''
+
+    parsed = parse_data_name(data_name)
+    if parsed is None:
+        return []
+    prefix, weather, density = parsed
+
+    # member paths, grouped by agent: {data_name}/{agent_id}/.../{name}{ext}
+    agents = {}
+    for entry in manifest:
+        member = entry["Path"] if isinstance(entry, dict) else entry
+        parts = member.replace("\\", "/").split("/")
+        if len(parts) < 3 or parts[0] != data_name or not parts[1].lstrip("-").isdigit():
+            continue
+        name = parts[-1]
+        if not name.endswith(ext) or (camera is not None and camera not in name[:len(name) - len(ext)]):
+            continue
+        agents.setdefault(parts[1], []).append(parts)
+
+    partitions = []
+    for agent_id, members in agents.items():
+
+        rows = []
+        for parts in sorted(members):
+
+            frame_id, camera_id, modality = parse_image_name(parts[-1][:len(parts[-1]) - len(ext)])
+            if modalities is not None and modality not in modalities:
+                continue
+
+            member = "/".join(parts)
+            image_path = member if image_root is None else str(Path(image_root) / member)
+            rows.append((data_name, prefix, weather, density, int(agent_id), frame_id, camera_id, image_path, modality))
+
+            if limit is not None and len(rows) == limit:
+                break
+
+        rows.sort(key=_row_key)
+        partitions.append(rows)
+
+    return partitions
+
+# the manifests in an index directory ({name}_manifest.json)
+def find_manifests(index_dir):
+    return sorted(Path(index_dir).glob("*_manifest.json"))
+
+# build an index straight from archive manifests, without extracting anything
+def build_index_from_manifests(manifest_paths, camera=None, ext='.png', limit=8, modalities=None,
+                               image_root=None, workers=8):
+
+    import json
+
+    def load(manifest_path):
+        manifest_path = Path(manifest_path)
+        data_name = manifest_path.name[:-len("_manifest.json")]
+        manifest = json.loads(manifest_path.read_text())
+        return index_manifest(manifest, data_name, camera=camera, ext=ext, limit=limit,
+                              modalities=modalities, image_root=image_root)
 
-        # sort
-        index_concat = index_concat.sort_values(sort_order).reset_index(drop=True)
+    # manifests are read and parsed in parallel, their agents merged in order
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        partitions = [rows for result in pool.map(load, manifest_paths) for rows in result]
 
-        # return the concatenated dataframe
-        return index_concat
+    return _batches_to_df(_to_batches(merge_partitions(partitions), manifest_columns, 65536), manifest_columns)
 
 # save index to file
 def save_index(df, dir_out, filename, ext='.csv'):
@@ -1,6 +1,8 @@
+# imports (pandas is imported inside the functions that use it, to keep startup fast)
 import json
 from pathlib import Path
-import pandas as pd
+from src.utils.file_operations import scan_image_headers
+from src.ingestion.sample import frame_group_id, paired_member
 
 # extract weather/vis/time labels from archive details
 def extract_archive_labels(archive_name, decode_time, decode_vis, archive_ext):
@@ -60,13 +62,116 @@ def extract_img_metadata(img_path):
 
     return details
 
+# the label columns holding the paths of the other modalities ("semantic" -> "semantic_path")
+def modality_columns(modalities):
+    return {m: f"{m}_path" for m in (modalities or []) if m != "camera"}
+
+# label rows for the images of one extracted archive directory
+def build_archive_label_rows(archive_dir, sampled_dir, decode_time, decode_vis, archive_ext, img_ext, invalid=None,
+                             modalities=None, modality_patterns=None):
+
+    '''
+    With modalities (e.g. ["camera", "semantic"]) there is one row per camera image, with
+    the path of its aligned member in each other modality (e.g. semantic_path).
+    '''
+
+    # pull the archive name
+    archive_name = archive_dir.name
+
+    # extract archive-level labels
+    archive_labels = extract_archive_labels(
+        archive_name=archive_name,
+        decode_time=decode_time,
+        decode_vis=decode_vis,
+        archive_ext=archive_ext
+    )
+
+    # if we don't get valid labels, skip
+    if not archive_labels:
+        print(f"[SKIP] cannot extract labels from {archive_name}")
+        return []
+
+    paired_columns = modality_columns(modalities)
+
+    # find all images in this archive (recursively)
+    rows = []
+    for img_file in archive_dir.rglob(f"*{img_ext}"):
+
+        # the other modalities are columns of their camera image's row
+        if paired_columns and "_camera" not in img_file.name:
+            continue
+
+        # initial row with archive labels
+        row = {}
+
+        # store archive and image name
+        row["archive_name"] = archive_name
+        #row["image_path"] = str(img_file)
+        rel_path = img_file.relative_to(sampled_dir)
+        row["image_path"] = str(rel_path)  
+
+        # extract image-level metadata
+        img_metadata = extract_img_metadata(img_file)
+
+        # add labels and metadata 
+        row.update(archive_labels)
+        row.update(img_metadata)
+
+        # the synchronized frame (all agents and cameras) this view belongs to
+        row["group_id"] = frame_group_id(row["image_path"])
+
+        # the aligned members of the other modalities (None if not extracted)
+        for modality, column in paired_columns.items():
+            member = paired_member(row["image_path"], modality, img_ext, modality_patterns)
+            row[column] = member if (sampled_dir / member).exists() else None
+
+        # flag images that failed validation (a sample is only valid if all of its modalities are)
+        if invalid is not None:
+            row["valid"] = all(row[c] not in invalid for c in ["image_path", *paired_columns.values()] if row[c] is not None)
+
+        # append to rows
+        rows.append(row)
+
+    return rows
+
+# creates a dataframe with labels and metadata for one archive (used when archives are streamed)
+def build_archive_labels_df(archive_dir, sampled_dir, decode_time, decode_vis, archive_ext, img_ext, invalid=None,
+                            modalities=None, modality_patterns=None):
+
+    import pandas as pd
+
+    # enforce Path types
+    if not isinstance(archive_dir, Path):
+        archive_dir = Path(archive_dir)
+    if not isinstance(sampled_dir, Path):
+        sampled_dir = Path(sampled_dir)
+
+    if not archive_dir.is_dir():
+        return pd.DataFrame()
+
+    rows = build_archive_label_rows(archive_dir, sampled_dir, decode_time, decode_vis, archive_ext, img_ext, invalid,
+                                    modalities, modality_patterns)
+    return pd.DataFrame(rows)
+
 # creates a dataframe with labels and metadata 
-def build_labels_df(sampled_dir, decode_time, decode_vis, archive_ext, img_ext):
+def build_labels_df(sampled_dir, decode_time, decode_vis, archive_ext, img_ext, invalid=None, modalities=None,
+                    archives=None, modality_patterns=None):
+
+    '''
+    invalid: optional collection of relative image paths that failed validation,
+             these are kept in the labels but flagged with valid=False
+    archives: optional archive filenames to label (default: every archive directory)
+    '''
+
+    import pandas as pd
 
     # enforce Path type
     if not isinstance(sampled_dir, Path):
         sampled_dir = Path(sampled_dir)
     
+    # only the directories of the chosen archives
+    stems = None if archives is None else {Path(a).stem for a in archives}
+
     # group by archive
     rows = []
     for archive_dir in sorted(sampled_dir.iterdir()):
@@ -75,47 +180,61 @@ def build_labels_df(sampled_dir, decode_time, decode_vis, archive_ext, img_ext):
         if not archive_dir.is_dir():
             print(f"[SKIP] {archive_dir.name} is not a directory")
             continue
+        if stems is not None and archive_dir.name not in stems:
+            continue
+
+        rows.extend(build_archive_label_rows(archive_dir, sampled_dir, decode_time, decode_vis, archive_ext, img_ext, invalid,
+                                             modalities, modality_patterns))
+
+    # build and return dataframe
+    return pd.DataFrame(rows) 
 
-        # pull the archive name
-        archive_name = archive_dir.name
+# add image header columns (width, height, bit depth, color type) to the labels
+def add_image_headers(df, sampled_dir, workers=8, cache_path=None):
 
-        # extract archive-level labels
-        archive_labels = extract_archive_labels(
-            archive_name=archive_name,
-            decode_time=decode_time,
-            decode_vis=decode_vis,
-            archive_ext=archive_ext
-        )
+    # enforce Path type
+    if not isinstance(sampled_dir, Path):
+        sampled_dir = Path(sampled_dir)
 
-        # if we don't get valid labels, skip
-        if not archive_labels:
-            print(f"[SKIP] cannot extract labels from {archive_name}")
-            continue
+    # nothing to scan
+    if df.empty:
+        return df
 
-        # find all images in this archive (recursively)
-        for img_file in archive_dir.rglob(f"*{img_ext}"):
+    # scan headers (cached per file fingerprint)
+    img_paths = [str(sampled_dir / p) for p in df["image_path"]]
+    headers = scan_image_headers(img_paths, workers=workers, cache_path=cache_path)
 
-            # initial row with archive labels
-            row = {}
+    # write header fields into columns
+    for column in ["width", "height", "bit_depth", "color_type"]:
+        df[column] = [
+            headers[p][column] if headers.get(p) is not None else None
+            for p in img_paths
+        ]
 
-            # store archive and image name
-            row["archive_name"] = archive_name
-            #row["image_path"] = str(img_file)
-            rel_path = img_file.relative_to(sampled_dir)
-            row["image_path"] = str(rel_path)  
+    print(f"[SCAN] Read image headers for {len(img_paths)} images")
 
-            # extract image-level metadata
-            img_metadata = extract_img_metadata(img_file)
+    return df
 
-            # add labels and metadata 
-            row.update(archive_labels)
-            row.update(img_metadata)
+# combine per-archive label files into one dataframe
+def merge_label_files(label_paths):
 
-            # append to rows
-            rows.append(row)
+    import pandas as pd
 
-    # build and return dataframe
-    return pd.DataFrame(rows) 
+    frames = []
+    for label_path in label_paths:
+        label_path = Path(label_path)
+        if not label_path.exists():
+            continue
+        try:
+            frames.append(pd.read_csv(label_path, dtype={"frame_id": str}))
+        except pd.errors.EmptyDataError:
+            # an archive with no images leaves an empty file
+            continue
+
+    if not frames:
+        return pd.DataFrame()
+
+    return pd.concat(frames, ignore_index=True)
 
 def save_labels(df, output_path):
 
@@ -1,10 +1,14 @@
-import random
 import json
+import heapq
+import hashlib
 from pathlib import Path
 
 # filter images from manifest
 def filter_manifest(files, camera=None, img_ext='.png', stride=1):
 
+    # verbose manifests hold full records, we only need the paths
+    files = [f["Path"] if isinstance(f, dict) else f for f in files]
+
     # filter by extension
     candidates = [f for f in files if f.endswith(img_ext)] 
 
@@ -19,17 +23,352 @@ def filter_manifest(files, camera=None, img_ext='.png', stride=1):
     # apply the stride
     return candidates[::stride]
 
+# a seeded pseudo-random priority for a path (or group/clip id); the lowest priorities are sampled first,
+# so a bigger budget always keeps what a smaller one picked, whatever order the archives come in
+def sample_priority(key, seed):
+    return int.from_bytes(hashlib.blake2b(f"{seed}:{key}".encode(), digest_size=8).digest(), "big")
+
 # randomly k sample(s) from manifest
 def sample_manifest(files, k, seed):
 
-    rnd = random.Random(seed)
-    
     # if fewer than k files, return all
     if len(files) <= k:
         return files
     
-    # otherwise sample k files
-    return rnd.sample(files, k)
+    # otherwise the k files with the lowest priority
+    return heapq.nsmallest(k, files, key=lambda f: sample_priority(f, seed))
+
+# *******************************
+# Frame groups
+# *******************************
+
+# the synchronized frame an image belongs to: "rcnj_cn_s/1011/000060_camera0.png" -> "rcnj_cn_s:000060"
+def frame_group_id(img_path):
+
+    parts = str(img_path).replace("\\", "/").split("/")
+    frame_id = parts[-1].split("_")[0]
+    return f"{parts[0]}:{frame_id}" if len(parts) > 1 else frame_id
+
+# group the images of a manifest by synchronized frame: {group id: [every agent/camera view]}
+def build_frame_groups(files, img_ext='.png'):
+
+    groups = {}
+    for f in files:
+        f = f["Path"] if isinstance(f, dict) else f
+        if f.endswith(img_ext):
+            groups.setdefault(frame_group_id(f), []).append(f)
+
+    return {group: sorted(members) for group, members in sorted(groups.items())}
+
+# the frame groups of a manifest, precomputed next to it ({stem}_groups.json) and rebuilt if the manifest is newer
+def load_frame_groups(manifest_path, img_ext='.png', manifest=None):
+
+    manifest_path = Path(manifest_path)
+    groups_path = manifest_path.with_name(manifest_path.name.replace("_manifest.json", "_groups.json"))
+
+    if groups_path.exists() and groups_path.stat().st_mtime >= manifest_path.stat().st_mtime:
+        cached = json.loads(groups_path.read_text())
+        if cached.get("img_ext") == img_ext:
+            return cached["groups"]
+
+    if manifest is None:
+        manifest = json.loads(manifest_path.read_text())
+    groups = build_frame_groups(manifest, img_ext=img_ext)
+
+    groups_path.write_text(json.dumps({"img_ext": img_ext, "groups": groups}))
+    print(f"[SAVE] {len(groups)} frame groups saved to {groups_path.name}")
+
+    return groups
+
+# randomly sample whole frame groups, up to k images in total
+def sample_groups(groups, k, seed, camera=None, stride=1):
+
+    '''
+    groups maps a group id to its member paths (see build_frame_groups). Members are
+    filtered by camera like filter_manifest, the stride applies to frames, and groups
+    are taken whole until the next one would go over k (at least one group is taken).
+    Returns the member paths, group by group, and the number of candidate groups.
+    '''
+
+    # keep the camera views of each frame (same filter as filter_manifest)
+    candidates = []
+    for group, members in sorted(groups.items())[::stride]:
+        members = [f for f in members if (camera in f if camera is not None else 'camera' in f)]
+        if members:
+            candidates.append((group, members))
+
+    # groups in priority order, so a bigger k only adds groups
+    candidates.sort(key=lambda candidate: sample_priority(candidate[0], seed))
+
+    sampled = []
+    for group, members in candidates:
+        if sampled and len(sampled) + len(members) > k:
+            break
+        sampled.extend(members)
+
+    return sampled, len(candidates)
+
+# *******************************
+# Modalities
+# *******************************
+
+# member names of the other sensors, relative to the agent directory: {frame} is the frame id, {n} the
+# camera number (for per-camera sensors) and {ext} the image extension; a name without {frame} is a
+# per-agent file shared by every frame. Other modalities are per-camera images ("{frame}_{modality}{n}{ext}").
+MODALITY_PATTERNS = {
+    "lidar": "{frame}_lidar.ply",
+    "metadata": "{frame}.yaml",
+}
+
+# the member name pattern of a modality (configured patterns first, then the built-in ones)
+def modality_pattern(modality, patterns=None):
+    return {**MODALITY_PATTERNS, **(patterns or {})}.get(modality, "{frame}_" + modality + "{n}{ext}")
+
+# the member of another modality aligned with a camera image: ".../000060_camera0.png" -> ".../000060_semantic0.png"
+def paired_member(img_path, modality, img_ext='.png', patterns=None):
+
+    head, _, name = img_path.replace("\\", "/").rpartition("/")
+    frame_id, _, sensor = name[:len(name) - len(img_ext)].partition("_")
+    number = sensor[len(sensor.rstrip("0123456789")):]
+    member = modality_pattern(modality, patterns).format(frame=frame_id, n=number, ext=img_ext)
+    return f"{head}/{member}" if head else member
+
+# the camera images whose members in every other modality (same agent, frame and sensor number)
+# are in the manifest: {camera image: {modality: member}}
+def pair_modalities(files, modalities, img_ext='.png', patterns=None):
+
+    '''
+    Raises ValueError for a modality that none of the camera images has a member of
+    (a typo, or a sensor whose member names need an ingestion.modality_patterns entry).
+    '''
+
+    others = [m for m in modalities if m != "camera"]
+    members = {f["Path"] if isinstance(f, dict) else f for f in files}
+
+    pairs = {}
+    found = dict.fromkeys(others, False)
+    for f in members:
+        if not f.endswith(img_ext) or "_camera" not in f.rsplit("/", 1)[-1]:
+            continue
+        paired = {m: paired_member(f, m, img_ext, patterns) for m in others}
+        present = {m: p in members for m, p in paired.items()}
+        found.update({m: True for m, ok in present.items() if ok})
+        if all(present.values()):
+            pairs[f] = paired
+
+    # a modality that matches nothing would silently empty the plan
+    cameras = any(f.endswith(img_ext) and "_camera" in f.rsplit("/", 1)[-1] for f in members)
+    missing = [m for m, ok in found.items() if not ok]
+    if cameras and missing:
+        raise ValueError(f"No member matches modality {', '.join(repr(m) for m in missing)} "
+                         f"(expected e.g. {', '.join(repr(modality_pattern(m, patterns)) for m in missing)})")
+
+    return pairs
+
+# the camera images of a plan followed by their paired members, so one archive pass extracts every modality
+# (a per-agent member shared by several images is listed once)
+def expand_pairs(sampled, pairs):
+    return list(dict.fromkeys(member for f in sampled for member in (f, *pairs[f].values())))
+
+# *******************************
+# Temporal clips
+# *******************************
+
+# the images of a manifest as streams (one per archive/agent/camera), sorted by frame within each stream
+def build_stream_index(files, camera=None, img_ext='.png'):
+
+    '''
+    Returns {"paths", "stream", "frame"} arrays sorted by (stream, frame), and "streams",
+    the "{archive}/{agent_id}/{camera}" key of each stream code. Images are filtered by
+    camera like filter_manifest.
+    '''
+
+    import numpy as np
+
+    paths, streams, frames = [], [], []
+    for f in files:
+        f = f["Path"] if isinstance(f, dict) else f
+        if not f.endswith(img_ext) or (camera is not None and camera not in f) or (camera is None and 'camera' not in f):
+            continue
+
+        # {archive}/{agent_id}/{frame_id}_{camera}{img_ext}
+        parts = f.replace("\\", "/").split("/")
+        frame_id, _, camera_id = parts[-1][:len(parts[-1]) - len(img_ext)].partition("_")
+        if len(parts) < 3 or not frame_id.isdigit():
+            continue
+
+        paths.append(f)
+        streams.append(f"{parts[0]}/{parts[1]}/{camera_id}")
+        frames.append(int(frame_id))
+
+    stream_keys, stream_codes = np.unique(np.array(streams, dtype=str), return_inverse=True)
+    frames = np.array(frames, dtype=np.int64)
+    order = np.lexsort((frames, stream_codes))
+
+    return {
+        "paths": np.array(paths, dtype=object)[order],
+        "stream": stream_codes[order],
+        "frame": frames[order],
+        "streams": stream_keys,
+    }
+
+# fixed-length clips of consecutive (strided) frames from each stream
+def build_clips(stream_index, clip_len, stride=1, overlap=0):
+
+    '''
+    Within each stream, frames are taken every `stride` frame steps (the smallest frame
+    gap in that stream), and a clip is clip_len of them with no frame missing in between.
+    Consecutive clips share `overlap` frames. Returns one dict per clip, in stream order.
+    '''
+
+    import numpy as np
+
+    if clip_len < 1 or not 0 <= overlap < clip_len:
+        raise ValueError(f"Invalid clip settings: clip_len={clip_len}, overlap={overlap}")
+    hop = clip_len - overlap
+
+    stream = stream_index["stream"]
+    bounds = np.flatnonzero(np.diff(stream)) + 1
+    starts = np.concatenate(([0], bounds))
+    ends = np.concatenate((bounds, [len(stream)]))
+
+    clips = []
+    for start, end in zip(starts, ends):
+        if end - start < clip_len:
+            continue
+
+        # keep the frames on this stream's stride grid
+        frames = stream_index["frame"][start:end]
+        gaps = np.diff(frames)
+        step = int(gaps[gaps > 0].min()) * stride if (gaps > 0).any() else stride
+        keep = (frames - frames[0]) % step == 0
+        frames = frames[keep]
+        paths = stream_index["paths"][start:end][keep]
+
+        # a window is a clip if none of its clip_len - 1 gaps is longer than one step
+        ok = np.concatenate(([0], np.cumsum(np.diff(frames) == step)))
+        valid = np.flatnonzero(ok[clip_len - 1:] - ok[:len(ok) - clip_len + 1] == clip_len - 1)
+
+        archive_name, agent_id, camera_id = stream_index["streams"][stream[start]].split("/")
+        next_start = 0
+        for i in valid:
+            if i < next_start:
+                continue
+            next_start = i + hop
+            clips.append({
+                "clip_id": f"{archive_name}:{agent_id}:{camera_id}:{frames[i]:06d}",
+                "archive_name": archive_name,
+                "agent_id": agent_id,
+                "camera_id": camera_id,
+                "frame_ids": [int(f) for f in frames[i:i + clip_len]],
+                "image_paths": list(paths[i:i + clip_len]),
+            })
+
+    return clips
+
+# randomly keep up to max_clips clips (in their original order)
+def sample_clips(clips, max_clips, seed):
+
+    if max_clips is None or len(clips) <= max_clips:
+        return clips
+
+    keep = heapq.nsmallest(max_clips, range(len(clips)), key=lambda i: sample_priority(clips[i]["clip_id"], seed))
+    return [clips[i] for i in sorted(keep)]
+
+# the images of some clips, once each (overlapping clips share frames)
+def clip_paths(clips):
+    return list(dict.fromkeys(path for clip in clips for path in clip["image_paths"]))
+
+# build the sampling plan from temporal clips: ({archive_name: paths}, {archive_name: clips})
+def build_clip_plan(manifests, CAMERA=None, IMG_EXT='.png', STRIDE=1, CLIP_LEN=8, CLIP_OVERLAP=0, MAX_CLIPS=None, SEED=42,
+                    MODALITIES=None, MODALITY_PATTERNS=None):
+
+    sampling_plan = {}
+    archive_clips = {}
+
+    for archive_name, files in manifests.items():
+
+        # with other modalities, only frames that have all of them can be in a clip
+        pairs = None
+        if MODALITIES and set(MODALITIES) != {"camera"}:
+            pairs = pair_modalities(files, MODALITIES, img_ext=IMG_EXT, patterns=MODALITY_PATTERNS)
+            files = sorted(pairs)
+
+        clips = build_clips(build_stream_index(files, camera=CAMERA, img_ext=IMG_EXT),
+                            CLIP_LEN, stride=STRIDE, overlap=CLIP_OVERLAP)
+        sampled = sample_clips(clips, MAX_CLIPS, seed=SEED)
+
+        archive_clips[archive_name] = sampled
+        sampling_plan[archive_name] = clip_paths(sampled) if pairs is None else expand_pairs(clip_paths(sampled), pairs)
+
+        print(f"{archive_name}:")
+        print(f"  Candidates: {len(clips)} clips")
+        print(f"  Sampled: {len(sampled)} clips, {len(sampling_plan[archive_name])} images\n")
+
+    return sampling_plan, archive_clips
+
+# save the clip table (one row per frame of each clip) next to the labels
+def save_clip_table(archive_clips, output_path):
+
+    import csv
+
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+
+    n_clips = 0
+    with open(output_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["clip_id", "archive_name", "agent_id", "camera_id", "position", "frame_id", "image_path"])
+        for clips in archive_clips.values():
+            for clip in clips:
+                n_clips += 1
+                for position, (frame_id, image_path) in enumerate(zip(clip["frame_ids"], clip["image_paths"])):
+                    writer.writerow([clip["clip_id"], clip["archive_name"], clip["agent_id"], clip["camera_id"],
+                                     position, frame_id, image_path])
+
+    print(f"[SAVE] {n_clips} clips saved to {output_path.name}")
+    return output_path
+
+# *******************************
+# Sampling plan
+# *******************************
+
+# sample one archive's manifest, as single images or as whole frame groups
+def sample_archive(files, camera=None, img_ext='.png', stride=1, max_imgs=5, seed=42, mode="images", groups=None,
+                   clip_len=8, clip_overlap=0, max_clips=None, modalities=None, modality_patterns=None):
+
+    '''
+    Returns (sampled paths, number of candidates). In "groups" mode the candidates are
+    frame groups (taken from groups if given, else built from files), in "clips" mode
+    temporal clips (see build_clip_plan). With modalities (e.g. ["camera", "semantic"]),
+    only camera images that have a member in every modality are candidates, and each
+    sampled image is followed by those members (max_imgs counts camera images). Members
+    are named by modality_patterns (see modality_pattern).
+    '''
+
+    if modalities and set(modalities) != {"camera"}:
+        pairs = pair_modalities(files, modalities, img_ext=img_ext, patterns=modality_patterns)
+        if groups is not None:
+            groups = {group: [f for f in members if f in pairs] for group, members in groups.items()}
+        sampled, n_candidates = sample_archive(sorted(pairs), camera=camera, img_ext=img_ext, stride=stride,
+                                               max_imgs=max_imgs, seed=seed, mode=mode, groups=groups,
+                                               clip_len=clip_len, clip_overlap=clip_overlap, max_clips=max_clips)
+        return expand_pairs(sampled, pairs), n_candidates
+
+    if mode == "groups":
+        if groups is None:
+            groups = build_frame_groups(files, img_ext=img_ext)
+        return sample_groups(groups, max_imgs, seed=seed, camera=camera, stride=stride)
+
+    if mode == "clips":
+        clips = build_clips(build_stream_index(files, camera=camera, img_ext=img_ext), clip_len, stride=stride, overlap=clip_overlap)
+        return clip_paths(sample_clips(clips, max_clips, seed=seed)), len(clips)
+
+    if mode != "images":
+        raise ValueError(f"Unknown sampling mode: {mode} (expected images, groups or clips)")
+
+    candidates = filter_manifest(files, camera=camera, img_ext=img_ext, stride=stride)
+    return sample_manifest(candidates, max_imgs, seed=seed), len(candidates)
 
 # build the sampling plan
 def build_sample_plan(manifests, 
@@ -37,40 +376,108 @@ def build_sample_plan(manifests,
                       IMG_EXT='.png', 
                       STRIDE=1, 
                       MAX_IMGS=5, 
-                      SEED=42):
+                      SEED=42,
+                      MODE="images",
+                      GROUPS=None,
+                      MODALITIES=None,
+                      MODALITY_PATTERNS=None):
+
+    '''
+    MODE "images" samples single images, "groups" samples whole synchronized frames
+    (every agent and camera of a frame_id). GROUPS optionally holds precomputed frame
+    groups per archive ({archive_name: groups}). MODALITIES pairs each sampled camera
+    image with its aligned members of other modalities (see sample_archive), named by
+    MODALITY_PATTERNS ({modality: member name pattern}, see modality_pattern).
+    '''
 
     # sampling plan will be stored here
     sampling_plan = {}
 
     for archive_name, files in manifests.items():
         
-        # filter candidates from manifest
-        candidates = filter_manifest(
+        # filter candidates from manifest and sample them per archive
+        sampled, n_candidates = sample_archive(
             files, 
             camera=CAMERA, 
             img_ext=IMG_EXT, 
-            stride=STRIDE
+            stride=STRIDE,
+            max_imgs=MAX_IMGS,
+            seed=SEED,
+            mode=MODE,
+            groups=(GROUPS or {}).get(archive_name),
+            modalities=MODALITIES,
+            modality_patterns=MODALITY_PATTERNS
         )
         
-        # sample images per archive
-        sampled = sample_manifest(candidates, MAX_IMGS, seed=SEED)
-        
         sampling_plan[archive_name] = sampled
         
         print(f"{archive_name}:")
-        print(f"  Candidates: {len(candidates)}")
+        print(f"  Candidates: {n_candidates}{' groups' if MODE == 'groups' else ''}")
         print(f"  Sampled: {len(sampled)}\n")
     
     return sampling_plan
 
+# *******************************
+# Plan changes
+# *******************************
+
+# load a saved sampling plan ({} if there is none)
+def load_sample_plan(plan_file):
+    plan_file = Path(plan_file)
+    return json.loads(plan_file.read_text()) if plan_file.exists() else {}
+
+# what changed between two plans: {archive_name: {"added": [...], "removed": [...]}} (changed archives only)
+def plan_diff(old_plan, new_plan):
+
+    diff = {}
+    for archive_name in sorted(set(old_plan) | set(new_plan)):
+        old_files = set(old_plan.get(archive_name, []))
+        new_files = new_plan.get(archive_name, [])
+        added = [f for f in new_files if f not in old_files]
+        removed = sorted(old_files - set(new_files))
+        if added or removed:
+            diff[archive_name] = {"added": added, "removed": removed}
+
+    return diff
+
+# one line per changed archive
+def print_plan_diff(diff):
+    for archive_name, change in diff.items():
+        print(f"[DIFF] {archive_name}: +{len(change['added'])} -{len(change['removed'])} files")
+
+# delete the extracted files a plan no longer has (so they do not end up in the labels)
+def prune_removed(diff, sampled_dir):
+
+    sampled_dir = Path(sampled_dir)
+    pruned = 0
+    for change in diff.values():
+        for rel_path in change["removed"]:
+            path = sampled_dir / rel_path
+            if path.exists():
+                path.unlink()
+                pruned += 1
+
+    if pruned:
+        print(f"[CLEANUP] Deleted {pruned} sampled files that are no longer in the plan")
+    return pruned
+
 # save the sampling plan to JSON
 def save_sample_plan(sampling_plan, output_file, overwrite=False):
   
+    '''
+    An existing plan is kept if it is the same, and otherwise updated (only the files in
+    the diff need extracting, since sampling is monotone in the budget).
+    '''
+
     output_file = Path(output_file)
     
     if output_file.exists() and not overwrite:
-        print(f"[SKIP] Sample plan already exists at {output_file.name}. Using existing plan.")
-        return output_file
+        diff = plan_diff(load_sample_plan(output_file), sampling_plan)
+        if not diff:
+            print(f"[SKIP] Sample plan already exists at {output_file.name}. Using existing plan.")
+            return output_file
+        print(f"[UPDATE] Sample plan at {output_file.name} changed:")
+        print_plan_diff(diff)
     
     if output_file.exists() and overwrite:
         print(f"[OVERWRITE] Overwriting existing sample plan at {output_file.name}")
@@ -1,19 +1,101 @@
-# imports
-import numpy as np
-import pandas as pd
+# imports (numpy and pandas are imported inside the functions that use them, to keep startup fast)
 from pathlib import Path
 
+# remove rows flagged as invalid by the validation stage
+def drop_invalid(labels_df):
+
+    if "valid" not in labels_df.columns:
+        return labels_df
+
+    valid = labels_df["valid"].astype(bool)
+    if not valid.all():
+        print(f"[EXCLUDE] Dropping {int((~valid).sum())} invalid images")
+
+    return labels_df[valid].reset_index(drop=True)
+
+# the labels columns whose groups must stay in one split: the views of a synchronized frame
+# when whole frames are sampled, and the duplicate groups (if dedup is on)
+def group_column(dedup, sample_mode="images"):
+    columns = (["group_id"] if sample_mode == "groups" else []) + (["dup_group"] if dedup else [])
+    return columns or None
+
+# one group per connected component of rows that share a value in any of the columns (union-find),
+# so e.g. a frame group and every duplicate of its images end up in the same group
+def connected_groups(labels_df, columns):
+
+    import pandas as pd
+
+    parent = list(range(len(labels_df)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for column in columns:
+        first = {}
+        for i, value in enumerate(labels_df[column]):
+            if pd.isna(value):
+                continue
+            j = first.setdefault(value, i)
+            if j != i:
+                parent[find(i)] = find(j)
+
+    return pd.Series([find(i) for i in range(len(labels_df))], index=labels_df.index)
+
+# the path columns of a labels row: the image, then its paired modalities (e.g. semantic_path)
+def path_columns(columns):
+    return ["image_path"] + [c for c in columns if c.endswith("_path") and c not in ("image_path", "canonical_path")]
+
+# assign whole groups to train/val/test (groups are shuffled, then filled in order)
+def split_groups(groups, train_size, val_size, rng):
+
+    import numpy as np
+    import pandas as pd
+
+    # row positions for each group, in order of first appearance
+    codes, uniques = pd.factorize(groups)
+    order = np.argsort(codes, kind="stable")
+    bounds = np.cumsum(np.bincount(codes, minlength=len(uniques)))
+    members = np.split(order, bounds[:-1])
+
+    # shuffle the groups with the same reproducible rng
+    train_indices, val_indices, test_indices = [], [], []
+    count = 0
+    for g in rng.permutation(len(uniques)):
+        if count < train_size:
+            train_indices.extend(members[g])
+        elif count < train_size + val_size:
+            val_indices.extend(members[g])
+        else:
+            test_indices.extend(members[g])
+        count += len(members[g])
+
+    return (np.array(train_indices, dtype=int),
+            np.array(val_indices, dtype=int),
+            np.array(test_indices, dtype=int))
+
 # split the labels
 def split_labels(labels_path, 
                  train_ratio=0.70, 
                  val_ratio=0.15, 
                  test_ratio=0.15, 
-                 seed=42):
+                 seed=42,
+                 group_col=None):
 
     '''|---- train ----|---- val ----|------ test ------|
         0            train_size   train_size+val_size   end
+
+        If group_col is given (e.g., "dup_group"), rows sharing a value are
+        kept together: whole groups are shuffled and assigned to splits. With
+        several columns (e.g. ["group_id", "dup_group"]), rows linked through
+        any of them are kept together.
     '''
 
+    import numpy as np
+    import pandas as pd
+
     # enforce labels path
     if not isinstance(labels_path, Path):
         labels_path = Path(labels_path)
@@ -22,18 +104,34 @@ def split_labels(labels_path,
     labels_df = pd.read_csv(labels_path)
     print(f"[LOAD] Loaded {len(labels_df)} labels from: {labels_path.name}")
 
+    # drop images that failed validation (if validation was run)
+    labels_df = drop_invalid(labels_df)
+
     # shuffle the labels with reproducible seed
     rng = np.random.RandomState(seed)
-    shuffled_indices = rng.permutation(len(labels_df))
 
     # compute split sizes
     train_size = int(len(labels_df) * train_ratio)
     val_size = int(len(labels_df) * val_ratio)
 
-    # split the indices (noting they are already shuffled)
-    train_indices = shuffled_indices[:train_size]
-    val_indices = shuffled_indices[train_size:train_size + val_size]
-    test_indices = shuffled_indices[train_size + val_size:]
+    # the grouping columns that are in the labels
+    group_cols = [group_col] if isinstance(group_col, str) else list(group_col or [])
+    group_cols = [c for c in group_cols if c in labels_df.columns]
+
+    if group_cols:
+
+        # split whole groups, so duplicates (and frame groups) never leak across splits
+        groups = labels_df[group_cols[0]] if len(group_cols) == 1 else connected_groups(labels_df, group_cols)
+        train_indices, val_indices, test_indices = split_groups(groups, train_size, val_size, rng)
+
+    else:
+
+        shuffled_indices = rng.permutation(len(labels_df))
+
+        # split the indices (noting they are already shuffled)
+        train_indices = shuffled_indices[:train_size]
+        val_indices = shuffled_indices[train_size:train_size + val_size]
+        test_indices = shuffled_indices[train_size + val_size:]
 
     # create split dataframes
     splits = {
@@ -86,29 +184,42 @@ def build_splits(splits, sampled_dir, ready_dir, cleanup_sampled=False, overwrit
         
         split_dir.mkdir(parents=True, exist_ok=True)
 
+        # never copy images that failed validation
+        split_data = drop_invalid(split_data)
+
         print(f"\n[BUILD] Building split: {split_name} with {len(split_data)} samples")
 
-        # map each image to split folders
+        # map each image (and its paired modalities) to split folders
         copied_count = 0
         skipped_count = 0
+        columns = path_columns(split_data.columns)
 
         # for each row in the split data
         for _, row in split_data.iterrows():
+            for column in columns:
 
-            # define source and destination paths
-            src_path = sampled_dir / row['image_path']
-            dest_path = split_dir / row['image_path']
+                # a modality that was not extracted for this row
+                if not isinstance(row[column], str):
+                    continue
 
-            # create destination parent directories
-            dest_path.parent.mkdir(parents=True, exist_ok=True)
+                # define source and destination paths
+                src_path = sampled_dir / row[column]
+                dest_path = split_dir / row[column]
 
-            # copy file if source exists
-            if src_path.exists():
-                dest_path.write_bytes(src_path.read_bytes())
-                copied_count += 1
-            else:
-                print(f"[WARN] Source file not found: {src_path.name}")
-                skipped_count += 1
+                # create destination parent directories
+                dest_path.parent.mkdir(parents=True, exist_ok=True)
+
+                # deduplicated rows may only have their canonical copy on disk
+                if column == 'image_path' and not src_path.exists() and isinstance(row.get('canonical_path'), str):
+                    src_path = sampled_dir / row['canonical_path']
+
+                # copy file if source exists
+                if src_path.exists():
+                    dest_path.write_bytes(src_path.read_bytes())
+                    copied_count += 1
+                else:
+                    print(f"[WARN] Source file not found: {src_path.name}")
+                    skipped_count += 1
 
         # save split-specific labels CSV
         split_labels_path = ready_dir / f"{split_name}_labels.csv"
@@ -121,10 +232,13 @@ def build_splits(splits, sampled_dir, ready_dir, cleanup_sampled=False, overwrit
         if cleanup_sampled:
             deleted_count = 0
             for _, row in split_data.iterrows():
-                src_path = sampled_dir / row['image_path']
-                if src_path.exists():
-                    src_path.unlink()
-                    deleted_count += 1
+                for column in columns:
+                    if not isinstance(row[column], str):
+                        continue
+                    src_path = sampled_dir / row[column]
+                    if src_path.exists():
+                        src_path.unlink()
+                        deleted_count += 1
             print(f"[CLEANUP] Deleted {deleted_count} files from sampled_dir")
         else:
             print(f"[CLEANUP] leaving sampled data for later")
\ No newline at end of file
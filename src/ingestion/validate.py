@@ -0,0 +1,220 @@
+# imports
+import json
+import struct
+import zlib
+from pathlib import Path
+from src.utils.file_operations import PNG_SIGNATURE, file_fingerprint, update_json_cache
+from src.ingestion.archive import load_member_crcs
+from src.utils import profiling
+
+# CRC-32 of a whole file, formatted like the "CRC = ..." field of `7z l -slt`
+def file_crc32(path, chunk_size=1024 * 1024):
+    crc = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            crc = zlib.crc32(chunk, crc)
+    return f"{crc & 0xFFFFFFFF:08X}"
+
+# walk the PNG chunks and check each chunk CRC (catches truncation and corruption without decoding)
+def check_png_crc(path):
+
+    '''
+    PNG layout after the 8-byte signature, repeated until IEND:
+        [length:4][type:4][data:length][crc:4]    (crc covers type + data)
+    '''
+
+    data = Path(path).read_bytes()
+
+    if data[:8] != PNG_SIGNATURE:
+        return False, "bad signature"
+
+    pos = 8
+    while pos + 8 <= len(data):
+
+        # chunk header
+        length, = struct.unpack(">I", data[pos:pos + 4])
+        chunk_type = data[pos + 4:pos + 8]
+        end = pos + 8 + length + 4
+
+        # truncated mid-chunk
+        if end > len(data):
+            return False, f"truncated in {chunk_type.decode('latin-1')} chunk"
+
+        # compare stored and computed CRC
+        stored, = struct.unpack(">I", data[end - 4:end])
+        if zlib.crc32(data[pos + 4:end - 4]) & 0xFFFFFFFF != stored:
+            return False, f"CRC mismatch in {chunk_type.decode('latin-1')} chunk"
+
+        # IEND closes the stream
+        if chunk_type == b"IEND":
+            return True, None
+
+        pos = end
+
+    return False, "missing IEND (truncated)"
+
+# fully decode the image with PIL (slower, but also catches bad compressed data)
+def check_png_decode(path):
+
+    # import here so the CRC mode does not need PIL in the workers
+    from PIL import Image
+
+    try:
+        # verify() checks structure, but leaves the image unusable, so re-open to decode
+        with Image.open(path) as img:
+            img.verify()
+        with Image.open(path) as img:
+            img.load()
+    except Exception as e:
+        return False, str(e)
+
+    return True, None
+
+# validate one image (runs in a worker process)
+def _validate_one(args):
+
+    path, mode, expected_crc = args
+
+    try:
+        # the archive listing gives the CRC of the whole file, which is the cheapest complete check
+        if expected_crc:
+            if file_crc32(path) != expected_crc.upper():
+                return False, "CRC does not match archive listing"
+            if mode != "decode":
+                return True, None
+
+        # other sensors (e.g. lidar .ply, .yaml) can only be checked against the archive listing
+        if not str(path).lower().endswith(".png"):
+            return True, None
+
+        if mode == "decode":
+            return check_png_decode(path)
+        return check_png_crc(path)
+
+    except OSError as e:
+        return False, str(e)
+
+# load the validation ledger (relative path -> fingerprint, member CRC, result)
+def load_validation(validation_path):
+    validation_path = Path(validation_path)
+    if not validation_path.exists():
+        return {}
+    return json.loads(validation_path.read_text())
+
+# merge new results into the validation ledger
+def update_validation(updates, validation_path):
+    return update_json_cache(updates, validation_path, indent=2)
+
+# invalid files recorded in the validation ledger ({relative path: reason})
+def load_invalid(validation_path):
+    ledger = load_validation(validation_path)
+    return {rel_path: entry["reason"] for rel_path, entry in ledger.items() if not entry["valid"]}
+
+# validate many images in parallel, skipping files unchanged since their last check
+def validate_images(sampled_dir, rel_paths, mode="crc", workers=4, validation_path=None, member_crcs=None):
+
+    '''
+    mode = "crc"    : check PNG chunk CRCs (or the archive CRC, when known)
+    mode = "decode" : additionally decode every image with PIL
+    member_crcs     : optional {relative path: CRC} from a verbose archive manifest
+    Returns {relative path: reason} for every invalid file.
+    '''
+
+    # enforce Path type
+    if not isinstance(sampled_dir, Path):
+        sampled_dir = Path(sampled_dir)
+    if member_crcs is None:
+        member_crcs = {}
+
+    # load previous results
+    ledger = load_validation(validation_path) if validation_path is not None else {}
+
+    # decide which files need (re)checking
+    to_check = []
+    fingerprints = {}
+    for rel_path in rel_paths:
+        rel_path = str(rel_path)
+        full_path = sampled_dir / rel_path
+        if not full_path.exists():
+            continue
+
+        fingerprint = file_fingerprint(full_path)
+        fingerprints[rel_path] = fingerprint
+        member_crc = member_crcs.get(rel_path)
+
+        # unchanged since the last check (a decode result also satisfies a crc request)
+        entry = ledger.get(rel_path)
+        if (entry is not None
+                and entry["fingerprint"] == fingerprint
+                and entry.get("member_crc") == member_crc
+                and (entry["mode"] == mode or entry["mode"] == "decode")):
+            continue
+
+        to_check.append((rel_path, member_crc))
+
+    print(f"[VALIDATE] {len(to_check)} to check, {len(fingerprints) - len(to_check)} unchanged (mode={mode})")
+
+    # check the rest in parallel (CPU bound, so use processes)
+    updates = {}
+    if to_check:
+        jobs = [(str(sampled_dir / rel_path), mode, member_crc) for rel_path, member_crc in to_check]
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers, **profiling.pool_kwargs()) as pool:
+            results = pool.map(_validate_one, jobs, chunksize=64)
+            for (rel_path, member_crc), (valid, reason) in zip(to_check, results):
+                updates[rel_path] = {
+                    "fingerprint": fingerprints[rel_path],
+                    "member_crc": member_crc,
+                    "mode": mode,
+                    "valid": valid,
+                    "reason": reason,
+                }
+        ledger.update(updates)
+
+        # persist for next time
+        if validation_path is not None:
+            update_validation(updates, validation_path)
+
+    # report invalid files (only those we were asked about)
+    invalid = {
+        rel_path: ledger[rel_path]["reason"]
+        for rel_path in fingerprints
+        if not ledger[rel_path]["valid"]
+    }
+    for rel_path, reason in invalid.items():
+        print(f"[INVALID] {rel_path}: {reason}")
+    print(f"[VALIDATE] {len(invalid)} invalid of {len(fingerprints)} images")
+
+    return invalid
+
+# validate everything in a sampling plan, reusing member CRCs from verbose manifests
+def validate_sample_plan(sample_plan_file, sampled_dir, index_dir, mode="crc", workers=4, validation_path=None,
+                         archives=None):
+
+    # ensure Path types
+    if not isinstance(sample_plan_file, Path):
+        sample_plan_file = Path(sample_plan_file)
+    if not isinstance(index_dir, Path):
+        index_dir = Path(index_dir)
+
+    with open(sample_plan_file, 'r') as f:
+        sample_plan = json.load(f)
+
+    # gather files and any known CRCs
+    rel_paths = []
+    member_crcs = {}
+    for archive_name, file_list in sample_plan.items():
+        # only the chosen archives, if given
+        if archives is not None and archive_name not in archives:
+            continue
+        rel_paths.extend(file_list)
+        member_crcs.update(load_member_crcs(archive_name, index_dir))
+
+    return validate_images(
+        sampled_dir=sampled_dir,
+        rel_paths=rel_paths,
+        mode=mode,
+        workers=workers,
+        validation_path=validation_path,
+        member_crcs=member_crcs
+    )
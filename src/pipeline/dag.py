@@ -0,0 +1,361 @@
+# imports
+import json
+import hashlib
+import threading
+import time
+from pathlib import Path
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from src.utils.file_operations import file_lock, write_atomic
+
+# files up to this size are fingerprinted by content, larger ones by size and mtime
+CONTENT_HASH_MAX_BYTES = 64 * 1024 ** 2
+
+# statuses that let dependent stages go ahead
+OK_STATUSES = {"done", "skipped", "deferred"}
+
+# read a value from the config with a dotted key (e.g. "ingestion.frame_stride")
+def get_config_value(cfg, dotted_key, default=None):
+    value = cfg
+    for key in dotted_key.split("."):
+        if not isinstance(value, dict) or key not in value:
+            return default
+        value = value[key]
+    return value
+
+# stable hash of any JSON-able object
+def hash_json(obj):
+    return hashlib.sha256(json.dumps(obj, sort_keys=True, default=str).encode()).hexdigest()
+
+# fingerprint a file or directory on disk (None if missing)
+def fingerprint_path(path):
+
+    path = Path(path)
+
+    if not path.exists():
+        return None
+
+    # small files: content addressed
+    if path.is_file():
+        stat = path.stat()
+        if stat.st_size <= CONTENT_HASH_MAX_BYTES:
+            return "sha256:" + hashlib.sha256(path.read_bytes()).hexdigest()
+        return [stat.st_size, stat.st_mtime_ns]
+
+    # directories: every file's relative path, size and mtime
+    listing = []
+    for p in sorted(path.rglob("*")):
+        if p.is_file():
+            stat = p.stat()
+            listing.append([str(p.relative_to(path)), stat.st_size, stat.st_mtime_ns])
+    return "dir:" + hash_json(listing)
+
+# define a stage
+def make_stage(name, func, deps=None, inputs=None, outputs=None, config_keys=None,
+               ephemeral=False, partial=False, requires=None, fingerprint=None):
+
+    '''
+    name        : unique stage name (e.g. "extract:rcnj_cn_s")
+    func        : called with no arguments; returning False means "no output" (dependents are blocked)
+    deps        : names of upstream stages
+    inputs      : extra files read by the stage (not produced by another stage)
+    outputs     : files/directories written by the stage
+    config_keys : dotted config keys the stage depends on
+    ephemeral   : outputs may be deleted later (e.g. raw archives); a missing output does not
+                  trigger a re-run, the stage is only re-run when a dependent requires it
+    partial     : run even if some deps failed (e.g. global merges over many archives)
+    requires    : deps whose outputs must be on disk when this stage runs (list, or a
+                  callable returning a list, evaluated at run time)
+    fingerprint : optional callable returning the output fingerprint (default: fingerprint outputs)
+    '''
+
+    return {
+        "name": name,
+        "func": func,
+        "deps": list(deps or []),
+        "inputs": [Path(p) for p in (inputs or [])],
+        "outputs": [Path(p) for p in (outputs or [])],
+        "config_keys": list(config_keys or []),
+        "ephemeral": ephemeral,
+        "partial": partial,
+        "requires": requires or [],
+        "fingerprint": fingerprint,
+    }
+
+# load the stage cache
+def load_cache(cache_path):
+    cache_path = Path(cache_path)
+    if not cache_path.exists():
+        return {}
+    return json.loads(cache_path.read_text())
+
+# merge stage records into the stage cache (other processes may be writing to it too)
+def save_cache(updates, cache_path):
+    cache_path = Path(cache_path)
+    with file_lock(cache_path):
+        cache = load_cache(cache_path)
+        cache.update(updates)
+        write_atomic(cache_path, json.dumps(cache, indent=2))
+    return cache_path
+
+# current output fingerprint of a stage
+def output_fingerprint(stage):
+    if stage["fingerprint"] is not None:
+        return stage["fingerprint"]()
+    return {str(p): fingerprint_path(p) for p in stage["outputs"]}
+
+# True if any declared output is missing from disk
+def outputs_missing(stage):
+    return any(not p.exists() for p in stage["outputs"])
+
+# hash of everything a stage reads: upstream outputs (as recorded) and extra input files
+def input_hash(stage, cache):
+    upstream = {dep: cache.get(dep, {}).get("output_fp") for dep in stage["deps"]}
+    files = {str(p): fingerprint_path(p) for p in stage["inputs"]}
+    return hash_json({"deps": upstream, "inputs": files})
+
+# hash of the config values a stage depends on
+def config_hash(stage, cfg):
+    return hash_json({key: get_config_value(cfg, key) for key in stage["config_keys"]})
+
+# check that every dep exists and there are no cycles
+def check_graph(stages):
+
+    for stage in stages.values():
+        for dep in stage["deps"]:
+            if dep not in stages:
+                raise ValueError(f"Stage '{stage['name']}' depends on unknown stage '{dep}'")
+
+    # depth-first search for cycles
+    state = {}
+    def visit(name, trail):
+        if state.get(name) == "done":
+            return
+        if state.get(name) == "visiting":
+            raise ValueError(f"Cycle in stage graph: {' -> '.join(trail + [name])}")
+        state[name] = "visiting"
+        for dep in stages[name]["deps"]:
+            visit(dep, trail + [name])
+        state[name] = "done"
+
+    for name in stages:
+        visit(name, [])
+
+# the stages of one kind ("extract" matches "extract:ri_cn_s" and "extract") plus everything upstream of them
+def select_stages(stage_list, kind):
+
+    stages = {stage["name"]: stage for stage in stage_list}
+    targets = [name for name in stages if name.split(":")[0] == kind]
+
+    # walk the deps back from the targets
+    keep = set()
+    todo = list(targets)
+    while todo:
+        name = todo.pop()
+        if name in keep:
+            continue
+        keep.add(name)
+        todo.extend(stages[name]["deps"])
+
+    # the requested stages must leave their outputs on disk, so they are never deferred
+    for name in targets:
+        stages[name]["ephemeral"] = False
+
+    return [stage for stage in stage_list if stage["name"] in keep]
+
+# summarise a run timeline: makespan, parallelism, and first/last finish per stage kind
+def timing_report(timeline):
+
+    '''
+    timeline: list of {"stage", "status", "start", "end"} with times in seconds from the run start.
+    The stage kind is the part of the name before ":" (e.g. "extract:ri_cn_s" -> "extract").
+    '''
+
+    if not timeline:
+        return {"makespan_s": 0.0, "busy_s": 0.0, "parallelism": 0.0, "kinds": {}, "stages": []}
+
+    makespan = max(t["end"] for t in timeline)
+    busy = sum(t["end"] - t["start"] for t in timeline)
+
+    kinds = {}
+    for t in timeline:
+        kind = t["stage"].split(":")[0]
+        k = kinds.setdefault(kind, {"count": 0, "busy_s": 0.0, "first_start_s": t["start"],
+                                    "first_end_s": t["end"], "last_end_s": t["end"]})
+        k["count"] += 1
+        k["busy_s"] = round(k["busy_s"] + t["end"] - t["start"], 3)
+        k["first_start_s"] = min(k["first_start_s"], t["start"])
+        k["first_end_s"] = min(k["first_end_s"], t["end"])
+        k["last_end_s"] = max(k["last_end_s"], t["end"])
+
+    return {
+        "makespan_s": round(makespan, 3),
+        "busy_s": round(busy, 3),
+        "parallelism": round(busy / makespan, 2) if makespan > 0 else 0.0,
+        "kinds": kinds,
+        "stages": sorted(timeline, key=lambda t: t["start"]),
+    }
+
+# print the timeline as a text gantt chart (overlapping bars = stages running together)
+def print_timeline(report, width=50):
+
+    makespan = report["makespan_s"] or 1.0
+    name_width = max([len(t["stage"]) for t in report["stages"]] + [5])
+
+    for t in report["stages"]:
+        a = int(t["start"] / makespan * width)
+        b = max(a + 1, int(t["end"] / makespan * width))
+        bar = " " * a + "#" * (b - a) + " " * (width - b)
+        print(f"  {t['stage']:<{name_width}} |{bar}| {t['end'] - t['start']:6.2f}s {t['status']}")
+
+    print(f"\n  makespan: {report['makespan_s']:.2f}s, busy: {report['busy_s']:.2f}s, parallelism: {report['parallelism']:.2f}")
+    for kind, k in report["kinds"].items():
+        print(f"  {kind:<{name_width}} first done at {k['first_end_s']:.2f}s, last done at {k['last_end_s']:.2f}s ({k['count']} stages)")
+
+# run a list of stages, skipping any whose inputs, config and outputs are unchanged
+def run_dag(stage_list, cfg, cache_path, workers=4, force=False, report_path=None):
+
+    '''
+    Stages run as soon as their deps finish, on a thread pool, so independent
+    branches (e.g. one per archive) run concurrently.
+    Returns {stage name: status} with status in
+        done / skipped / deferred / empty / failed / blocked
+    If report_path is given, the per-stage timing report is saved there as JSON.
+    '''
+
+    stages = {stage["name"]: stage for stage in stage_list}
+    check_graph(stages)
+
+    cache = load_cache(cache_path)
+    cache_lock = threading.Lock()
+    stage_locks = defaultdict(threading.Lock)
+    status = {}
+    timeline = []
+    run_start = time.time()
+
+    # run a stage and record when it started and finished
+    def timed_visit(name):
+        start = time.time() - run_start
+        result = "failed"
+        try:
+            result = visit(name)
+            return result
+        finally:
+            with cache_lock:
+                timeline.append({"stage": name, "status": result,
+                                 "start": round(start, 3), "end": round(time.time() - run_start, 3)})
+
+    # run one stage now, regardless of its cache record
+    def execute(name, input_h, config_h):
+
+        stage = stages[name]
+
+        # make sure anything we need on disk is there (re-runs deferred/ephemeral deps)
+        requires = stage["requires"]() if callable(stage["requires"]) else stage["requires"]
+        refreshed = False
+        for dep in requires:
+            with stage_locks[dep]:
+                if outputs_missing(stages[dep]):
+                    print(f"[RUN] {dep} (required by {name})")
+                    if execute(dep, input_hash(stages[dep], cache), config_hash(stages[dep], cfg)) != "done":
+                        raise RuntimeError(f"required stage '{dep}' produced no output")
+                    refreshed = True
+
+        # upstream outputs may have changed
+        if refreshed:
+            input_h = input_hash(stage, cache)
+
+        start = time.time()
+        result = stage["func"]()
+        duration = time.time() - start
+
+        if result is False:
+            return "empty"
+
+        record = {
+            "input_hash": input_h,
+            "config_hash": config_h,
+            "output_fp": output_fingerprint(stage),
+            "finished_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "duration_s": round(duration, 3),
+        }
+        with cache_lock:
+            cache[name] = record
+            save_cache({name: record}, cache_path)
+
+        print(f"[DONE] {name} ({duration:.1f}s)")
+        return "done"
+
+    # decide whether a stage needs to run, then run it
+    def visit(name):
+
+        stage = stages[name]
+        input_h = input_hash(stage, cache)
+        config_h = config_hash(stage, cfg)
+        record = cache.get(name)
+
+        # ephemeral outputs that are gone are only rebuilt on demand
+        if stage["ephemeral"] and outputs_missing(stage) and not force:
+            return "deferred"
+
+        # unchanged inputs, config and outputs
+        if (not force
+                and record is not None
+                and record["input_hash"] == input_h
+                and record["config_hash"] == config_h
+                and record["output_fp"] == output_fingerprint(stage)):
+            print(f"[SKIP] {name} is up to date")
+            return "skipped"
+
+        print(f"[RUN] {name}")
+        with stage_locks[name]:
+            return execute(name, input_h, config_h)
+
+    # schedule stages as their deps complete
+    pending = set(stages)
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while pending or running:
+
+            # submit everything that is ready
+            for name in sorted(pending):
+                deps = stages[name]["deps"]
+                if any(dep not in status for dep in deps):
+                    continue
+                pending.discard(name)
+                if not stages[name]["partial"] and any(status[dep] not in OK_STATUSES for dep in deps):
+                    status[name] = "blocked"
+                    print(f"[BLOCKED] {name}")
+                    continue
+                running[pool.submit(timed_visit, name)] = name
+
+            # blocked stages may have unlocked more stages
+            if not running:
+                continue
+
+            # wait for the next stage to finish
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    status[name] = future.result()
+                except Exception as e:
+                    status[name] = "failed"
+                    print(f"[ERROR] {name}: {e}")
+
+    # summary
+    counts = defaultdict(int)
+    for s in status.values():
+        counts[s] += 1
+    print(f"[DAG] {len(status)} stages: " + ", ".join(f"{k}={v}" for k, v in sorted(counts.items())))
+
+    # timing report
+    report = timing_report(timeline)
+    print_timeline(report)
+    if report_path is not None:
+        report_path = Path(report_path)
+        report_path.parent.mkdir(parents=True, exist_ok=True)
+        report_path.write_text(json.dumps(report, indent=2))
+        print(f"[SAVE] Timing report saved to {report_path.name}")
+
+    return status
@@ -0,0 +1,318 @@
+# a local job queue for the per-archive branches of the stage graph, backed by SQLite
+#
+# The coordinator puts one task per archive in the queue (largest archive first), starts worker
+# processes, and waits. Each worker claims a task with a lease, runs that archive's stages
+# (download -> manifest -> plan -> extract -> validate -> label) and marks it done. A worker
+# renews its lease while it works, so a killed worker's lease runs out and the archive is handed
+# to another worker. Failed tasks are retried with exponential backoff up to max_attempts.
+# The global stages (plan merge, label merge, split) then run as usual, with every archive stage
+# already up to date in the stage cache.
+
+# imports
+import os
+import sys
+import time
+import random
+import socket
+import sqlite3
+import threading
+from pathlib import Path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    name          TEXT PRIMARY KEY,
+    priority      INTEGER NOT NULL DEFAULT 0,
+    status        TEXT NOT NULL DEFAULT 'pending',   -- pending / leased / done / failed
+    attempts      INTEGER NOT NULL DEFAULT 0,
+    available_at  REAL NOT NULL DEFAULT 0,
+    lease_owner   TEXT,
+    lease_expires REAL,
+    last_error    TEXT,
+    updated_at    REAL
+)
+"""
+
+# *******************************
+# Queue
+# *******************************
+
+# open the queue (one connection per process or thread)
+def connect(db_path):
+    db_path = Path(db_path)
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(SCHEMA)
+    return conn
+
+# start a run: (re)queue every task as pending, with its priority (bigger runs first)
+def enqueue(db_path, priorities):
+    conn = connect(db_path)
+    now = time.time()
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM tasks")
+        conn.executemany(
+            "INSERT INTO tasks (name, priority, status, updated_at) VALUES (?, ?, 'pending', ?)",
+            [(name, int(priority or 0), now) for name, priority in priorities.items()]
+        )
+    conn.close()
+
+# claim the next task: the largest pending task, or one whose lease has run out
+def claim(conn, owner, lease_s, max_attempts):
+
+    while True:
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                """SELECT name, attempts, status FROM tasks
+                   WHERE (status = 'pending' AND available_at <= ?)
+                      OR (status = 'leased' AND lease_expires < ?)
+                   ORDER BY priority DESC, name LIMIT 1""",
+                (now, now)
+            ).fetchone()
+
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+
+            name, attempts, status = row
+
+            # a lease that keeps running out (e.g. the archive crashes every worker) is given up
+            if attempts >= max_attempts:
+                conn.execute(
+                    "UPDATE tasks SET status = 'failed', last_error = COALESCE(last_error, ?), updated_at = ? WHERE name = ?",
+                    (f"lease expired after {attempts} attempts", now, name)
+                )
+                conn.execute("COMMIT")
+                print(f"[QUEUE] {name} failed after {attempts} attempts")
+                continue
+
+            conn.execute(
+                """UPDATE tasks SET status = 'leased', attempts = attempts + 1, lease_owner = ?,
+                   lease_expires = ?, updated_at = ? WHERE name = ?""",
+                (owner, now + lease_s, now, name)
+            )
+            conn.execute("COMMIT")
+
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        if status == "leased":
+            print(f"[QUEUE] {name}: previous lease expired, reclaimed by {owner}")
+        return name, attempts + 1
+
+# extend a lease (returns False if the task is no longer ours)
+def renew(conn, name, owner, lease_s):
+    cur = conn.execute(
+        "UPDATE tasks SET lease_expires = ? WHERE name = ? AND lease_owner = ? AND status = 'leased'",
+        (time.time() + lease_s, name, owner)
+    )
+    return cur.rowcount == 1
+
+# mark a task done
+def complete(conn, name, owner):
+    conn.execute(
+        "UPDATE tasks SET status = 'done', last_error = NULL, updated_at = ? WHERE name = ? AND lease_owner = ?",
+        (time.time(), name, owner)
+    )
+
+# put a failed task back with a backoff delay (or give up after max_attempts)
+def fail(conn, name, owner, attempts, error, max_attempts, backoff_s):
+
+    now = time.time()
+    if attempts >= max_attempts:
+        conn.execute(
+            "UPDATE tasks SET status = 'failed', last_error = ?, updated_at = ? WHERE name = ? AND lease_owner = ?",
+            (error, now, name, owner)
+        )
+        return None
+
+    # exponential backoff with jitter
+    delay = backoff_s * 2 ** (attempts - 1) * random.uniform(0.5, 1.5)
+    conn.execute(
+        """UPDATE tasks SET status = 'pending', available_at = ?, lease_owner = NULL, lease_expires = NULL,
+           last_error = ?, updated_at = ? WHERE name = ? AND lease_owner = ?""",
+        (now + delay, error, now, name, owner)
+    )
+    return delay
+
+# number of tasks that are not finished yet
+def remaining(conn):
+    return conn.execute("SELECT COUNT(*) FROM tasks WHERE status IN ('pending', 'leased')").fetchone()[0]
+
+# {status: count} and the failed tasks with their last error
+def summary(db_path):
+    conn = connect(db_path)
+    counts = dict(conn.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall())
+    failed = dict(conn.execute("SELECT name, last_error FROM tasks WHERE status = 'failed'").fetchall())
+    conn.close()
+    return counts, failed
+
+# *******************************
+# Workers
+# *******************************
+
+# keep renewing a lease until stopped
+def _heartbeat(db_path, name, owner, lease_s, stop):
+    conn = connect(db_path)
+    while not stop.wait(lease_s / 3):
+        if not renew(conn, name, owner, lease_s):
+            break
+    conn.close()
+
+# the stages of each archive branch: {archive stem: [stages]}
+def archive_branches(stage_list):
+    branches = {}
+    for stage in stage_list:
+        if ":" in stage["name"]:
+            branches.setdefault(stage["name"].split(":", 1)[1], []).append(stage)
+    return branches
+
+# worker process: claim tasks and run their archive's stages until the queue is empty
+def worker_main(db_path, cfg, project_root, kind, worker_id, options):
+
+    from src.pipeline import stages as pipeline_stages
+    from src.pipeline.dag import run_dag, OK_STATUSES
+
+    # each worker logs to its own file
+    log_path = Path(db_path).parent / f"worker-{worker_id}.log"
+    sys.stdout = sys.stderr = open(log_path, "w", buffering=1)
+
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    conn = connect(db_path)
+
+    # the coordinator's setup does not carry over to a spawned process
+    from src.ingestion import download
+    download.setup_metadata_cache(cfg, Path(project_root) / cfg["data_paths"]["index"])
+
+    # the archive branches of the (selected part of the) graph
+    stage_list = pipeline_stages.build_stages(cfg, project_root)
+    if kind is not None:
+        stage_list = pipeline_stages.select_stages(stage_list, kind)
+    branches = archive_branches(stage_list)
+
+    # the archives this worker downloads share one async engine (with ingestion.download_engine "async")
+    s = pipeline_stages.load_settings(cfg, project_root)
+    download.start_engine(s["ingestion_cfg"], s["base_url"], s["raw_dir"], [], timeout=60,
+                          max_size_GB=s["max_gb"], overwrite=s["overwrite"], budget=s["budget"])
+
+    while True:
+
+        task = claim(conn, owner, options["lease_s"], options["max_attempts"])
+        if task is None:
+            if remaining(conn) == 0:
+                break
+            # other workers hold the rest (or they are backing off)
+            time.sleep(options["poll_s"])
+            continue
+
+        name, attempts = task
+        print(f"[QUEUE] {owner} took {name} (attempt {attempts})")
+
+        # renew the lease in the background while the archive is processed
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=_heartbeat, args=(db_path, name, owner, options["lease_s"], stop), daemon=True)
+        heartbeat.start()
+
+        try:
+            status = run_dag(branches.get(name, []), cfg, cache_path=options["cache_path"], workers=1,
+                             force=cfg["sampling"]["overwrite"])
+            bad = {stage: result for stage, result in status.items() if result not in OK_STATUSES | {"empty"}}
+            error = ", ".join(f"{stage}={result}" for stage, result in bad.items()) if bad else None
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        finally:
+            stop.set()
+            heartbeat.join()
+
+        if error is None:
+            complete(conn, name, owner)
+            print(f"[QUEUE] {name} done")
+        else:
+            delay = fail(conn, name, owner, attempts, error, options["max_attempts"], options["backoff_s"])
+            if delay is None:
+                print(f"[QUEUE] {name} failed for good: {error}")
+            else:
+                print(f"[QUEUE] {name} failed ({error}), retrying in {delay:.1f}s")
+
+    download.stop_engine()
+    conn.close()
+
+# *******************************
+# Coordinator
+# *******************************
+
+# size of an archive, used to run the largest first (on disk, else the server's content-length)
+def archive_priority(s, filename):
+
+    raw_path = s["raw_dir"] / filename
+    if raw_path.exists():
+        return raw_path.stat().st_size
+
+    from src.ingestion import download
+    try:
+        size = download.content_length(f"{s['base_url']}/{filename}", timeout=30)
+    except Exception:
+        size = None
+    if size is not None:
+        return size
+
+    # no size available: a manifest's length is still a fair relative measure
+    manifest_path = s["index_dir"] / f"{Path(filename).stem}_manifest.json"
+    return manifest_path.stat().st_size if manifest_path.exists() else 0
+
+# queue the archive branches and run them on local worker processes
+def run_queue(cfg, project_root, kind=None):
+
+    '''
+    Returns ({status: count}, {failed task: last error}).
+    '''
+
+    import multiprocessing
+    from concurrent.futures import ThreadPoolExecutor
+    from src.pipeline import stages as pipeline_stages
+
+    pipeline_cfg = cfg.get("pipeline", {})
+    s = pipeline_stages.load_settings(cfg, project_root)
+    db_path = s["state_dir"] / "jobs" / pipeline_cfg.get("queue_filename", "jobs.sqlite")
+    workers = int(pipeline_cfg.get("queue_workers", 4))
+    options = {
+        "lease_s": float(pipeline_cfg.get("lease_s", 300)),
+        "max_attempts": int(pipeline_cfg.get("max_attempts", 3)),
+        "backoff_s": float(pipeline_cfg.get("retry_backoff_s", 5)),
+        "poll_s": float(pipeline_cfg.get("queue_poll_s", 1)),
+        "cache_path": s["state_dir"] / pipeline_cfg.get("cache_filename", "stage_cache.json"),
+    }
+
+    # one task per archive, largest first (sizes are fetched in parallel)
+    filenames = pipeline_stages.archive_filenames(s)
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        sizes = list(pool.map(lambda f: archive_priority(s, f), filenames))
+    enqueue(db_path, {Path(f).stem: size for f, size in zip(filenames, sizes)})
+    print(f"[QUEUE] {len(filenames)} archive tasks, {workers} workers (logs in {db_path.parent})")
+
+    # spawn, so the workers do not inherit the coordinator's threads and locks
+    ctx = multiprocessing.get_context("spawn")
+    procs = [
+        ctx.Process(target=worker_main, args=(db_path, cfg, project_root, kind, i, options))
+        for i in range(workers)
+    ]
+    start = time.time()
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+
+    # every worker died before the queue drained
+    counts, failed = summary(db_path)
+    if counts.get("pending") or counts.get("leased"):
+        print(f"[QUEUE] workers exited with {counts.get('pending', 0) + counts.get('leased', 0)} tasks unfinished")
+
+    print(f"[QUEUE] finished in {time.time() - start:.1f}s: " + ", ".join(f"{k}={v}" for k, v in sorted(counts.items())))
+    for name, error in failed.items():
+        print(f"[QUEUE] failed: {name}: {error}")
+
+    return counts, failed
@@ -0,0 +1,146 @@
+# sharded execution: archives are split across N nodes, each node runs its own archives
+# (download -> manifest -> plan -> extract -> validate -> label) and keeps its plan, labels,
+# ledgers and caches in its own shard directory; a coordinator merges the shards and splits.
+#
+# Archives are assigned by rendezvous (highest random weight) hashing of the archive name,
+# so the assignment does not depend on the archive order, and changing N only moves the
+# archives that land on the added (or removed) shards.
+
+# imports
+import os
+import sys
+import time
+import hashlib
+import subprocess
+from pathlib import Path
+
+# *******************************
+# Assignment
+# *******************************
+
+# parse "K/N" (0-based shard K of N)
+def parse_shard(text):
+
+    try:
+        shard, shards = (int(part) for part in str(text).split("/"))
+    except ValueError:
+        raise ValueError(f"Shard '{text}' is not of the form K/N (e.g. 0/4)")
+
+    if shards < 1 or not 0 <= shard < shards:
+        raise ValueError(f"Shard '{text}': K must be in 0..N-1")
+
+    return shard, shards
+
+# the shard an archive belongs to
+def shard_of(archive_name, shards):
+    weights = [
+        hashlib.sha256(f"{shard}:{archive_name}".encode()).digest()
+        for shard in range(shards)
+    ]
+    return max(range(shards), key=lambda shard: weights[shard])
+
+# keep only the archives of one shard
+def shard_archives(filenames, shard, shards):
+    return [f for f in filenames if shard_of(f, shards) == shard]
+
+# where one shard keeps its plan, labels, ledgers and caches
+def shard_dir(shards_dir, shard, shards):
+    return Path(shards_dir) / f"shard-{shard}-of-{shards}"
+
+# *******************************
+# Merge
+# *******************************
+
+# combine the shard stores into the global plan, ledgers, caches and labels
+def merge_shards(s):
+
+    import pandas as pd
+    from src.ingestion import label, dedup, sample
+    from src.utils.file_operations import load_json_cache, update_json_cache
+
+    shard_dirs = [shard_dir(s["shards_dir"], k, s["shards"]) for k in range(s["shards"])]
+
+    # every shard must have finished
+    missing = [d.name for d in shard_dirs if not (d / s["labels_file"].name).exists()]
+    if missing:
+        raise RuntimeError(f"{len(missing)} shard(s) have no labels yet: {', '.join(missing)}")
+
+    # plans
+    sampling_plan = {}
+    for d in shard_dirs:
+        sampling_plan.update(load_json_cache(d / s["plan_file"].name))
+    sample.save_sample_plan(sampling_plan, s["plan_file"], overwrite=True)
+
+    # ledgers and caches (keys are archive names or image paths, so shards never overlap)
+    for path, indent in [(s["ledger_path"], 2), (s["validation_path"], 2), (s["header_cache"], None), (s["hash_cache"], None)]:
+        updates = {}
+        for d in shard_dirs:
+            updates.update(load_json_cache(d / path.name))
+        if updates:
+            update_json_cache(updates, path, indent=indent)
+            print(f"[MERGE] {len(updates)} entries into {path.name}")
+
+    # labels, keeping only the rows of each shard's own archives (so no image is counted twice)
+    frames = []
+    for k, d in enumerate(shard_dirs):
+        shard_labels = label.merge_label_files([d / s["labels_file"].name])
+        if shard_labels.empty:
+            continue
+        own = shard_labels["archive_name"].map(lambda name: shard_of(f"{name}{s['archive_ext']}", s["shards"]) == k)
+        if not own.all():
+            print(f"[MERGE] {d.name}: dropped {int((~own).sum())} labels of archives from other shards")
+        frames.append(shard_labels[own])
+    labels_data = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+    # deduplicated across shards (hashes come from the merged cache)
+    if s["dedup"] and not labels_data.empty:
+        labels_data = dedup.dedup_labels(labels_data, s["sampled_dir"], perceptual=s["dedup_perceptual"],
+                                         workers=s["image_workers"], cache_path=s["hash_cache"], link_copies=s["dedup_link"])
+    print(f"[MERGE] {len(labels_data)} labels from {len(shard_dirs)} shards")
+    label.save_labels(labels_data, s["labels_file"])
+    return True
+
+# *******************************
+# Local nodes
+# *******************************
+
+# run `adver-etl <kind> --shard K/N` for every shard as local processes standing in for nodes
+def run_local_nodes(kind, shards, project_root, shards_dir, config_path=None, overrides=None, flags=None):
+
+    '''
+    overrides are --set values and flags extra command-line options, passed to every node.
+    Each node's output goes to node.log in its shard directory.
+    Returns {shard: exit code}.
+    '''
+
+    project_root = Path(project_root)
+    code_root = Path(__file__).resolve().parent.parent.parent
+
+    # make sure the nodes can import the package, wherever the project root is
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([str(code_root)] + [p for p in [env.get("PYTHONPATH")] if p])
+
+    procs = {}
+    for shard in range(shards):
+
+        cmd = [sys.executable, "-m", "src.cli", kind, "--root", str(project_root), "--shard", f"{shard}/{shards}"]
+        if config_path is not None:
+            cmd += ["--config", str(config_path)]
+        for override in overrides or []:
+            cmd += ["--set", override]
+        cmd += list(flags or [])
+
+        log_dir = shard_dir(shards_dir, shard, shards)
+        log_dir.mkdir(parents=True, exist_ok=True)
+        log = open(log_dir / "node.log", "w")
+        procs[shard] = (subprocess.Popen(cmd, cwd=project_root, env=env, stdout=log, stderr=subprocess.STDOUT), log, time.time())
+        print(f"[NODE] shard {shard}/{shards} started (log: {log_dir / 'node.log'})")
+
+    codes = {}
+    for shard, (proc, log, start) in procs.items():
+        codes[shard] = proc.wait()
+        log.close()
+        status = "ok" if codes[shard] == 0 else f"exit code {codes[shard]}"
+        print(f"[NODE] shard {shard}/{shards} finished in {time.time() - start:.1f}s ({status})")
+
+    return codes
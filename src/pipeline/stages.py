@@ -0,0 +1,702 @@
+# the Adver-City ETL as a stage graph:
+#   download -> manifest -> plan -> extract   (one branch per archive, run concurrently)
+#   plan (merge) -> validate -> label -> split (global)
+# with streaming on, validate and label also run per archive, and only split waits for every archive:
+#   download -> manifest -> plan -> extract -> validate -> label   (per archive)
+#   label (merge + dedup) -> split                                (global)
+# with sharding on, a node (shard K of N) only builds the branches of its own archives, up to label,
+# and a coordinator builds merge (all shards) -> split
+
+# imports
+import json
+import shutil
+from pathlib import Path
+from functools import partial
+from src.ingestion import download, archive, sample, extract, validate
+# label, dedup and split pull in pandas, so they are imported by the stage functions that use them
+# shards and jobs (sqlite3, socket, subprocess) are only imported when sharding or the queue executor is used
+from src.pipeline.dag import make_stage, run_dag, hash_json, select_stages
+from src.utils import profiling, disk_budget
+
+# config keys each stage depends on
+DOWNLOAD_KEYS = ["ingestion.url", "ingestion.max_size_GB"]
+MANIFEST_KEYS = ["ingestion.manifest_mode"]
+PLAN_KEYS = ["ingestion.camera", "ingestion.image_extension", "ingestion.frame_stride",
+             "ingestion.images_per_archive", "ingestion.sample_mode", "ingestion.clip_length",
+             "ingestion.clip_overlap", "ingestion.max_clips_per_archive", "ingestion.modalities",
+             "ingestion.modality_patterns", "catalog.query", "reproducibility.seed"]
+VALIDATE_KEYS = ["images.validate_mode"]
+ARCHIVE_LABEL_KEYS = ["labels.weather_decode_time", "labels.weather_decode_visibility",
+                      "ingestion.archive_extension", "ingestion.image_extension", "ingestion.modalities",
+                      "ingestion.modality_patterns", "images.validate", "images.scan_headers"]
+DEDUP_KEYS = ["images.dedup", "images.dedup_perceptual", "images.dedup_link_copies"]
+LABEL_KEYS = ARCHIVE_LABEL_KEYS + DEDUP_KEYS
+THUMBNAIL_KEYS = ["thumbnails.size"]
+CATALOG_KEYS = ["labels.weather_decode_time", "labels.weather_decode_visibility"]
+SPLIT_KEYS = ["splits.train", "splits.val", "splits.test", "reproducibility.seed", "images.dedup", "ingestion.sample_mode"]
+
+# *******************************
+# Stage functions
+# *******************************
+
+# download one archive
+def run_download(s, filename):
+    downloaded = download.download_with_config(
+        s["ingestion_cfg"],
+        base_url=s["base_url"],
+        destinations_dir=s["raw_dir"],
+        filenames=[filename],
+        timeout=60,
+        max_size_GB=s["max_gb"],
+        overwrite=s["overwrite"],
+        budget=s["budget"]
+    )
+    # nothing downloaded (e.g. too big): stop this branch
+    return bool(downloaded)
+
+# (re)build the manifest for one archive
+def run_manifest(s, filename, manifest_path):
+    raw_path = s["raw_dir"] / filename
+
+    # the raw archive may have been cleaned up, in which case keep the manifest we have
+    if not raw_path.exists():
+        print(f"[SKIP] {filename} not on disk, keeping {manifest_path.name}")
+        return manifest_path.exists()
+
+    # the stage is stale, so re-index rather than reuse the cached manifest
+    if manifest_path.exists():
+        manifest_path.unlink()
+    archive.build_manifest(raw_path, s["index_dir"], mode=s["manifest_mode"])
+    return True
+
+# the members of one archive that are candidates for its plan: the manifest, narrowed by the
+# catalog query if there is one (the filtering is pushed down to the catalog)
+def plan_candidates(s, filename, manifest_path):
+
+    if not s["query"]:
+        return json.loads(manifest_path.read_text())
+
+    from src.ingestion import catalog
+    return catalog.query_manifest(s["catalog_path"], filename, manifest_path, s["query"],
+                                  s["decode_time"], s["decode_vis"], s["archive_ext"])
+
+# build the sampling plan for one archive
+def run_plan(s, filename, manifest_path, plan_path):
+    manifest = plan_candidates(s, filename, manifest_path)
+    plan_path.parent.mkdir(parents=True, exist_ok=True)
+
+    # temporal clips: keep the clips next to the plan, for the clip table
+    if s["sample_mode"] == "clips":
+        plan, clips = sample.build_clip_plan(
+            {filename: manifest},
+            CAMERA=s["camera"],
+            IMG_EXT=s["img_ext"],
+            STRIDE=s["stride"],
+            CLIP_LEN=s["clip_len"],
+            CLIP_OVERLAP=s["clip_overlap"],
+            MAX_CLIPS=s["max_clips"],
+            SEED=s["seed"],
+            MODALITIES=s["modalities"],
+            MODALITY_PATTERNS=s["modality_patterns"]
+        )
+        clips_path(s, filename).write_text(json.dumps(clips[filename], indent=2))
+
+    else:
+        # whole frames are sampled from the precomputed frame groups (built from the candidates, with a query)
+        groups = None
+        if s["sample_mode"] == "groups" and s["query"]:
+            groups = {filename: sample.build_frame_groups(manifest, img_ext=s["img_ext"])}
+        elif s["sample_mode"] == "groups":
+            groups = {filename: sample.load_frame_groups(manifest_path, img_ext=s["img_ext"], manifest=manifest)}
+
+        plan = sample.build_sample_plan(
+            {filename: manifest},
+            CAMERA=s["camera"],
+            IMG_EXT=s["img_ext"],
+            STRIDE=s["stride"],
+            MAX_IMGS=s["max_imgs"],
+            SEED=s["seed"],
+            MODE=s["sample_mode"],
+            GROUPS=groups,
+            MODALITIES=s["modalities"],
+            MODALITY_PATTERNS=s["modality_patterns"]
+        )
+
+    # a changed plan only needs its added files extracted; the files it dropped are deleted
+    if plan_path.exists():
+        diff = sample.plan_diff({filename: json.loads(plan_path.read_text())}, plan)
+        sample.print_plan_diff(diff)
+        if s["prune_removed"]:
+            sample.prune_removed(diff, s["sampled_dir"])
+
+    plan_path.write_text(json.dumps(plan[filename], indent=2))
+    return True
+
+# extract the planned files for one archive
+def run_extract(s, filename, plan_path):
+    file_list = json.loads(plan_path.read_text())
+
+    # nothing missing, just record it
+    if s["overwrite"] or not extract.all_files_exist_for_archive(file_list, s["sampled_dir"]):
+
+        # wait for room under the disk budget, if there is one
+        need = disk_budget.extraction_bytes(s["budget"], s["raw_dir"] / filename, file_list, s["sampled_dir"]) if s["budget"] else 0
+        with disk_budget.admitted(s["budget"], f"extract:{filename}", need, archive_name=filename) as ok:
+            if not ok:
+                raise RuntimeError(f"{filename} does not fit in the disk budget")
+            to_extract = file_list if s["overwrite"] else extract.missing_files(file_list, s["sampled_dir"])
+            result = extract.extract_selected(s["raw_dir"] / filename, to_extract, s["sampled_dir"], overwrite=s["overwrite"])
+        if result["errors"]:
+            raise RuntimeError(result.get("error_msg", "Unknown error"))
+        print(f"  [SUCCESS] {filename}: extracted {result['extracted']} files")
+
+        if s["cleanup_raw"]:
+            (s["raw_dir"] / filename).unlink()
+            print(f"  [CLEANUP] Deleted raw archive: {filename}")
+
+    extract.record_extraction(s["ledger_path"], filename, file_list)
+    return True
+
+# the clips sampled from one archive
+def clips_path(s, filename):
+    return s["plans_dir"] / f"{Path(filename).stem}_clips.json"
+
+# merge the per-archive plans into the global sampling plan (and the clips into the clip table)
+def run_plan_merge(s, plan_paths):
+    sampling_plan = {}
+    for filename, plan_path in plan_paths.items():
+        if plan_path.exists():
+            sampling_plan[filename] = json.loads(plan_path.read_text())
+    print(f" Total images to extract: {sum(len(v) for v in sampling_plan.values())}")
+    sample.save_sample_plan(sampling_plan, s["plan_file"], overwrite=True)
+
+    if s["sample_mode"] == "clips":
+        archive_clips = {f: json.loads(clips_path(s, f).read_text()) for f in sampling_plan if clips_path(s, f).exists()}
+        sample.save_clip_table(archive_clips, s["clips_file"])
+    elif s["clips_file"].exists():
+        # the plan is no longer made of clips
+        s["clips_file"].unlink()
+    return True
+
+# the archives a node validates and labels (None: everything in sampled_dir)
+def node_archives(s):
+    if s["shards"] > 1 and s["shard"] is not None:
+        return archive_filenames(s)
+    return None
+
+# validate everything in the sampling plan
+def run_validate(s):
+    validate.validate_sample_plan(
+        sample_plan_file=s["plan_file"],
+        sampled_dir=s["sampled_dir"],
+        index_dir=s["index_dir"],
+        mode=s["validate_mode"],
+        workers=s["image_workers"],
+        validation_path=s["validation_path"],
+        archives=node_archives(s)
+    )
+    return True
+
+# validate the planned files of one archive
+def run_archive_validate(s, filename, plan_path):
+    validate.validate_images(
+        sampled_dir=s["sampled_dir"],
+        rel_paths=json.loads(plan_path.read_text()),
+        mode=s["validate_mode"],
+        workers=s["image_workers"],
+        validation_path=s["validation_path"],
+        member_crcs=archive.load_member_crcs(filename, s["index_dir"])
+    )
+    return True
+
+# label the images of one archive
+def run_archive_label(s, filename, labels_path):
+    from src.ingestion import label
+    labels_data = label.build_archive_labels_df(
+        archive_dir=s["sampled_dir"] / Path(filename).stem,
+        sampled_dir=s["sampled_dir"],
+        decode_time=s["decode_time"],
+        decode_vis=s["decode_vis"],
+        archive_ext=s["archive_ext"],
+        img_ext=s["img_ext"],
+        invalid=validate.load_invalid(s["validation_path"]) if s["validate"] else None,
+        modalities=s["modalities"],
+        modality_patterns=s["modality_patterns"]
+    )
+    if s["scan_headers"] and not labels_data.empty:
+        labels_data = label.add_image_headers(labels_data, s["sampled_dir"], workers=s["image_workers"], cache_path=s["header_cache"])
+
+    labels_path.parent.mkdir(parents=True, exist_ok=True)
+    if labels_data.empty:
+        labels_path.write_text("")
+    else:
+        labels_data.to_csv(labels_path, index=False)
+    print(f"[SAVE] {len(labels_data)} labels for {filename} saved to {labels_path.name}")
+    return True
+
+# merge the per-archive labels, dedup across archives, and save the global labels
+def run_label_merge(s, label_paths):
+    from src.ingestion import label, dedup
+    labels_data = label.merge_label_files(label_paths)
+    if s["dedup"] and not labels_data.empty:
+        labels_data = dedup.dedup_labels(labels_data, s["sampled_dir"], perceptual=s["dedup_perceptual"],
+                                         workers=s["image_workers"], cache_path=s["hash_cache"], link_copies=s["dedup_link"])
+    label.save_labels(labels_data, s["labels_file"])
+    return True
+
+# build (and optionally enrich) the labels
+def run_label(s):
+    from src.ingestion import label, dedup
+    labels_data = label.build_labels_df(
+        sampled_dir=s["sampled_dir"],
+        decode_time=s["decode_time"],
+        decode_vis=s["decode_vis"],
+        archive_ext=s["archive_ext"],
+        img_ext=s["img_ext"],
+        invalid=validate.load_invalid(s["validation_path"]) if s["validate"] else None,
+        modalities=s["modalities"],
+        modality_patterns=s["modality_patterns"],
+        archives=node_archives(s)
+    )
+    if s["scan_headers"]:
+        labels_data = label.add_image_headers(labels_data, s["sampled_dir"], workers=s["image_workers"], cache_path=s["header_cache"])
+    if s["dedup"]:
+        labels_data = dedup.dedup_labels(labels_data, s["sampled_dir"], perceptual=s["dedup_perceptual"],
+                                         workers=s["image_workers"], cache_path=s["hash_cache"], link_copies=s["dedup_link"])
+    label.save_labels(labels_data, s["labels_file"])
+    return True
+
+# thumbnails of the labelled images, for browsing them in notebooks
+def run_thumbnails(s):
+    from src.utils import thumbnails
+    thumbnails.build_label_thumbnails(s["labels_file"], s["sampled_dir"], s["thumbnails_dir"],
+                                      size=s["thumbnail_size"], workers=s["image_workers"])
+    return True
+
+# bring the catalog up to date with the manifests, plan, ledger and labels of this run
+def run_catalog(s, filenames):
+    from src.ingestion import catalog
+    catalog.sync_catalog(s["catalog_path"], filenames, s["index_dir"], s["plan_file"], s["ledger_path"], s["labels_file"],
+                         s["decode_time"], s["decode_vis"], s["archive_ext"])
+    return True
+
+# rebuild the train/val/test sets
+def run_split(s):
+    from src.ingestion import split
+    splits = split.split_labels(
+        labels_path=s["labels_file"],
+        train_ratio=s["train"],
+        val_ratio=s["val"],
+        test_ratio=s["test"],
+        seed=s["seed"],
+        group_col=split.group_column(s["dedup"], s["sample_mode"])
+    )
+
+    # the stage is stale, so replace any splits built from older labels
+    for split_name in splits:
+        split_dir = s["ready_dir"] / split_name
+        if split_dir.exists():
+            shutil.rmtree(split_dir)
+
+    # the split copies must fit under the disk budget, if there is one
+    need = 0
+    if s["budget"] is not None:
+        for split_data in splits.values():
+            for column in split.path_columns(split_data.columns):
+                for rel_path in split_data[column].dropna():
+                    path = s["sampled_dir"] / rel_path
+                    need += path.stat().st_size if path.exists() else 0
+
+    with disk_budget.admitted(s["budget"], "split", need) as ok:
+        if not ok:
+            raise RuntimeError("the splits do not fit in the disk budget")
+        split.build_splits(
+            splits=splits,
+            sampled_dir=s["sampled_dir"],
+            ready_dir=s["ready_dir"],
+            cleanup_sampled=s["cleanup_sampled"],
+            overwrite=True
+        )
+    return True
+
+# *******************************
+# Fingerprints and requirements
+# *******************************
+
+# an extraction is described by its plan and whether all planned files are present
+def extract_fingerprint(s, plan_path):
+    if not plan_path.exists():
+        return None
+    file_list = json.loads(plan_path.read_text())
+    missing = sum(1 for f in file_list if not (s["sampled_dir"] / f).exists())
+    return {"plan": hash_json(sorted(file_list)), "missing": missing}
+
+# a per-archive validation is described by the ledger entries of its planned files
+def validation_fingerprint(s, plan_path):
+    if not plan_path.exists():
+        return None
+    ledger = validate.load_validation(s["validation_path"])
+    entries = [ledger.get(f) for f in sorted(json.loads(plan_path.read_text()))]
+    return hash_json(entries)
+
+# the catalog is described by the fingerprints of the files loaded into it
+def catalog_fingerprint(s):
+    from src.ingestion import catalog
+    return catalog.source_fingerprints(s["catalog_path"])
+
+# the manifest only needs the raw archive if there is no manifest yet
+def manifest_requires(download_name, manifest_path):
+    return [] if manifest_path.exists() else [download_name]
+
+# extraction only needs the raw archive if some planned files are missing
+def extract_requires(s, download_name, plan_path):
+    if s["overwrite"] or not plan_path.exists():
+        return [download_name]
+    file_list = json.loads(plan_path.read_text())
+    if all((s["sampled_dir"] / f).exists() for f in file_list):
+        return []
+    return [download_name]
+
+# *******************************
+# Graph
+# *******************************
+
+# pull the settings the stages need out of the config
+def load_settings(cfg, project_root):
+
+    project_root = Path(project_root)
+    labels_cfg = cfg["labels"]
+    images_cfg = cfg.get("images", {})
+    sharding_cfg = cfg.get("sharding", {})
+    index_dir = project_root / cfg["data_paths"]["index"]
+
+    s = {
+        "raw_dir": project_root / cfg["data_paths"]["raw"],
+        "index_dir": index_dir,
+        "sampled_dir": project_root / cfg["data_paths"]["sampled"],
+        "ready_dir": project_root / cfg["data_paths"]["ready"],
+        "plans_dir": index_dir / "plans",
+        "archive_labels_dir": index_dir / "labels",
+        "streaming": cfg.get("pipeline", {}).get("streaming", False),
+        "plan_file": index_dir / cfg["sampling"]["plan_filename"],
+        "labels_file": index_dir / cfg["sampling"]["labels_filename"],
+        "clips_file": index_dir / cfg["sampling"].get("clips_filename", "clips.csv"),
+        "ledger_path": index_dir / cfg.get("pipeline", {}).get("ledger_filename", "extract_ledger.json"),
+        "base_url": cfg["ingestion"]["url"],
+        "ingestion_cfg": cfg["ingestion"],
+        "archive_ext": cfg["ingestion"]["archive_extension"],
+        "manifest_mode": cfg["ingestion"]["manifest_mode"],
+        "max_gb": float(cfg["ingestion"]["max_size_GB"]),
+        "max_imgs": int(cfg["ingestion"]["images_per_archive"]),
+        "stride": int(cfg["ingestion"]["frame_stride"]),
+        "sample_mode": cfg["ingestion"].get("sample_mode", "images"),
+        "clip_len": int(cfg["ingestion"].get("clip_length", 8)),
+        "clip_overlap": int(cfg["ingestion"].get("clip_overlap", 0)),
+        "camera": cfg["ingestion"].get("camera", None),
+        "modalities": cfg["ingestion"].get("modalities", None),
+        "modality_patterns": cfg["ingestion"].get("modality_patterns", None),
+        "img_ext": cfg["ingestion"]["image_extension"],
+        "seed": int(cfg["reproducibility"]["seed"]),
+        "overwrite": cfg["sampling"]["overwrite"],
+        "cleanup_raw": cfg["sampling"].get("cleanup_raw_after_extract", False),
+        "prune_removed": cfg["sampling"].get("prune_removed", True),
+        "cleanup_sampled": cfg["splits"].get("cleanup_sampled_after_split", False),
+        "train": cfg["splits"]["train"],
+        "val": cfg["splits"]["val"],
+        "test": cfg["splits"]["test"],
+        "decode_time": labels_cfg["weather_decode_time"],
+        "decode_vis": labels_cfg["weather_decode_visibility"],
+        "valid_prefix": set(labels_cfg["valid_prefix"]),
+        "valid_weather": set(labels_cfg["valid_weather"]),
+        "valid_density": set(labels_cfg["valid_density"]),
+        "choose_prefix": labels_cfg.get("choose_prefix", labels_cfg["valid_prefix"]),
+        "choose_weather": labels_cfg.get("choose_weather", labels_cfg["valid_weather"]),
+        "choose_density": labels_cfg.get("choose_density", labels_cfg["valid_density"]),
+        "image_workers": int(images_cfg.get("workers", 8)),
+        "thumbnails": cfg.get("thumbnails", {}).get("enabled", False),
+        "thumbnail_size": int(cfg.get("thumbnails", {}).get("size", 256)),
+        "thumbnails_dir": index_dir / cfg.get("thumbnails", {}).get("dirname", "thumbnails"),
+        "catalog": cfg.get("catalog", {}).get("enabled", False),
+        "catalog_path": index_dir / cfg.get("catalog", {}).get("filename", "catalog.sqlite"),
+        "query": cfg.get("catalog", {}).get("query") or {},
+        "scan_headers": images_cfg.get("scan_headers", False),
+        "header_cache": index_dir / images_cfg.get("header_cache_filename", "image_headers.json"),
+        "validate": images_cfg.get("validate", False),
+        "validate_mode": images_cfg.get("validate_mode", "crc"),
+        "validation_path": index_dir / images_cfg.get("validation_filename", "image_validation.json"),
+        "dedup": images_cfg.get("dedup", False),
+        "dedup_perceptual": images_cfg.get("dedup_perceptual", False),
+        "dedup_link": images_cfg.get("dedup_link_copies", False),
+        "hash_cache": index_dir / images_cfg.get("hash_cache_filename", "image_hashes.json"),
+        "shards": int(sharding_cfg.get("shards", 1)),
+        "shard": sharding_cfg.get("shard"),
+        "shards_dir": index_dir / sharding_cfg.get("dirname", "shards"),
+        "state_dir": index_dir,
+    }
+
+    # clips per archive: as set, else as many as images_per_archive allows
+    max_clips = cfg["ingestion"].get("max_clips_per_archive", None)
+    s["max_clips"] = int(max_clips) if max_clips is not None else max(1, s["max_imgs"] // s["clip_len"])
+
+    # a node keeps its plan, labels, ledgers and caches (and stage cache) in its shard directory
+    if s["shards"] > 1 and s["shard"] is not None:
+        from src.pipeline import shards
+        s["state_dir"] = shards.shard_dir(s["shards_dir"], int(s["shard"]), s["shards"])
+        for key in ["plan_file", "labels_file", "clips_file", "ledger_path", "validation_path", "header_cache", "hash_cache",
+                    "catalog_path"]:
+            s[key] = s["state_dir"] / s[key].name
+
+    # one disk budget for raw, sampled and ready (shared by every node and worker on this disk)
+    s["budget"] = disk_budget.make_budget(cfg, project_root, s["ledger_path"], s["plan_file"], plans_dir=s["plans_dir"])
+
+    return s
+
+# the archives to process (only this node's, when sharded)
+def archive_filenames(s):
+
+    filenames = download.build_filenames(
+        s["choose_prefix"], s["choose_weather"], s["choose_density"],
+        s["valid_prefix"], s["valid_weather"], s["valid_density"],
+        s["archive_ext"]
+    )
+
+    # the archive-level part of the query (e.g. time, visibility) is answered before anything is downloaded
+    if s["query"]:
+        from src.ingestion import catalog
+        if catalog.archive_query(s["query"]):
+            filenames = catalog.filter_archives(s["catalog_path"], filenames, s["query"],
+                                                s["decode_time"], s["decode_vis"], s["archive_ext"])
+
+    if s["shards"] > 1 and s["shard"] is not None:
+        from src.pipeline import shards
+        filenames = shards.shard_archives(filenames, int(s["shard"]), s["shards"])
+
+    return filenames
+
+# the coordinator graph: merge the shard stores, then split
+def build_coordinator_stages(s):
+
+    from src.pipeline import shards
+
+    shard_labels = [shards.shard_dir(s["shards_dir"], k, s["shards"]) / s["labels_file"].name for k in range(s["shards"])]
+
+    return [
+        make_stage(
+            "merge", partial(shards.merge_shards, s),
+            inputs=shard_labels,
+            outputs=[s["labels_file"], s["plan_file"]],
+            config_keys=DEDUP_KEYS
+        ),
+        make_stage(
+            "split", partial(run_split, s),
+            deps=["merge"],
+            outputs=[s["ready_dir"] / f"{name}_labels.csv" for name in ["train", "val", "test"]],
+            config_keys=SPLIT_KEYS
+        ),
+    ]
+
+# build the stage graph for the configured archives
+def build_stages(cfg, project_root):
+
+    s = load_settings(cfg, project_root)
+
+    # sharded, but not a node: merge and split only
+    if s["shards"] > 1 and s["shard"] is None:
+        return build_coordinator_stages(s)
+
+    filenames = archive_filenames(s)
+
+    stages = []
+    plan_paths = {}
+    extract_names = []
+    archive_label_paths = []
+    archive_label_names = []
+
+    # one branch per archive
+    for filename in filenames:
+
+        stem = Path(filename).stem
+        manifest_path = s["index_dir"] / f"{stem}_manifest.json"
+        plan_path = s["plans_dir"] / f"{stem}_plan.json"
+        plan_paths[filename] = plan_path
+
+        download_name = f"download:{stem}"
+        manifest_name = f"manifest:{stem}"
+        plan_name = f"plan:{stem}"
+        extract_name = f"extract:{stem}"
+        extract_names.append(extract_name)
+
+        stages.append(make_stage(
+            download_name, partial(run_download, s, filename),
+            outputs=[s["raw_dir"] / filename],
+            config_keys=DOWNLOAD_KEYS,
+            ephemeral=True
+        ))
+        stages.append(make_stage(
+            manifest_name, partial(run_manifest, s, filename, manifest_path),
+            deps=[download_name],
+            outputs=[manifest_path],
+            config_keys=MANIFEST_KEYS,
+            requires=partial(manifest_requires, download_name, manifest_path)
+        ))
+        stages.append(make_stage(
+            plan_name, partial(run_plan, s, filename, manifest_path, plan_path),
+            deps=[manifest_name],
+            outputs=[plan_path],
+            config_keys=PLAN_KEYS
+        ))
+        stages.append(make_stage(
+            extract_name, partial(run_extract, s, filename, plan_path),
+            deps=[plan_name, download_name],
+            config_keys=[],
+            requires=partial(extract_requires, s, download_name, plan_path),
+            fingerprint=partial(extract_fingerprint, s, plan_path)
+        ))
+
+        # streaming: carry on to validation and labelling without waiting for other archives
+        if s["streaming"]:
+
+            label_deps = [extract_name]
+            if s["validate"]:
+                validate_name = f"validate:{stem}"
+                stages.append(make_stage(
+                    validate_name, partial(run_archive_validate, s, filename, plan_path),
+                    deps=[extract_name, plan_name],
+                    config_keys=VALIDATE_KEYS,
+                    fingerprint=partial(validation_fingerprint, s, plan_path)
+                ))
+                label_deps = [validate_name]
+
+            labels_path = s["archive_labels_dir"] / f"{stem}_labels.csv"
+            archive_label_paths.append(labels_path)
+            archive_label_names.append(f"label:{stem}")
+            stages.append(make_stage(
+                f"label:{stem}", partial(run_archive_label, s, filename, labels_path),
+                deps=label_deps,
+                outputs=[labels_path],
+                config_keys=ARCHIVE_LABEL_KEYS
+            ))
+
+    # global stages
+    stages.append(make_stage(
+        "plan", partial(run_plan_merge, s, plan_paths),
+        deps=[f"plan:{Path(f).stem}" for f in filenames],
+        outputs=[s["plan_file"]],
+        partial=True
+    ))
+
+    if s["streaming"]:
+
+        # labels were built per archive, just merge them
+        stages.append(make_stage(
+            "label", partial(run_label_merge, s, archive_label_paths),
+            deps=archive_label_names,
+            outputs=[s["labels_file"]],
+            config_keys=DEDUP_KEYS,
+            partial=True
+        ))
+
+    else:
+
+        # validate and label every archive at once
+        label_deps = extract_names + ["plan"]
+        if s["validate"]:
+            stages.append(make_stage(
+                "validate", partial(run_validate, s),
+                deps=extract_names + ["plan"],
+                outputs=[s["validation_path"]],
+                config_keys=VALIDATE_KEYS,
+                partial=True
+            ))
+            label_deps = ["validate"]
+
+        stages.append(make_stage(
+            "label", partial(run_label, s),
+            deps=label_deps,
+            outputs=[s["labels_file"]],
+            config_keys=LABEL_KEYS,
+            partial=True
+        ))
+
+    # thumbnails are made before the split, which may clean up the sampled images
+    split_deps = ["label"]
+    if s["thumbnails"]:
+        stages.append(make_stage(
+            "thumbnails", partial(run_thumbnails, s),
+            deps=["label"],
+            outputs=[s["thumbnails_dir"] / "thumbnails.json"],
+            config_keys=THUMBNAIL_KEYS
+        ))
+        split_deps.append("thumbnails")
+
+    # the catalog is refreshed once the labels are in
+    if s["catalog"]:
+        stages.append(make_stage(
+            "catalog", partial(run_catalog, s, filenames),
+            deps=["plan", "label"],
+            config_keys=CATALOG_KEYS,
+            fingerprint=partial(catalog_fingerprint, s)
+        ))
+
+    # a node stops at its labels, the coordinator splits
+    if s["shards"] > 1:
+        return stages
+
+    stages.append(make_stage(
+        "split", partial(run_split, s),
+        deps=split_deps,
+        outputs=[s["ready_dir"] / f"{name}_labels.csv" for name in ["train", "val", "test"]],
+        config_keys=SPLIT_KEYS
+    ))
+
+    return stages
+
+# run the pipeline as a stage graph (only the stages of one kind and their upstream stages, if given)
+def run_pipeline(cfg, project_root, kind=None):
+
+    pipeline_cfg = cfg.get("pipeline", {})
+    s = load_settings(cfg, project_root)
+    state_dir = s["state_dir"]
+
+    stages = build_stages(cfg, project_root)
+    if kind is not None:
+        stages = select_stages(stages, kind)
+        if not stages:
+            raise ValueError(f"No '{kind}' stages in the graph (check the config, e.g. images.validate)")
+    print(f"Built {len(stages)} stages\n")
+
+    # queue executor: the archive branches run on local worker processes first, so the
+    # graph below finds them up to date and only runs the global stages
+    queued = False
+    if pipeline_cfg.get("executor", "threads") == "queue":
+        from src.pipeline import jobs
+        queued = bool(jobs.archive_branches(stages))
+    if queued:
+        jobs.run_queue(cfg, project_root, kind=kind)
+
+    # profile the selected stage(s), if any
+    profiling.wrap_stages(stages)
+
+    # one async download engine for the run, that the download stages feed; the archives that will
+    # surely be downloaded (no raw file, no manifest) have their sizes probed up front
+    download_stems = {stage["name"].split(":", 1)[1] for stage in stages if stage["name"].startswith("download:")}
+    if download_stems:
+        probe = [f for f in archive_filenames(s) if Path(f).stem in download_stems
+                 and not (s["index_dir"] / f"{Path(f).stem}_manifest.json").exists()]
+        download.start_engine(s["ingestion_cfg"], s["base_url"], s["raw_dir"], probe, timeout=60,
+                              max_size_GB=s["max_gb"], overwrite=s["overwrite"], budget=s["budget"])
+
+    try:
+        status = run_dag(
+            stages,
+            cfg,
+            cache_path=state_dir / pipeline_cfg.get("cache_filename", "stage_cache.json"),
+            workers=int(pipeline_cfg.get("workers", 4)),
+            force=cfg["sampling"]["overwrite"] and not queued,
+            report_path=state_dir / pipeline_cfg.get("report_filename", "stage_timing.json")
+        )
+    finally:
+        download.stop_engine()
+    disk_budget.print_usage(s["budget"])
+
+    return status
@@ -0,0 +1,320 @@
+# a global disk budget over data/raw, data/sampled and data/ready
+#
+# A download or an extraction asks for the bytes it is about to write (admit). It goes ahead when
+# what is on disk, plus what other admitted operations are still writing, plus its own bytes fit
+# in disk_budget.max_GB (and leave disk_budget.min_free_GB free on the device). If not, raw archives
+# whose current plan is fully extracted (per the extraction ledger) are deleted, least recently
+# extracted first; if that is still not enough, it waits for the other operations to finish, and
+# gives up after disk_budget.wait_s. Admissions are recorded in a small JSON file under a file lock,
+# so threads, queue workers and local shard nodes all share one budget. The same file keeps a running
+# total of the bytes on disk: it is updated on release (the reserved bytes were written) and eviction,
+# and the directories are only walked again, outside the lock, once it is older than
+# disk_budget.usage_refresh_s (which also corrects for files deleted by other means).
+
+# imports
+import os
+import json
+import time
+import shutil
+import socket
+import threading
+import contextlib
+from pathlib import Path
+from src.utils.file_operations import file_lock, write_atomic, load_json_cache
+
+# serialise admissions between the threads of one process (the file lock covers the processes)
+_budget_lock = threading.Lock()
+
+# *******************************
+# Setup
+# *******************************
+
+# the budget for a project (None if disk_budget.max_GB and disk_budget.min_free_GB are both unset)
+def make_budget(cfg, project_root, ledger_path, plan_file, plans_dir=None):
+
+    budget_cfg = cfg.get("disk_budget", {})
+    max_gb = budget_cfg.get("max_GB", None)
+    min_free_gb = budget_cfg.get("min_free_GB", None)
+    if max_gb is None and min_free_gb is None:
+        return None
+
+    project_root = Path(project_root)
+    index_dir = project_root / cfg["data_paths"]["index"]
+
+    return {
+        "max_B": None if max_gb is None else int(float(max_gb) * 1024 ** 3),
+        "min_free_B": None if min_free_gb is None else int(float(min_free_gb) * 1024 ** 3),
+        "dirs": {key: project_root / cfg["data_paths"][key] for key in ["raw", "sampled", "ready"]},
+        "raw_dir": project_root / cfg["data_paths"]["raw"],
+        "index_dir": index_dir,
+        "ledger_path": Path(ledger_path),
+        "plan_file": Path(plan_file),
+        "plans_dir": Path(plans_dir) if plans_dir is not None else None,
+        "state_path": index_dir / budget_cfg.get("state_filename", "disk_budget.json"),
+        "evict_raw": budget_cfg.get("evict_raw", True),
+        "wait_s": float(budget_cfg.get("wait_s", 600)),
+        "poll_s": float(budget_cfg.get("poll_s", 2)),
+        "usage_refresh_s": float(budget_cfg.get("usage_refresh_s", 60)),
+    }
+
+# *******************************
+# Usage
+# *******************************
+
+# bytes under a directory (hard links, e.g. deduplicated copies, are counted once)
+def directory_bytes(path, seen=None):
+
+    seen = set() if seen is None else seen
+    total = 0
+    try:
+        entries = list(os.scandir(path))
+    except FileNotFoundError:
+        return 0
+
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            total += directory_bytes(entry.path, seen)
+        elif entry.is_file(follow_symlinks=False):
+            stat = entry.stat(follow_symlinks=False)
+            if (stat.st_dev, stat.st_ino) not in seen:
+                seen.add((stat.st_dev, stat.st_ino))
+                total += stat.st_size
+
+    return total
+
+# bytes in each budgeted directory
+def usage(budget):
+    seen = set()
+    return {key: directory_bytes(path, seen) for key, path in budget["dirs"].items()}
+
+# bytes the planned files of an archive will take once extracted (those not on disk yet)
+def extraction_bytes(budget, archive_path, file_list, sampled_dir):
+
+    missing = [f for f in file_list if not (Path(sampled_dir) / f).exists()]
+    if not missing:
+        return 0
+
+    archive_path = Path(archive_path)
+    archive_size = archive_path.stat().st_size if archive_path.exists() else 0
+    manifest = load_json_cache(budget["index_dir"] / f"{archive_path.stem}_manifest.json") or []
+
+    # exact with a verbose manifest, otherwise the archive's share (images hardly compress)
+    member_sizes = {f["Path"]: int(f.get("Size") or 0) for f in manifest if isinstance(f, dict)}
+    if member_sizes:
+        return sum(member_sizes.get(f, 0) for f in missing)
+    if manifest:
+        return int(archive_size * len(missing) / len(manifest))
+    return archive_size
+
+# *******************************
+# Reservations
+# *******************************
+
+# the shared state: {"reservations": {key: reservation}, "usage": {"bytes", "at"}}
+def _load_state(budget):
+    state = load_json_cache(budget["state_path"])
+    if "reservations" not in state:
+        # older state files held the reservations only
+        state = {"reservations": state}
+    return state
+
+def _save_state(budget, state):
+    write_atomic(budget["state_path"], json.dumps(state, indent=2))
+
+# the running total of bytes on disk (None if there is none, or it is due for a fresh scan)
+def _cached_usage(budget, state):
+    cached = state.get("usage")
+    if cached is None or time.time() - cached["at"] > budget["usage_refresh_s"]:
+        return None
+    return cached["bytes"]
+
+# reservations of processes that are still running
+def _live_reservations(reservations):
+
+    host = socket.gethostname()
+    live = {}
+    for key, r in reservations.items():
+        if r.get("host") == host:
+            try:
+                os.kill(r["pid"], 0)
+            except ProcessLookupError:
+                continue
+            except PermissionError:
+                pass
+        live[key] = r
+    return live
+
+# *******************************
+# Eviction
+# *******************************
+
+# the current plan of an archive (per-archive plan file in the stage graph, else the global plan)
+def plan_for(budget, archive_name):
+
+    if budget["plans_dir"] is not None:
+        plan_path = budget["plans_dir"] / f"{Path(archive_name).stem}_plan.json"
+        if plan_path.exists():
+            return json.loads(plan_path.read_text())
+
+    return load_json_cache(budget["plan_file"]).get(archive_name)
+
+# raw archives that can go: their current plan is fully extracted, least recently extracted first
+def eviction_candidates(budget, in_use=()):
+
+    from src.ingestion import extract
+
+    ledger = extract.load_ledger(budget["ledger_path"])
+    candidates = []
+    for archive_name, entry in ledger.items():
+
+        raw_path = budget["raw_dir"] / archive_name
+        if archive_name in in_use or not raw_path.exists():
+            continue
+
+        # the ledger must cover the plan the archive has now
+        file_list = plan_for(budget, archive_name)
+        if file_list is None or entry.get("plan_hash") != extract.plan_hash(file_list):
+            continue
+
+        candidates.append((entry.get("extracted_at", ""), archive_name, raw_path))
+
+    return [(name, path) for _, name, path in sorted(candidates)]
+
+# delete raw archives until `needed` bytes are freed (none if they cannot free that much), returns the bytes freed
+def evict(budget, needed, in_use=()):
+
+    candidates = eviction_candidates(budget, in_use)
+
+    # evicting is pointless if it cannot free enough
+    if sum(raw_path.stat().st_size for _, raw_path in candidates) < needed:
+        return 0
+
+    freed = 0
+    for archive_name, raw_path in candidates:
+        if freed >= needed:
+            break
+        try:
+            size = raw_path.stat().st_size
+            raw_path.unlink()
+        except FileNotFoundError:
+            continue
+        freed += size
+        print(f"[BUDGET] Evicted raw archive {archive_name} ({size / 1024 ** 2:.1f} MB, plan fully extracted)")
+
+    return freed
+
+# *******************************
+# Admission
+# *******************************
+
+# bytes over the budget if `nbytes` more were written now, with `used` bytes on disk (0 if it fits)
+def _overflow(budget, used, nbytes, reservations):
+
+    reserved = sum(r["bytes"] for r in reservations.values())
+    over = 0
+
+    if budget["max_B"] is not None:
+        over = max(over, used + reserved + nbytes - budget["max_B"])
+
+    if budget["min_free_B"] is not None:
+        free = shutil.disk_usage(budget["raw_dir"] if budget["raw_dir"].exists() else budget["state_path"].parent).free
+        over = max(over, budget["min_free_B"] + reserved + nbytes - free)
+
+    return over
+
+# try to reserve nbytes for `key` (e.g. "download:ri_cn_s.7z"), evicting and waiting if needed
+def admit(budget, key, nbytes, archive_name=None):
+
+    '''
+    Returns True once the bytes are reserved (release them with release()),
+    False if they do not fit even after eviction and waiting.
+    '''
+
+    if budget is None:
+        return True
+
+    nbytes = int(nbytes or 0)
+    deadline = time.time() + budget["wait_s"]
+    waiting = False
+
+    while True:
+
+        # walk the directories (without holding the lock) only if the running total is due for a refresh
+        scanned = None
+        if budget["max_B"] is not None and _cached_usage(budget, _load_state(budget)) is None:
+            scanned = {"bytes": sum(usage(budget).values()), "at": time.time()}
+
+        with _budget_lock, file_lock(budget["state_path"]):
+
+            state = _load_state(budget)
+            if scanned is not None and _cached_usage(budget, state) is None:
+                state["usage"] = scanned
+            used = (_cached_usage(budget, state) or 0) if budget["max_B"] is not None else 0
+            reservations = _live_reservations(state["reservations"])
+            over = _overflow(budget, used, nbytes, reservations)
+
+            # free some space by dropping raw archives that are no longer needed
+            if over > 0 and budget["evict_raw"]:
+                in_use = {r.get("archive") for r in reservations.values()} | {archive_name}
+                freed = evict(budget, over, in_use)
+                if freed > 0:
+                    used -= freed
+                    if "usage" in state:
+                        state["usage"]["bytes"] -= freed
+                    over = _overflow(budget, used, nbytes, reservations)
+
+            state["reservations"] = reservations
+            if over <= 0:
+                reservations[key] = {"bytes": nbytes, "archive": archive_name, "pid": os.getpid(),
+                                     "host": socket.gethostname(), "at": time.time()}
+                _save_state(budget, state)
+                return True
+            _save_state(budget, state)
+
+            # nothing else is running, so nothing will free up
+            others = [k for k in reservations if k != key]
+            if not others or time.time() > deadline:
+                print(f"[BUDGET] {key} needs {nbytes / 1024 ** 2:.1f} MB, {over / 1024 ** 2:.1f} MB over the disk budget")
+                return False
+
+        if not waiting:
+            print(f"[BUDGET] {key} waiting for {len(others)} running operation(s) to free space")
+            waiting = True
+        time.sleep(budget["poll_s"])
+
+# drop a reservation (its bytes are on disk by now, or were never written)
+def release(budget, key):
+
+    if budget is None:
+        return
+
+    with _budget_lock, file_lock(budget["state_path"]):
+        state = _load_state(budget)
+        reservation = state["reservations"].pop(key, None)
+        if reservation is not None:
+            # its bytes are now on disk (an estimate until the next scan)
+            if "usage" in state:
+                state["usage"]["bytes"] += reservation["bytes"]
+            state["reservations"] = _live_reservations(state["reservations"])
+            _save_state(budget, state)
+
+# admit for the duration of a block: `with admitted(budget, key, nbytes) as ok: if ok: ...`
+@contextlib.contextmanager
+def admitted(budget, key, nbytes, archive_name=None):
+    ok = admit(budget, key, nbytes, archive_name=archive_name)
+    try:
+        yield ok
+    finally:
+        if ok:
+            release(budget, key)
+
+# print the usage per directory against the budget
+def print_usage(budget):
+
+    if budget is None:
+        return
+
+    used = usage(budget)
+    parts = ", ".join(f"{key} {n / 1024 ** 2:.1f} MB" for key, n in used.items())
+    limit = "" if budget["max_B"] is None else f" of {budget['max_B'] / 1024 ** 3:.2f} GB"
+    print(f"[BUDGET] {sum(used.values()) / 1024 ** 2:.1f} MB used{limit} ({parts})")
@@ -1,5 +1,21 @@
+import os
+import json
+import itertools
+import struct
+import threading
+import contextlib
 from pathlib import Path
-from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+
+# advisory file locks (POSIX); elsewhere only the in-process locks apply
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# every PNG starts with this signature, immediately followed by the IHDR chunk
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_HEADER_BYTES = 26   # signature (8) + chunk length (4) + chunk type (4) + width/height (8) + bit depth/color type (2)
 
 
 # get agent ids
@@ -25,31 +41,204 @@ def get_agent_ids(root_dir, include_negative=True):
     agent_ids.sort(key=int)
     return agent_ids
 
+# directory listings, reused while a directory's mtime is unchanged: {path: (mtime_ns, [(name, is_dir)])}
+_dir_snapshots = {}
+_snapshot_lock = threading.Lock()
+
+# the entries of a directory as sorted (name, is_dir) pairs
+def _list_dir(path, use_cache=False):
+
+    if use_cache:
+        mtime_ns = os.stat(path).st_mtime_ns
+        with _snapshot_lock:
+            snapshot = _dir_snapshots.get(path)
+        if snapshot is not None and snapshot[0] == mtime_ns:
+            return snapshot[1]
+
+    with os.scandir(path) as it:
+        entries = sorted((entry.name, entry.is_dir()) for entry in it)
+
+    if use_cache:
+        with _snapshot_lock:
+            _dir_snapshots[path] = (mtime_ns, entries)
+
+    return entries
+
+# walk a tree in sorted order, yielding the files whose name passes `match` (as path strings)
+def _walk_sorted(path, match, use_cache=False):
+    for name, is_dir in _list_dir(path, use_cache):
+        child = os.path.join(path, name)
+        if is_dir:
+            yield from _walk_sorted(child, match, use_cache)
+        elif match(name):
+            yield child
+
 # find image
-def find_imgs(root, camera=None, ext=".png", limit=5):
+def find_imgs(root, camera=None, ext=".png", limit=5, use_cache=False, as_paths=True):
+
+    '''
+    Same result as sorted(root.rglob(f"*{camera}*{ext}"))[:limit], but the tree is walked with
+    os.scandir in sorted order and stops after `limit` matches. Names are matched before any Path
+    is built (as_paths=False returns the path strings). use_cache reuses directory listings while
+    the directory's mtime is unchanged.
+    '''
 
     # we specify the root direct
     root = Path(root)
+    if not root.is_dir():
+        return []
 
     # if I don't specify a camera, return all
     if camera is None:
-        pattern = f"*camera*{ext}"
-    # else, return a specific one
-    else:
-        pattern = f"*{camera}*{ext}"
-
-    if limit is None:
-        # we can limit the max returns
-        return sorted(root.rglob(pattern))
-    else:
-        return sorted(root.rglob(pattern))[:limit]
+        camera = "camera"
+
+    # match on the raw name: *{camera}*{ext}
+    def match(name):
+        return name.endswith(ext) and camera in name[:len(name) - len(ext)]
+
+    found = _walk_sorted(str(root), match, use_cache)
+
+    # we can limit the max returns
+    if limit is not None:
+        found = itertools.islice(found, limit)
+
+    return [Path(p) for p in found] if as_paths else list(found)
+
+# cheap identity for a file on disk (changes whenever the file is rewritten)
+def file_fingerprint(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+# read width/height/bit depth/color type from the IHDR chunk of a PNG
+def read_png_header(path):
+
+    '''
+    Only reads the first 26 bytes of the file:
+        [signature:8][length:4]["IHDR":4][width:4][height:4][bit_depth:1][color_type:1]
+    Returns None if the file is not a PNG (or is too short to be one).
+    '''
+
+    with open(path, "rb") as f:
+        head = f.read(PNG_HEADER_BYTES)
+
+    if len(head) < PNG_HEADER_BYTES or head[:8] != PNG_SIGNATURE or head[12:16] != b"IHDR":
+        return None
+
+    width, height, bit_depth, color_type = struct.unpack(">IIBB", head[16:26])
+
+    return {
+        "width": width,
+        "height": height,
+        "bit_depth": bit_depth,
+        "color_type": color_type,
+    }
+
+# load a per-file JSON cache (path -> fingerprint + cached result)
+def load_json_cache(cache_path):
+    if cache_path is None:
+        return {}
+    cache_path = Path(cache_path)
+    if not cache_path.exists():
+        return {}
+    return json.loads(cache_path.read_text())
+
+# hold an exclusive lock on {path}.lock, across processes (e.g. queue workers sharing a cache)
+@contextlib.contextmanager
+def file_lock(path):
+    lock_path = Path(f"{path}.lock")
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(lock_path, "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+# replace a file in one step, so a reader never sees it half written
+def write_atomic(path, text):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    temp.write_text(text)
+    os.replace(temp, path)
+    return path
+
+# several stages (threads or processes) may update the same cache concurrently, so serialise writes
+_cache_lock = threading.Lock()
+
+# merge new entries into a per-file JSON cache on disk
+def update_json_cache(updates, cache_path, indent=None):
+    cache_path = Path(cache_path)
+    with _cache_lock, file_lock(cache_path):
+        cache = load_json_cache(cache_path)
+        cache.update(updates)
+        write_atomic(cache_path, json.dumps(cache, indent=indent))
+    return cache_path
+
+# fingerprint and read the header of one file (runs in a worker thread)
+def _scan_one(path):
+    try:
+        return file_fingerprint(path), read_png_header(path), None
+    except OSError as e:
+        return None, None, e
+
+# scan the headers of many images in parallel, reusing cached results for unchanged files
+def scan_image_headers(imgs, workers=8, cache_path=None):
+
+    # load previous results
+    cache = load_json_cache(cache_path)
+
+    # split into files we already know about and files we need to read
+    headers = {}
+    to_scan = []
+    for path in imgs:
+        key = str(path)
+        entry = cache.get(key)
+        if entry is not None:
+            try:
+                if entry["fingerprint"] == file_fingerprint(path):
+                    headers[key] = entry["header"]
+                    continue
+            except OSError:
+                pass
+        to_scan.append(key)
+
+    # read the remaining headers (I/O bound, so threads are enough)
+    updates = {}
+    if to_scan:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for key, (fingerprint, header, error) in zip(to_scan, pool.map(_scan_one, to_scan, chunksize=256)):
+                if error is not None:
+                    print(f"Failed to read image header: {key}\n{error}")
+                    headers[key] = None
+                    continue
+                headers[key] = header
+                updates[key] = {"fingerprint": fingerprint, "header": header}
+
+        # persist for next time
+        if cache_path is not None:
+            update_json_cache(updates, cache_path)
+
+    return headers
     
 # list the unique images sizes
-def list_image_sizes(imgs, verbose=True):
+def list_image_sizes(imgs, verbose=True, workers=8, cache_path=None):
 
     sizes = set()
 
+    # fast path: PNG headers only
+    headers = scan_image_headers(imgs, workers=workers, cache_path=cache_path)
+
     for path in imgs:
+        header = headers.get(str(path))
+        if header is not None:
+            sizes.add((header["width"], header["height"]))
+            continue
+
+        # not a PNG (or unreadable header), fall back to PIL
+        from PIL import Image
         try:
             with Image.open(path) as img:
                 sizes.add(img.size)  # (width, height)
@@ -61,4 +250,4 @@ def list_image_sizes(imgs, verbose=True):
         for w, h in sorted(sizes):
             print(f"  {w} × {h}")
 
-    return sizes
\ No newline at end of file
+    return sizes
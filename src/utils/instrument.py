@@ -0,0 +1,365 @@
+# per-stage instrumentation: wall time, CPU time, bytes in/out, files processed and peak RSS
+#
+# Nothing is wrapped until install() is called, so a disabled run pays no cost at all.
+# When enabled, the stage functions of the installed modules are replaced by a wrapper
+# that records one span per call; spans nest (a stage calling another stage records a parent).
+
+# imports
+import os
+import sys
+import json
+import time
+import uuid
+import resource
+import threading
+import functools
+from pathlib import Path
+
+# psutil is optional (better RSS / byte counters), loaded by enable() so a run without metrics skips it
+psutil = None
+
+# ru_maxrss is in KB on Linux and bytes on macOS
+_RU_MAXRSS_SCALE = 1 if sys.platform == "darwin" else 1024
+
+# stage-level functions in src.ingestion (per-file helpers are left alone, they would flood the report)
+STAGE_FUNCTIONS = {
+    "download": ["download_files", "download_files_async", "download_file", "content_length"],
+    "archive": ["index_archive", "build_manifest"],
+    "sample": ["build_sample_plan", "save_sample_plan"],
+    "extract": ["extract_file", "extract_files", "extract_selected", "extract_from_sample_plan"],
+    "validate": ["validate_images", "validate_sample_plan"],
+    "label": ["build_labels_df", "build_archive_labels_df", "add_image_headers", "merge_label_files", "save_labels"],
+    "dedup": ["hash_images", "dedup_labels"],
+    "split": ["split_labels", "build_splits"],
+    "index": ["build_index", "build_index_multi", "build_index_from_manifests", "save_index"],
+}
+
+# module state (only touched when enabled)
+_state = {
+    "enabled": False,
+    "run_id": None,
+    "report_path": None,
+    "metrics_path": None,
+    "metrics_format": "prometheus",
+    "spans": [],
+    "active": {},
+    "sampler": None,
+    "installed": [],
+}
+_lock = threading.Lock()
+_local = threading.local()
+
+# *******************************
+# Counters
+# *******************************
+
+# current resident set size in bytes
+def current_rss():
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _RU_MAXRSS_SCALE
+
+# bytes read/written by this process through system calls (files and sockets)
+def io_bytes():
+    if psutil is not None and hasattr(psutil.Process(), "io_counters"):
+        io = psutil.Process().io_counters()
+        return getattr(io, "read_chars", io.read_bytes), getattr(io, "write_chars", io.write_bytes)
+    try:
+        fields = dict(line.split(": ") for line in Path("/proc/self/io").read_text().splitlines())
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+# CPU time, block I/O and peak RSS of finished child processes (e.g. 7z)
+def children_usage():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        "cpu": usage.ru_utime + usage.ru_stime,
+        "bytes_in": usage.ru_inblock * 512,
+        "bytes_out": usage.ru_oublock * 512,
+        "maxrss": usage.ru_maxrss * _RU_MAXRSS_SCALE,
+    }
+
+# count the files a stage processed from what it returned
+def count_files(result):
+
+    # explicit extraction summaries
+    if isinstance(result, dict):
+        for key in ("total_extracted", "extracted"):
+            if isinstance(result.get(key), int):
+                return result[key]
+
+    # lists of paths, manifests, plans, dataframes...
+    if hasattr(result, "__len__") and not isinstance(result, (str, bytes, Path)):
+        try:
+            return len(result)
+        except TypeError:
+            return None
+
+    return None
+
+# stages can report what they did directly (adds to the innermost active span)
+def add_files(n):
+    stack = getattr(_local, "stack", None)
+    if stack:
+        stack[-1]["files_reported"] = stack[-1].get("files_reported", 0) + n
+
+def add_bytes(bytes_in=0, bytes_out=0):
+    stack = getattr(_local, "stack", None)
+    if stack:
+        stack[-1]["bytes_in_reported"] = stack[-1].get("bytes_in_reported", 0) + bytes_in
+        stack[-1]["bytes_out_reported"] = stack[-1].get("bytes_out_reported", 0) + bytes_out
+
+# *******************************
+# Spans
+# *******************************
+
+# sample RSS in the background so each active span sees its own peak
+def _sample_rss(interval):
+    while _state["enabled"]:
+        rss = current_rss()
+        with _lock:
+            for span in _state["active"].values():
+                span["peak"] = max(span["peak"], rss)
+        time.sleep(interval)
+
+# open a span
+def _start_span(name):
+
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+
+    bytes_in, bytes_out = io_bytes()
+    span = {
+        "id": uuid.uuid4().hex[:12],
+        "name": name,
+        "parent": stack[-1]["id"] if stack else None,
+        "t0": time.time(),
+        "wall0": time.perf_counter(),
+        "cpu0": time.thread_time(),
+        "children0": children_usage(),
+        "io0": (bytes_in, bytes_out),
+        "peak": current_rss(),
+    }
+    stack.append(span)
+    with _lock:
+        _state["active"][span["id"]] = span
+    return span
+
+# close a span and record it
+def _end_span(span, status, result=None):
+
+    _local.stack.pop()
+    with _lock:
+        _state["active"].pop(span["id"], None)
+
+    bytes_in, bytes_out = io_bytes()
+    children = children_usage()
+    files = span.get("files_reported")
+    if files is None:
+        files = count_files(result)
+
+    record = {
+        "run_id": _state["run_id"],
+        "span_id": span["id"],
+        "parent_id": span["parent"],
+        "stage": span["name"],
+        "status": status,
+        "thread": threading.current_thread().name,
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(span["t0"])),
+        "wall_s": round(time.perf_counter() - span["wall0"], 6),
+        "cpu_s": round(time.thread_time() - span["cpu0"], 6),
+        # child processes are process-wide, so concurrent stages share these
+        "children_cpu_s": round(children["cpu"] - span["children0"]["cpu"], 6),
+        "bytes_in": bytes_in - span["io0"][0] + children["bytes_in"] - span["children0"]["bytes_in"]
+                    + span.get("bytes_in_reported", 0),
+        "bytes_out": bytes_out - span["io0"][1] + children["bytes_out"] - span["children0"]["bytes_out"]
+                     + span.get("bytes_out_reported", 0),
+        "files": files,
+        "peak_rss_bytes": max(span["peak"], current_rss()),
+        "children_peak_rss_bytes": children["maxrss"],
+    }
+
+    with _lock:
+        _state["spans"].append(record)
+        if _state["report_path"] is not None:
+            with open(_state["report_path"], "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+    return record
+
+# wrap one function so each call records a span
+def instrument(func, name=None):
+
+    name = name or f"{func.__module__.split('.')[-1]}.{func.__name__}"
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        span = _start_span(name)
+        try:
+            result = func(*args, **kwargs)
+        except BaseException:
+            _end_span(span, "error")
+            raise
+        _end_span(span, "ok", result)
+        return result
+
+    wrapper.__instrumented__ = func
+    return wrapper
+
+# wrap functions of each module: {module: [function names]}, or every public function if names is None
+def install(modules):
+    import inspect
+    for module, names in modules.items():
+        for attr, obj in list(vars(module).items()):
+            if attr.startswith("_") or not inspect.isfunction(obj):
+                continue
+            if names is not None and attr not in names:
+                continue
+            if obj.__module__ != module.__name__ or hasattr(obj, "__instrumented__"):
+                continue
+            setattr(module, attr, instrument(obj))
+            _state["installed"].append((module, attr, obj))
+
+# put the original functions back
+def uninstall():
+    for module, attr, obj in _state["installed"]:
+        setattr(module, attr, obj)
+    _state["installed"] = []
+
+# *******************************
+# Lifecycle
+# *******************************
+
+# turn instrumentation on
+def enable(report_path=None, metrics_path=None, metrics_format="prometheus", sample_interval=0.05):
+
+    global psutil
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+
+    _state["enabled"] = True
+    _state["run_id"] = time.strftime("%Y%m%dT%H%M%S") + "-" + uuid.uuid4().hex[:6]
+    _state["spans"] = []
+    _state["report_path"] = Path(report_path) if report_path is not None else None
+    _state["metrics_path"] = Path(metrics_path) if metrics_path is not None else None
+    _state["metrics_format"] = metrics_format
+
+    if _state["report_path"] is not None:
+        _state["report_path"].parent.mkdir(parents=True, exist_ok=True)
+
+    # background RSS sampling (daemon, stops when disabled)
+    sampler = threading.Thread(target=_sample_rss, args=(sample_interval,), daemon=True)
+    sampler.start()
+    _state["sampler"] = sampler
+
+# set up from the "instrumentation" section of config.json (does nothing if disabled)
+def setup(cfg, index_dir, modules=None):
+
+    inst_cfg = cfg.get("instrumentation", {})
+    if not inst_cfg.get("enabled", False):
+        return False
+
+    index_dir = Path(index_dir)
+    metrics_filename = inst_cfg.get("metrics_filename")
+
+    enable(
+        report_path=index_dir / inst_cfg.get("report_filename", "run_report.ndjson"),
+        metrics_path=index_dir / metrics_filename if metrics_filename else None,
+        metrics_format=inst_cfg.get("metrics_format", "prometheus"),
+        sample_interval=float(inst_cfg.get("sample_interval_s", 0.05)),
+    )
+
+    # default: the stage functions in src.ingestion (plus the stage graph, if used)
+    if modules is None:
+        import importlib
+        modules = {
+            importlib.import_module(f"src.ingestion.{name}"): functions
+            for name, functions in STAGE_FUNCTIONS.items()
+        }
+        if cfg.get("pipeline", {}).get("mode") == "dag":
+            stages = importlib.import_module("src.pipeline.stages")
+            modules[stages] = [name for name in vars(stages) if name.startswith("run_") and name != "run_pipeline"]
+
+    install(modules)
+    print(f"[INSTRUMENT] Recording stage metrics (run {_state['run_id']})")
+    return True
+
+# aggregate spans per stage
+def summarize(spans=None):
+
+    spans = _state["spans"] if spans is None else spans
+    summary = {}
+    for span in spans:
+        s = summary.setdefault(span["stage"], {"calls": 0, "errors": 0, "wall_s": 0.0, "cpu_s": 0.0,
+                                               "children_cpu_s": 0.0, "bytes_in": 0, "bytes_out": 0,
+                                               "files": 0, "peak_rss_bytes": 0})
+        s["calls"] += 1
+        s["errors"] += span["status"] != "ok"
+        for key in ("wall_s", "cpu_s", "children_cpu_s"):
+            s[key] = round(s[key] + span[key], 6)
+        for key in ("bytes_in", "bytes_out"):
+            s[key] += span[key]
+        s["files"] += span["files"] or 0
+        s["peak_rss_bytes"] = max(s["peak_rss_bytes"], span["peak_rss_bytes"])
+    return summary
+
+# render the summary as Prometheus text exposition (or OpenMetrics)
+def format_metrics(summary, metrics_format="prometheus"):
+
+    metrics = [
+        ("advercity_stage_calls", "counter", "Number of calls", "calls"),
+        ("advercity_stage_errors", "counter", "Number of calls that raised", "errors"),
+        ("advercity_stage_wall_seconds", "counter", "Wall-clock time", "wall_s"),
+        ("advercity_stage_cpu_seconds", "counter", "CPU time of the calling thread", "cpu_s"),
+        ("advercity_stage_children_cpu_seconds", "counter", "CPU time of child processes", "children_cpu_s"),
+        ("advercity_stage_read_bytes", "counter", "Bytes read", "bytes_in"),
+        ("advercity_stage_written_bytes", "counter", "Bytes written", "bytes_out"),
+        ("advercity_stage_files", "counter", "Files processed", "files"),
+        ("advercity_stage_peak_rss_bytes", "gauge", "Peak resident set size", "peak_rss_bytes"),
+    ]
+
+    openmetrics = metrics_format == "openmetrics"
+    lines = []
+    for metric, kind, help_text, key in metrics:
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} {kind}")
+        # OpenMetrics counters carry a _total suffix on the sample
+        sample = f"{metric}_total" if openmetrics and kind == "counter" else metric
+        for stage, s in sorted(summary.items()):
+            lines.append(f'{sample}{{stage="{stage}"}} {s[key]}')
+    if openmetrics:
+        lines.append("# EOF")
+
+    return "\n".join(lines) + "\n"
+
+# finish the run: write the summary and metrics, unwrap functions (no-op if never enabled)
+def finish():
+
+    if not _state["enabled"]:
+        return None
+
+    _state["enabled"] = False
+    summary = summarize()
+
+    if _state["report_path"] is not None:
+        with open(_state["report_path"], "a") as f:
+            f.write(json.dumps({"run_id": _state["run_id"], "summary": summary}) + "\n")
+        print(f"[SAVE] Run report saved to {_state['report_path'].name}")
+
+    if _state["metrics_path"] is not None:
+        # write then rename, so a textfile collector never reads a partial file
+        temp = _state["metrics_path"].with_suffix(_state["metrics_path"].suffix + ".tmp")
+        temp.write_text(format_metrics(summary, _state["metrics_format"]))
+        temp.rename(_state["metrics_path"])
+        print(f"[SAVE] Metrics saved to {_state['metrics_path'].name}")
+
+    uninstall()
+    return summary
@@ -0,0 +1,252 @@
+# optional per-stage profiling: cProfile stats or a sampled collapsed-stack (flamegraph) file,
+# plus the top tracemalloc allocators, saved under data/index/profiles/
+#
+# A stage is picked by name: a stage-graph stage ("extract:rcnj_cn_s"), a stage kind ("extract"),
+# or an ingestion function ("extract.extract_selected"). Worker pools created while the profiled
+# stage runs (see pool_kwargs) profile each worker process too.
+
+# imports
+import os
+import sys
+import time
+import cProfile
+import threading
+import functools
+import importlib
+import tracemalloc
+from pathlib import Path
+from collections import Counter
+
+# the function each stage kind maps to when the pipeline runs in linear mode
+STAGE_TARGETS = {
+    "download": "download.download_files",
+    "manifest": "archive.build_manifest",
+    "plan": "sample.build_sample_plan",
+    "extract": "extract.extract_from_sample_plan",
+    "validate": "validate.validate_sample_plan",
+    "label": "label.build_labels_df",
+    "dedup": "dedup.dedup_labels",
+    "split": "split.build_splits",
+}
+
+# module state
+_settings = {"stage": None, "out_dir": None, "mode": "cprofile", "top": 25, "interval": 0.005}
+_cprofile_lock = threading.Lock()
+_tracemalloc_users = [0]
+_tracemalloc_lock = threading.Lock()
+_local = threading.local()
+_patched = []
+
+# *******************************
+# Profilers
+# *******************************
+
+# sample one thread's stack at a fixed interval and count collapsed stacks
+def _sampler(thread_id, interval, counts, stop):
+    while not stop.is_set():
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})")
+            frame = frame.f_back
+        if stack:
+            counts[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+
+# start profiling the current thread, returns a session to pass to _stop
+def _start(mode, interval):
+
+    session = {"mode": mode}
+
+    # tracemalloc is process-wide, so count users
+    with _tracemalloc_lock:
+        if _tracemalloc_users[0] == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(25)
+            session["owns_tracemalloc"] = True
+        _tracemalloc_users[0] += 1
+
+    if mode == "sampling":
+        session["counts"] = Counter()
+        session["stop"] = threading.Event()
+        session["thread"] = threading.Thread(
+            target=_sampler,
+            args=(threading.get_ident(), interval, session["counts"], session["stop"]),
+            daemon=True
+        )
+        session["thread"].start()
+
+    # only one cProfile session can be active at a time
+    elif _cprofile_lock.acquire(blocking=False):
+        session["profiler"] = cProfile.Profile()
+        session["profiler"].enable()
+
+    return session
+
+# stop profiling and write the results, returns the paths written
+def _stop(session, base_path, top):
+
+    written = []
+
+    if "profiler" in session:
+        session["profiler"].disable()
+        _cprofile_lock.release()
+        prof_path = Path(f"{base_path}.prof")
+        session["profiler"].dump_stats(prof_path)
+        written.append(prof_path)
+
+    if "thread" in session:
+        session["stop"].set()
+        session["thread"].join()
+        collapsed_path = Path(f"{base_path}.collapsed")
+        collapsed_path.write_text("".join(f"{stack} {n}\n" for stack, n in session["counts"].most_common()))
+        written.append(collapsed_path)
+
+    # top allocators (by line) while the stage ran
+    snapshot = tracemalloc.take_snapshot() if tracemalloc.is_tracing() else None
+    with _tracemalloc_lock:
+        _tracemalloc_users[0] -= 1
+        if _tracemalloc_users[0] == 0 and session.get("owns_tracemalloc"):
+            tracemalloc.stop()
+
+    if snapshot is not None:
+        stats = snapshot.filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ]).statistics("lineno")
+        alloc_path = Path(f"{base_path}.tracemalloc.txt")
+        lines = [f"# top {top} allocators (by line), still allocated at the end of the stage"]
+        lines += [str(stat) for stat in stats[:top]]
+        alloc_path.write_text("\n".join(lines) + "\n")
+        written.append(alloc_path)
+
+    return written
+
+# file name prefix for one profiled call
+def _base_path(out_dir, name):
+    safe = "".join(c if c.isalnum() or c in "-_" else "_" for c in name)
+    return Path(out_dir) / f"{safe}_{time.strftime('%Y%m%dT%H%M%S')}_{os.getpid()}"
+
+# run func under the profiler and save the results
+def run_profiled(func, name, out_dir, mode, top, interval, *args, **kwargs):
+
+    # already profiling in this thread (e.g. a stage calling a profiled function)
+    if getattr(_local, "active", False):
+        return func(*args, **kwargs)
+
+    Path(out_dir).mkdir(parents=True, exist_ok=True)
+    _local.active = True
+    _local.name = name
+    session = _start(mode, interval)
+    if mode == "cprofile" and "profiler" not in session:
+        print(f"[PROFILE] {name}: another stage is being profiled, recording allocations only")
+
+    try:
+        return func(*args, **kwargs)
+    finally:
+        written = _stop(session, _base_path(out_dir, name), top)
+        _local.active = False
+        for path in written:
+            print(f"[PROFILE] {name}: saved {path.name}")
+
+# wrap a function so every call is profiled
+def wrap(func, name):
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return run_profiled(func, name, _settings["out_dir"], _settings["mode"],
+                            _settings["top"], _settings["interval"], *args, **kwargs)
+
+    wrapper.__profiled__ = func
+    return wrapper
+
+# *******************************
+# Worker processes
+# *******************************
+
+# runs in each worker process: profile until the worker exits
+def _worker_initializer(name, out_dir, mode, top, interval):
+
+    # a forked worker inherits the parent's locks and counters, start clean
+    global _cprofile_lock
+    _cprofile_lock = threading.Lock()
+    _tracemalloc_users[0] = 0
+
+    Path(out_dir).mkdir(parents=True, exist_ok=True)
+    session = _start(mode, interval)
+    base_path = _base_path(out_dir, f"{name}-worker")
+    # multiprocessing finalizers run when a pool worker shuts down (atexit does not)
+    import multiprocessing.util
+    multiprocessing.util.Finalize(None, _stop, args=(session, base_path, top), exitpriority=10)
+
+# extra ProcessPoolExecutor arguments: profile the workers if the calling stage is being profiled
+def pool_kwargs():
+    if not getattr(_local, "active", False):
+        return {}
+    return {
+        "initializer": _worker_initializer,
+        "initargs": (_local.name, str(_settings["out_dir"]), _settings["mode"],
+                     _settings["top"], _settings["interval"]),
+    }
+
+# *******************************
+# Setup
+# *******************************
+
+# True if a stage-graph stage name matches the profiled stage ("extract" matches "extract:ri_cn_s")
+def matches(stage_name):
+    stage = _settings["stage"]
+    return stage is not None and (stage_name == stage or stage_name.split(":")[0] == stage)
+
+# wrap the matching stage-graph stages (no-op if profiling is off)
+def wrap_stages(stages):
+    for stage in stages:
+        if matches(stage["name"]):
+            stage["func"] = wrap(stage["func"], stage["name"])
+    return stages
+
+# turn profiling on for one stage
+def setup(stage, out_dir, mode="cprofile", top=25, interval=0.005):
+
+    if not stage:
+        return False
+
+    if mode not in ("cprofile", "sampling"):
+        raise ValueError(f"Unsupported profiling mode: {mode} (cprofile or sampling)")
+
+    _settings.update({"stage": stage, "out_dir": Path(out_dir), "mode": mode, "top": top, "interval": interval})
+
+    # patch the ingestion function behind the stage (linear mode, or a "module.function" name)
+    target = STAGE_TARGETS.get(stage, stage if "." in stage else None)
+    if target is not None:
+        module_name, func_name = target.split(".", 1)
+        module = importlib.import_module(f"src.ingestion.{module_name}")
+        func = getattr(module, func_name)
+        setattr(module, func_name, wrap(func, stage))
+        _patched.append((module, func_name, func))
+
+    print(f"[PROFILE] Profiling stage '{stage}' ({mode}) into {Path(out_dir)}")
+    return True
+
+# set up from the "profiling" section of config.json (a command line stage/mode takes precedence)
+def setup_from_config(cfg, index_dir, stage=None, mode=None):
+
+    prof_cfg = cfg.get("profiling", {})
+    stage = stage or prof_cfg.get("stage")
+    if not stage:
+        return False
+
+    return setup(
+        stage,
+        Path(index_dir) / prof_cfg.get("dirname", "profiles"),
+        mode=mode or prof_cfg.get("mode", "cprofile"),
+        top=int(prof_cfg.get("tracemalloc_top", 25)),
+        interval=float(prof_cfg.get("sample_interval_s", 0.005)),
+    )
+
+# undo setup
+def teardown():
+    for module, func_name, func in _patched:
+        setattr(module, func_name, func)
+    _patched.clear()
+    _settings["stage"] = None
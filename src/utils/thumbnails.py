@@ -0,0 +1,180 @@
+# a thumbnail atlas for browsing images without decoding the full-resolution PNGs
+#
+# Thumbnails (at most size x size, aspect ratio kept) are packed into one memory-mapped uint8 file,
+# thumbnails.u8, of shape (slots, size, size, 3). thumbnails.json maps each image path to its slot,
+# the thumbnail's shape, the original size and the source fingerprint (size, mtime); an image whose
+# fingerprint changed is rebuilt in its slot. Images that cannot be read are noted with their fingerprint
+# and only tried again once the file changes. numpy and PIL are imported inside the functions.
+
+# imports
+import os
+import json
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from src.utils.file_operations import file_fingerprint, file_lock, write_atomic, load_json_cache
+
+ATLAS_FILENAME = "thumbnails.u8"
+INDEX_FILENAME = "thumbnails.json"
+
+# *******************************
+# Atlas
+# *******************************
+
+# the atlas index ({} entries if there is none, or if it was built for another size)
+def load_atlas_index(atlas_dir, size):
+    index = load_json_cache(Path(atlas_dir) / INDEX_FILENAME)
+    if index.get("size") != size:
+        return {"size": size, "slots": 0, "images": {}, "failed": {}}
+    index.setdefault("failed", {})
+    return index
+
+# the atlas as an array of shape (slots, size, size, 3)
+def open_atlas(atlas_dir, size, slots, mode="r"):
+
+    import numpy as np
+
+    return np.memmap(Path(atlas_dir) / ATLAS_FILENAME, dtype=np.uint8, mode=mode, shape=(slots, size, size, 3))
+
+# decode and shrink one image (runs in a worker thread; PIL releases the GIL while decoding and resizing)
+def _make_thumbnail(path, size):
+
+    from PIL import Image
+    import numpy as np
+
+    try:
+        fingerprint = file_fingerprint(path)
+        with Image.open(path) as img:
+            original = img.size
+            img.draft("RGB", (size, size))
+            img = img.convert("RGB")
+            img.thumbnail((size, size))
+            return fingerprint, original, np.asarray(img), None
+    except Exception as e:
+        return None, None, None, f"{type(e).__name__}: {e}"
+
+# *******************************
+# Build
+# *******************************
+
+# add the thumbnails of these images to the atlas (only new or changed images are decoded)
+def build_thumbnails(imgs, atlas_dir, size=256, workers=8):
+
+    '''
+    Returns the atlas index: {"size", "slots", "images": {path: {"slot", "shape",
+    "original", "fingerprint"}}, "failed": {path: fingerprint}}. Images that cannot
+    be read are left out of images (and get no slot).
+    '''
+
+    atlas_dir = Path(atlas_dir)
+    atlas_dir.mkdir(parents=True, exist_ok=True)
+    index_path = atlas_dir / INDEX_FILENAME
+
+    with file_lock(index_path):
+
+        index = load_atlas_index(atlas_dir, size)
+        images = index["images"]
+        failures = index["failed"]
+
+        # images that are not in the atlas, or whose file changed since (failures are not retried until then)
+        to_build = []
+        for path in dict.fromkeys(str(p) for p in imgs):
+            entry = images.get(path)
+            try:
+                fingerprint = file_fingerprint(path)
+            except OSError:
+                continue
+            if entry is not None and entry["fingerprint"] == fingerprint:
+                continue
+            if failures.get(path) == fingerprint:
+                continue
+            to_build.append(path)
+
+        if not to_build:
+            return index
+
+        # a stale image keeps its slot, new ones are appended (a new atlas starts from scratch); room is
+        # reserved for every new image, and the file is cut back to the slots actually used afterwards
+        reserved = index["slots"] + sum(1 for path in to_build if path not in images)
+        atlas_path = atlas_dir / ATLAS_FILENAME
+        if index["slots"] == 0 and atlas_path.exists():
+            atlas_path.unlink()
+        with open(atlas_path, "ab") as f:
+            f.truncate(reserved * size * size * 3)
+        atlas = open_atlas(atlas_dir, size, reserved, mode="r+")
+
+        next_slot = index["slots"]
+        failed = 0
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for path, (fingerprint, original, thumb, error) in zip(to_build, pool.map(lambda p: _make_thumbnail(p, size), to_build)):
+                if error is not None:
+                    failed += 1
+                    try:
+                        failures[path] = file_fingerprint(path)
+                    except OSError:
+                        pass
+                    continue
+                failures.pop(path, None)
+                if path in images:
+                    slot = images[path]["slot"]
+                else:
+                    slot = next_slot
+                    next_slot += 1
+                atlas[slot] = 0
+                atlas[slot, :thumb.shape[0], :thumb.shape[1]] = thumb
+                images[path] = {"slot": slot, "shape": list(thumb.shape[:2]), "original": list(original),
+                                "fingerprint": fingerprint}
+
+        atlas.flush()
+        del atlas
+
+        # images that failed get no slot
+        with open(atlas_path, "r+b") as f:
+            f.truncate(next_slot * size * size * 3)
+        index["slots"] = next_slot
+        write_atomic(index_path, json.dumps(index))
+
+    print(f"[THUMBS] Built {len(to_build) - failed} thumbnails ({failed} failed), {len(images)} in the atlas")
+    return index
+
+# *******************************
+# Read
+# *******************************
+
+# the thumbnail of an image as an (h, w, 3) array and its original (width, height), or (None, None) if it
+# is not in the atlas or its file changed since
+def read_thumbnail(path, atlas_dir, size=256, index=None, atlas=None):
+
+    if index is None:
+        index = load_atlas_index(atlas_dir, size)
+
+    entry = index["images"].get(str(path))
+    try:
+        if entry is None or entry["fingerprint"] != file_fingerprint(path):
+            return None, None
+    except OSError:
+        return None, None
+
+    if atlas is None:
+        atlas = open_atlas(atlas_dir, index["size"], index["slots"])
+    height, width = entry["shape"]
+    return atlas[entry["slot"], :height, :width], tuple(entry["original"])
+
+# the thumbnails of several images, building the missing ones first: [(array, (width, height))]
+def thumbnails_for(imgs, atlas_dir, size=256, workers=8):
+
+    index = build_thumbnails(imgs, atlas_dir, size=size, workers=workers)
+    if index["slots"] == 0:
+        return [(None, None) for _ in imgs]
+
+    atlas = open_atlas(atlas_dir, index["size"], index["slots"])
+    return [read_thumbnail(path, atlas_dir, size=size, index=index, atlas=atlas) for path in imgs]
+
+# the thumbnail stage: thumbnails of every labelled image
+def build_label_thumbnails(labels_file, sampled_dir, atlas_dir, size=256, workers=8):
+
+    import csv
+
+    with open(labels_file, newline="") as f:
+        imgs = [os.path.join(sampled_dir, row["image_path"]) for row in csv.DictReader(f)]
+
+    return build_thumbnails(imgs, atlas_dir, size=size, workers=workers)
@@ -1,11 +1,11 @@
-from directory_tree import DisplayTree
-from PIL import Image
+# imports (matplotlib, PIL and directory_tree are imported inside the functions that use them, to keep startup fast)
 import random
-import matplotlib.pyplot as plt
 
 # print the folder tree
 def print_folder_tree(root_dir, max_depth=1):
 
+    from directory_tree import DisplayTree
+
     # configuration
     config_tree = {
         # specify starting path 
@@ -20,10 +20,34 @@ def print_folder_tree(root_dir, max_depth=1):
     # create and display tree
     DisplayTree(**config_tree)
 
-# show image
-def show_image(path, title=None, figsize = (6,6)):
-    try:
+# load an image for display: its thumbnail from the atlas in atlas_dir (built if needed), else the full image;
+# returns (image, (original width, original height))
+def load_display_images(paths, atlas_dir=None, thumb_size=256):
+
+    from PIL import Image
+
+    thumbs = [(None, None)] * len(paths)
+    if atlas_dir is not None:
+        from src.utils.thumbnails import thumbnails_for
+        thumbs = thumbnails_for(paths, atlas_dir, size=thumb_size)
+
+    loaded = []
+    for path, (thumb, original) in zip(paths, thumbs):
+        if thumb is not None:
+            loaded.append((thumb, original))
+            continue
         img = Image.open(path).convert("RGB")
+        loaded.append((img, img.size))
+
+    return loaded
+
+# show image (from the thumbnail atlas in atlas_dir, if given)
+def show_image(path, title=None, figsize = (6,6), atlas_dir=None, thumb_size=256):
+
+    import matplotlib.pyplot as plt
+
+    try:
+        img, img_size = load_display_images([path], atlas_dir=atlas_dir, thumb_size=thumb_size)[0]
     except Exception as e:
         print(f"Failed to load image: {path}\n{e}")
         return
@@ -34,11 +58,14 @@ def show_image(path, title=None, figsize = (6,6)):
     if title:
         plt.title(title)
     else:
-        plt.title(f"{img.size[0]}x{img.size[1]}")
+        plt.title(f"{img_size[0]}x{img_size[1]}")
     plt.show()
 
-# show images as a grid
-def show_images_grid(imgs, rows=2, cols=3, randomize = True, seed=None):
+# show images as a grid (from the thumbnail atlas in atlas_dir, if given)
+def show_images_grid(imgs, rows=2, cols=3, randomize = True, seed=None, atlas_dir=None, thumb_size=256):
+
+    import matplotlib.pyplot as plt
+
     n = rows * cols
 
     if not imgs:
@@ -55,10 +82,9 @@ def show_images_grid(imgs, rows=2, cols=3, randomize = True, seed=None):
     fig, axes = plt.subplots(rows, cols, figsize=(cols * 4, rows * 4))
     axes = axes.flatten()
 
-    for ax, path in zip(axes, imgs):
-        img = Image.open(path).convert("RGB")
+    for ax, (img, img_size) in zip(axes, load_display_images(imgs, atlas_dir=atlas_dir, thumb_size=thumb_size)):
         ax.imshow(img)
-        ax.set_title(f"{img.size[0]} × {img.size[1]}", fontsize=10)
+        ax.set_title(f"{img_size[0]} × {img_size[1]}", fontsize=10)
         ax.axis("off")
 
     # turn off unused axes